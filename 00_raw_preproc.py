@@ -1,16 +1,19 @@
 import sys
 import time
+import shutil
+import tempfile
 import utils
+from tools.stage_cache import StageCache, code_files
+from tools.catalogue import DatasetCatalogue, derived_cache_path, ds_subject_block
+from tools.fast_ica import fit_ica
 import numpy as np
-from copy import copy
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from mne import set_log_level
 from meegkit.dss import dss_line_iter
 from mne.io import (
-    read_raw_ctf,
-    RawArray
+    read_raw_ctf
 )
-from mne.preprocessing import ICA
 from mne import (
     find_events,
     annotations_from_events
@@ -27,27 +30,232 @@ raw_path = dataset_path.joinpath("MEG", "raw")
 proc_path = dataset_path.joinpath("MEG", "processed")
 beh_path = dataset_path.joinpath("BEH")
 
-# specific file search and selection
-all_files = utils.get_directories(raw_path, depth="all")
-all_files = [i for i in all_files if "realtime" in i.parts[-1]]
+# specific file search and selection, from the incrementally refreshed dataset catalogue
+catalogue = DatasetCatalogue(dataset_path, settings.get("catalogue_path"))
+catalogue.refresh()
+all_files = catalogue.query(strings=["realtime"], under=raw_path, is_dir=True, order_by="path")
+
+ZAPLINE_PARAMS = dict(fline=50.0, spot_sz=5.5, win_sz=10, nfft=1024, n_iter_max=30)
+
+# ICA fit, see tools.fast_ica.fit_ica, overridden by the settings.json "ica" dictionary
+ICA_PARAMS = dict(
+    n_components=20, method="fastica", fit_params=None, decim=1, segment_length=10.0, segment_step=1,
+    random_state=None, fit_cache=False, compare=False
+)
+
+def zapline_chunk(data, sfreq):
+    """Zapline of one chunk (channels x times), returns the cleaned chunk in the same layout."""
+    cleaned, iters = dss_line_iter(data.T, sfreq=sfreq, **ZAPLINE_PARAMS)
+    return cleaned.T
+
+
+def zapline(data, picks, sfreq, n_chunks=10, overlap=0, n_jobs=1, label=""):
+    """
+    Chunked zapline, written in place into `data`.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Continuous data (channels x times), the `picks` rows are overwritten with the cleaned data.
+    picks : numpy.ndarray
+        Indices of the channels to clean.
+    sfreq : float
+        Sampling frequency in Hz.
+    n_chunks : int
+        Number of chunks along time, same boundaries as np.array_split.
+    overlap : int
+        Samples of uncleaned data added on both sides of each chunk for the fit, only the chunk itself is written
+        back.
+    n_jobs : int
+        Number of worker processes, at most n_jobs chunks are in flight at once.
+    label : str
+        Prefix of the progress messages.
+    """
+
+    n_times = data.shape[1]
+    sizes = [n_times // n_chunks + 1] * (n_times % n_chunks) + [n_times // n_chunks] * (n_chunks - n_times % n_chunks)
+    bounds = np.cumsum([0] + sizes)
+    # contiguous channel block as a view, fancy indexing would copy the whole array
+    if np.all(np.diff(picks) == 1):
+        rows = slice(picks[0], picks[-1] + 1)
+    else:
+        rows = picks
+
+    # the left pads lie in earlier chunks, which are overwritten before (serial) or while (parallel) the later
+    # chunks are cleaned, they are taken from the original data so that both give the same result. The chunk
+    # itself and its right pad are only written back after its result.
+    left_pads = [np.array(data[rows, max(0, bounds[ix] - overlap):bounds[ix]]) for ix in range(n_chunks)]
+
+    def chunk_input(ix):
+        stop = min(n_times, bounds[ix + 1] + overlap)
+        offset = left_pads[ix].shape[1]
+        if offset == 0:
+            return data[rows, bounds[ix]:stop], offset
+        return np.concatenate([left_pads[ix], data[rows, bounds[ix]:stop]], axis=1), offset
+
+    def write_back(ix, cleaned, offset):
+        core = bounds[ix + 1] - bounds[ix]
+        data[rows, bounds[ix]:bounds[ix + 1]] = cleaned[:, offset:offset + core]
+        print(label, f"{ix+1}/{n_chunks}")
+
+    if n_jobs == 1:
+        for ix in range(n_chunks):
+            chunk, offset = chunk_input(ix)
+            write_back(ix, zapline_chunk(chunk, sfreq), offset)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        running = {}
+        for ix in range(n_chunks):
+            chunk, offset = chunk_input(ix)
+            running[ix] = (pool.submit(zapline_chunk, chunk, sfreq), offset)
+            # bound the chunks in flight, collected in order
+            if len(running) >= n_jobs:
+                first = min(running)
+                future, first_offset = running.pop(first)
+                write_back(first, future.result(), first_offset)
+        for ix in sorted(running):
+            future, offset = running[ix]
+            write_back(ix, future.result(), offset)
+
+
+def memory_target(n_times, n_channels, n_mag, n_chunks=10, overlap=0, n_jobs=1, low_memory=True, ica_fraction=1.0):
+    """
+    Estimated peak resident memory of `process_ds` in bytes, to decide how many blocks can run on one node.
+
+    MNE filters and fits ICA on float64 data, the estimate counts 8 bytes per sample.
+
+    Parameters
+    ----------
+    n_times : int
+        Number of samples of the recording.
+    n_channels : int
+        Number of channels read from the dataset.
+    n_mag : int
+        Number of channels cleaned by zapline and used by the ICA.
+    low_memory : bool
+        Whether the continuous buffer is disk-backed (not counted) or held in memory.
+    ica_fraction : float
+        Fraction of the samples the ICA is fitted on, 1 / (decim * segment_step).
+
+    See `zapline` for the other parameters.
+
+    Returns
+    -------
+    target : int
+        Bytes of anonymous memory: the in-memory buffer, the largest of the zapline chunks in flight
+        (chunk, its transposed copy and the DSS intermediates, about 4 copies each) and the ICA fit
+        (data copy, pre-whitened and demeaned copies, about 3 copies of the fitted samples of the ICA channels,
+        and one copy of all the samples when the components are sorted).
+    """
+
+    itemsize = 8
+    buffer = 0 if low_memory else n_channels * n_times * itemsize
+    chunk = n_mag * (n_times // n_chunks + 1 + 2 * overlap) * itemsize
+    zapline_peak = 4 * chunk * min(n_jobs, n_chunks)
+    ica_peak = max(3 * int(n_times * ica_fraction), n_times) * n_mag * itemsize
+    return buffer + max(zapline_peak, ica_peak)
+
 
 # function that can also be accessed by importing this file
-def process_ds(ds, trigger_mapping, proc_path):
+def output_paths(ds, proc_path):
+    """
+    Output files of `process_ds` for one CTF dataset.
 
-    subject = ds.stem.split("_")[0]
-    subject_path = utils.make_directory(proc_path, f"sub-{subject}")
+    Returns
+    -------
+    outputs : dict
+        subject (sub-XXX directory name), block ("calibration" or zero-padded block number), raw and ica fif
+        paths, calibration json path.
+    """
 
-    if "01.ds" in ds.parts[-1]:
-        block_type = "calibration"
+    subject_dir, block_type = ds_subject_block(ds.parts[-1])
+    subject = subject_dir[len("sub-"):]
+    subject_path = Path(proc_path).joinpath(subject_dir)
+
+    return {
+        "subject": subject_dir,
+        "block": block_type,
+        "raw": subject_path.joinpath(f"realtime_sub-{subject}_block-{block_type}_raw.fif"),
+        "ica": subject_path.joinpath(f"realtime_sub-{subject}_block-{block_type}_ica.fif"),
+        "calibration": subject_path.joinpath(f"realtime_sub-{subject}_meg-calibration.json"),
+    }
+
+
+# function that can also be accessed by importing this file
+def process_ds(ds, trigger_mapping, proc_path, n_chunks=10, overlap=0, n_jobs=1, low_memory=False,
+               buffer_dir=None, ica_params=None, cache=False, hash_mode="mtime"):
+    """
+    Raw preprocessing of one CTF dataset: gradient compensation, low-pass, zapline, annotations and ICA.
+
+    All steps modify the data read from the dataset in place, it is never copied as a whole. With
+    `low_memory` the data is read once into a memory-mapped file (MNE's `preload=<path>`) instead of
+    anonymous memory, so only the pages being processed stay resident and several blocks can run on one node.
+    The peak RSS and its `memory_target` estimate are printed at the end.
+
+    Parameters
+    ----------
+    n_chunks, overlap, n_jobs :
+        Zapline settings, see `zapline`.
+    low_memory : bool
+        Read the data into a disk-backed buffer.
+    buffer_dir : str or pathlib.Path or None
+        Where to put the disk-backed buffer (removed at the end), system default temporary directory if None.
+    ica_params : dict or None
+        ICA fit settings overriding `ICA_PARAMS`, see `tools.fast_ica.fit_ica`. "fit_cache": true reuses a
+        seeded fit of the same data and parameters from the local cache directory, "compare": true also fits the ICA on all the data and prints
+        how well the components match.
+    cache : bool
+        Skip the dataset if its outputs were produced from the same dataset, code and parameters, see
+        `tools.stage_cache.StageCache`.
+    hash_mode : str
+        Input fingerprint of the cache, "mtime" or "content".
+    """
+
+    outputs = output_paths(ds, proc_path)
+    utils.make_directory(proc_path, outputs["subject"])
+    block_type = outputs["block"]
+    raw_output, ica_output, calib_output = outputs["raw"], outputs["ica"], outputs["calibration"]
+    ica_params = {**ICA_PARAMS, **(ica_params or {})}
+
+    if cache:
+        outputs = [calib_output] if block_type == "calibration" else [raw_output, ica_output]
+        params = {
+            "trigger_mapping": trigger_mapping, "n_chunks": n_chunks, "overlap": overlap,
+            "compensation": 3, "filter": [None, 125], "zapline": ZAPLINE_PARAMS,
+            "ica_filter": [1, 40], "ica": {i: ica_params[i] for i in ica_params if i not in ("compare", "fit_cache")}
+        }
+        # the settings.json keys that change the outputs are in the parameters, not the worker or memory settings
+        stage_cache = StageCache(
+            "raw_preproc", [ds, Path(__file__)] + code_files(utils, fit_ica), params, outputs,
+            hash_mode=hash_mode
+        )
+        if stage_cache.is_current():
+            print(ds.name, "up to date, skipped")
+            return
+
+    if low_memory:
+        buffer_dir = tempfile.mkdtemp(dir=buffer_dir)
+        preload = str(Path(buffer_dir).joinpath("raw.dat"))
     else:
-        block = int(ds.parts[-1].split("_")[-1].split(".")[0]) - 2
-        block_type = str(block).zfill(3)
-    filename = f"realtime_sub-{subject}_block-{block_type}_raw.fif"
-    raw_output = subject_path.joinpath(filename)
-    filename = f"realtime_sub-{subject}_block-{block_type}_ica.fif"
-    ica_output = subject_path.joinpath(filename)
-    
-    raw = read_raw_ctf(ds, preload=True, clean_names=True, verbose=False)
+        preload = True
+
+    try:
+        raw = read_raw_ctf(ds, preload=preload, clean_names=True, verbose=False)
+        _process_raw(
+            raw, ds, trigger_mapping, raw_output, ica_output, calib_output,
+            n_chunks=n_chunks, overlap=overlap, n_jobs=n_jobs, low_memory=low_memory, ica_params=ica_params
+        )
+    finally:
+        if low_memory:
+            shutil.rmtree(buffer_dir, ignore_errors=True)
+
+    if cache:
+        stage_cache.record()
+
+
+def _process_raw(raw, ds, trigger_mapping, raw_output, ica_output, calib_output, n_chunks=10, overlap=0, n_jobs=1,
+                 low_memory=False, ica_params=ICA_PARAMS):
 
     if "01.ds" in ds.parts[-1]:
         gripper_channels = ["UADC009", "UADC010"]
@@ -56,8 +264,6 @@ def process_ds(ds, trigger_mapping, proc_path):
         for ch_name in ["UADC009", "UADC010"]:
             data = raw[ch_name][0]
             meg_calibration[ch_name] = [np.median(data).astype(float), np.max(data).astype(float)]
-        filename = f"realtime_sub-{subject}_meg-calibration.json"
-        calib_output = subject_path.joinpath(filename)
         utils.save_dict_as_json(calib_output, meg_calibration)
 
     else:
@@ -73,54 +279,76 @@ def process_ds(ds, trigger_mapping, proc_path):
         raw = raw.set_channel_types(set_ch)
         events = find_events(raw, "UDIO001")
 
-        # zapline
-
-        raw_data = raw.get_data()
-        raw_info = raw.info
-        first_samp = raw.first_samp
+        # zapline, in place on the preloaded data
         mag_ix = np.array([i for i, lab in enumerate(raw.get_channel_types()) if lab == "mag"])
+        zapline(
+            raw._data, mag_ix, raw.info["sfreq"],
+            n_chunks=n_chunks, overlap=overlap, n_jobs=n_jobs, label=ds.name
+        )
 
-        rd = np.array_split(raw_data[mag_ix], 10, axis=1)
-        rd = [np.moveaxis(i, [0,1], [1,0]) for i in rd]
-        rd_f = []
+        afe = annotations_from_events(events, raw.info["sfreq"], trigger_mapping, raw.first_samp)
 
-        for ix, ss in enumerate(rd):
-            print(ds.name, f"{ix+1}/10")
-            data, iters = dss_line_iter(
-                ss, fline=50.0, sfreq=raw_info["sfreq"], 
-                spot_sz=5.5, win_sz=10, nfft=1024, n_iter_max=30
+        raw = raw.set_annotations(afe)
+    
+        raw.save(raw_output, fmt="single", overwrite=True, verbose=False)
+    
+        raw = raw.filter(1, 40)
+        ica_params = dict(ica_params)
+        fit_cache = derived_cache_path(ica_output, "_fit_ica.fif") if ica_params.pop("fit_cache") else None
+        ica, report = fit_ica(raw, fit_cache=fit_cache, **ica_params)
+        ica.save(ica_output, overwrite=True, verbose=False)
+        to_print = (
+            f"ICA fit: {report['fit_time']:.1f} s, {report['n_samples']} samples, "
+            f"{ica_params['method']}, {'cached' if report['fit_cached'] else 'fitted'}"
+        )
+        if "match" in report:
+            to_print += (
+                f", full fit: {report['full_fit_time']:.1f} s, {report['full_n_samples']} samples, "
+                f"component match |r| mean: {np.mean(report['match']):.3f} min: {np.min(report['match']):.3f}"
             )
-            rd_f.append(data)
-        del rd
-        rd_f = [np.moveaxis(i, [0,1], [1,0]) for i in rd_f]
-        rd_f = np.hstack(rd_f)
-
-        new_raw_data = copy(raw_data)
-        del raw_data
-        new_raw_data[mag_ix, :] = rd_f
-
-        new_raw = RawArray(
-            new_raw_data,
-            raw_info,
-            first_samp=first_samp
+        print(ds.name, to_print)
+
+        target = memory_target(
+            raw.n_times, len(raw.ch_names), len(mag_ix),
+            n_chunks=n_chunks, overlap=overlap, n_jobs=n_jobs, low_memory=low_memory,
+            ica_fraction=1 / (ica_params["decim"] * ica_params["segment_step"])
+        )
+        own, children = utils.peak_rss()
+        # the resident pages of the disk-backed buffer count in the RSS but can be reclaimed
+        print(
+            ds.name, f"peak RSS: {own / 2**20:.0f} MB, zapline workers: {children / 2**20:.0f} MB,",
+            f"target: {target / 2**20:.0f} MB"
         )
 
-        del raw
 
-        # zapline
-        afe = annotations_from_events(events, new_raw.info["sfreq"], trigger_mapping, new_raw.first_samp)
 
-        new_raw = new_raw.set_annotations(afe)
-    
-        new_raw.save(raw_output, fmt="single", overwrite=True, verbose=False)
-    
-        new_raw = new_raw.filter(1, 40)
-        ica = ICA(n_components=20)
-        ica.fit(new_raw)
-        ica.save(ica_output, overwrite=True, verbose=False)
+# function that can also be accessed by importing this file
+def process_ds_settings():
+    """Keyword arguments of `process_ds` from the settings.json options, shared by all the entry points."""
 
+    # optional zapline settings: worker processes, chunks and chunk overlap in samples
+    zapline_settings = settings.get("zapline", {})
+    # optional memory-bounded mode: {"low_memory": true, "buffer_dir": "/scratch"}
+    memory_settings = settings.get("preprocessing", {})
+    return dict(
+        n_chunks=zapline_settings.get("n_chunks", 10),
+        overlap=zapline_settings.get("overlap", 0),
+        n_jobs=zapline_settings.get("n_jobs", 1),
+        low_memory=memory_settings.get("low_memory", False),
+        buffer_dir=memory_settings.get("buffer_dir", None),
+        # optional ICA fit settings, e.g. {"method": "picard", "decim": 4, "segment_step": 2, "random_state": 42, "fit_cache": true}
+        ica_params=settings.get("ica", {}),
+        cache=settings.get("stage_cache", False),
+        hash_mode=settings.get("stage_cache_hash", "mtime")
+    )
 
 
+# function that can also be accessed by importing this file
+def run_index(index):
+    """Preprocessing of the index-th dataset of `all_files` with the settings.json options."""
+
+    process_ds(all_files[index], trigger_mapping, proc_path, **process_ds_settings())
+
 
 if __name__ == '__main__':
     try:
@@ -128,15 +356,13 @@ if __name__ == '__main__':
     except:
         raise IndexError("no file index")
     
-    ds = all_files[index]
-    
     start_time = time.time()
 
     status = "START"
     to_print = f"{status} File:{str(index+1).zfill(3)}/{len(all_files)}"
     print(to_print)
     
-    process_ds(ds, trigger_mapping, proc_path)
+    run_index(index)
 
     status = "END"
     time_elapsed =  np.round((time.time() - start_time)/60, 2)
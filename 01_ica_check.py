@@ -1,5 +1,6 @@
 import sys
 import utils
+from tools.catalogue import DatasetCatalogue
 from pathlib import Path
 from mne import set_log_level
 from mne.io import (
@@ -19,13 +20,13 @@ raw_path = dataset_path.joinpath("MEG", "raw")
 proc_path = dataset_path.joinpath("MEG", "processed")
 beh_path = dataset_path.joinpath("BEH")
 
-# specific file search and selection
-all_fif_files = utils.get_files(proc_path, "*.fif", strings=["realtime", "raw.fif"], depth="all")
-all_fif_files = [i for i in all_fif_files if "calibration" not in i.stem]
-all_ica_files = utils.get_files(proc_path, "*.fif", strings=["realtime", "ica.fif"], depth="all")
-all_fif_files.sort()
-all_ica_files.sort()
-all_files = list(zip(all_fif_files, all_ica_files))
+# specific file search and selection, raw and ICA files paired by subject and block
+catalogue = DatasetCatalogue(dataset_path, settings.get("catalogue_path"))
+catalogue.refresh()
+all_files = [
+    (fif_path, ica_path) for fif_path, ica_path in catalogue.pairs("preproc", "ica", strings=["realtime"], under=proc_path)
+    if "calibration" not in fif_path.stem
+]
 
 
 # function that can also be accessed by importing this file
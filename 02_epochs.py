@@ -1,17 +1,25 @@
 import sys
 import time
 import utils
+from tools.catalogue import DatasetCatalogue
+from tools.stage_cache import StageCache, code_files
 import numpy as np
 from pathlib import Path
 from mne import (
     set_log_level,
     events_from_annotations,
-    Epochs
+    pick_info,
+    Epochs,
+    EpochsArray
 )
+from mne.filter import filter_data
+from scipy.fft import next_fast_len
+from scipy.signal import hilbert
 from mne.io import (
     read_raw_fif
 )
 from mne.preprocessing import read_ica
+from tools.ica_projection import load_ica_projection, apply_ica_projection, check_ica_projection
 
 # TO DO:
 #  - integrate head motion regression
@@ -29,13 +37,13 @@ raw_path = dataset_path.joinpath("MEG", "raw")
 proc_path = dataset_path.joinpath("MEG", "processed")
 beh_path = dataset_path.joinpath("BEH")
 
-# specific file search and selection
-all_fif_files = utils.get_files(proc_path, "*.fif", strings=["realtime", "raw.fif"], depth="all")
-all_fif_files = [i for i in all_fif_files if "calibration" not in i.stem]
-all_ica_files = utils.get_files(proc_path, "*.fif", strings=["realtime", "ica.fif"], depth="all")
-all_fif_files.sort()
-all_ica_files.sort()
-all_files = list(zip(all_fif_files, all_ica_files))
+# specific file search and selection, raw and ICA files paired by subject and block
+catalogue = DatasetCatalogue(dataset_path, settings.get("catalogue_path"))
+catalogue.refresh()
+all_files = [
+    (fif_path, ica_path) for fif_path, ica_path in catalogue.pairs("preproc", "ica", strings=["realtime"], under=proc_path)
+    if "calibration" not in fif_path.stem
+]
 
 epochs_options = {
     "whole_trial": ["dots_onset", -1.5, 4.1, 0],
@@ -44,53 +52,276 @@ epochs_options = {
     "response": ["response_onset", -0.25, 3.5, -20],
 }
 
+# seconds of data around each epoch for the windowed Hilbert envelope
+HILBERT_PAD = 2.0
+
+# epochs_maker variants made for each raw/ICA pair by the main block and the pipeline runner
+epochs_variants = [
+    dict(
+        epoch_settings=epochs_options["extra_trial"], filter=(None, None), filter_name="long-epoch",
+        decim=1, limited_channels=True, hilbert=True
+    ),
+    # dict(
+    #     epoch_settings=epochs_options["extra_trial"], filter=(13, 30), filter_name="13-30-hilbert-env-decim-1",
+    #     decim=1, limited_channels=True, hilbert=True, hilbert_pad=HILBERT_PAD
+    # ),
+]
+
+def _epochs_path(fif_path, epoch_settings, filter=(None, None), filter_name=None):
+    trial_type = epoch_settings[0]
+    fil_name = "nf"
+    if tuple(filter) != (None, None):
+        fil_name = f"{filter[0]}-{filter[1]}"
+    trial_label = trial_type.replace("_", "-")
+    if filter_name != None:
+        fil_name = filter_name
+    filename = "_".join([trial_label] + [fil_name] + (fif_path.stem.split("_")[:-1]) + ["epo.fif"])
+    return Path(fif_path.parent).joinpath(filename)
+
+
+def _epoch_picks(raw, limited_channels=True):
+    # channel selection at epoching, the continuous data is shared with the other variants
+    if not limited_channels:
+        return None
+    mags = [ix for ix, ch_t in enumerate(raw.get_channel_types()) if ch_t == "mag"]
+    grippers = [ix for ix, ch_n in enumerate(raw.ch_names) if utils.check_many(["UADC009", "UADC010"], ch_n, func="any")]
+    channels = mags + grippers
+    channels.sort()
+    return [raw.ch_names[i] for i in channels]
+
+
+def _epoch_events(raw, epoch_settings, trigger_mapping):
+    trial_type, tmin, tmax, modifier = epoch_settings
+    events_selection = {trigger_mapping[i]: i + modifier for i in trigger_mapping.keys() if trial_type in trigger_mapping[i]}
+    return events_from_annotations(raw, event_id=events_selection)
+
+
+def _save_epochs(raw, epoch_path, epoch_settings, trigger_mapping, decim=1, limited_channels=True):
+    trial_type, tmin, tmax, modifier = epoch_settings
+
+    events, event_ids = _epoch_events(raw, epoch_settings, trigger_mapping)
+
+    epochs = Epochs(
+        raw, events, event_ids, tmin, tmax, decim=decim, baseline=None, picks=_epoch_picks(raw, limited_channels)
+    )
+
+    epochs.save(epoch_path, fmt="single", overwrite=True)
+
+
+def windowed_envelope_epochs(raw, band, epoch_settings, trigger_mapping, decim=1, limited_channels=True, pad=HILBERT_PAD,
+                             n_batch=16):
+    """
+    Band-limited Hilbert envelope epochs computed on padded windows around the events only, instead of filtering
+    and Hilbert transforming the whole continuous recording. Windows of n_batch events are filtered and
+    transformed at once, the envelope is cut to the epoch and decimated. Same layout as Epochs(decim=decim) on
+    `raw.filter(*band, picks="mag").apply_hilbert(picks="mag", envelope=True)`, only the magnetometers are
+    filtered. Epochs outside the recording or overlapping bad annotations are dropped, as by Epochs.
+
+    Parameters
+    ----------
+
+    raw: mne.io.Raw
+        preloaded continuous data, not modified
+
+    band: tuple
+        l_freq, h_freq of the filter
+
+    pad: float
+        seconds added on both sides of each epoch, absorbs the filter and Hilbert edge effects (about 0.3% of
+        the envelope at 2 s for a 13-30 Hz band)
+
+    n_batch: int
+        number of events transformed at once, bounds the memory
+
+    """
+
+    trial_type, tmin, tmax, modifier = epoch_settings
+    sfreq = raw.info["sfreq"]
+    events, event_ids = _epoch_events(raw, epoch_settings, trigger_mapping)
+
+    picks = _epoch_picks(raw, limited_channels)
+    pick_ix = np.arange(len(raw.ch_names)) if picks is None else np.array([raw.ch_names.index(i) for i in picks])
+    mag_rows = np.array([ix for ix, ch_ix in enumerate(pick_ix) if raw.get_channel_types()[ch_ix] == "mag"])
+
+    # epoch samples as in Epochs, then the samples kept by the decimation (time 0 is kept)
+    first, last = int(round(tmin * sfreq)), int(round(tmax * sfreq))
+    i_start = -first % decim
+    n_out = len(range(i_start, last - first + 1, decim))
+    pad = int(round(pad * sfreq))
+
+    onsets = events[:, 0] - raw.first_samp + first
+    bad_ix = [ix for ix, desc in enumerate(raw.annotations.description) if desc.lower().startswith(("bad", "edge"))]
+    annotations = raw.annotations[bad_ix] if len(bad_ix) else []
+    bad = [
+        tuple(raw.time_as_index([onset, onset + duration], use_rounding=True, origin=annotations.orig_time))
+        for onset, duration in zip(annotations.onset, annotations.duration)
+    ] if len(annotations) else []
+    keep = [
+        ix for ix, onset in enumerate(onsets)
+        if onset >= 0 and onset + last - first < raw.n_times and
+        not any(start <= onset + last - first and onset <= stop for start, stop in bad)
+    ]
+    events, onsets = events[keep], onsets[keep]
+
+    data = np.zeros((len(events), len(pick_ix), n_out))
+    for batch in range(0, len(events), n_batch):
+        batch_onsets = onsets[batch:batch + n_batch]
+        # windows clipped to the recording, the edges are reflected by filter_data
+        starts = np.maximum(batch_onsets - pad, 0)
+        stops = np.minimum(batch_onsets + last - first + 1 + pad, raw.n_times)
+        for length in np.unique(stops - starts):
+            same = np.where(stops - starts == length)[0]
+            windows = np.stack([raw.get_data(picks=pick_ix, start=starts[i], stop=stops[i]) for i in same])
+            if len(mag_rows):
+                mags = filter_data(np.ascontiguousarray(windows[:, mag_rows]), sfreq, *band, copy=False)
+                windows[:, mag_rows] = np.abs(hilbert(mags, N=next_fast_len(length), axis=-1)[..., :length])
+            for ix, window in zip(same, windows):
+                offset = batch_onsets[ix] - starts[ix]
+                data[batch + ix] = window[:, offset + i_start:offset + last - first + 1:decim]
+
+    info = pick_info(raw.info, pick_ix)
+    with info._unlock():
+        info["sfreq"] = sfreq / decim
+    return EpochsArray(data, info, events, tmin=(first + i_start) / sfreq, event_id=event_ids, baseline=None)
+
+
+# function that can also be accessed by importing this file
+def epochs_maker_variants(fif_path, ica_path, variants, trigger_mapping, cache=False, hash_mode="mtime"):
+    """
+    Several epoch variants of one raw/ICA pair, the raw file is read and cleaned with the ICA once and the
+    filtered / Hilbert envelope data is computed once per band and shared by the variants using it.
+
+    Parameters
+    ----------
+
+    variants: list
+        dictionaries of epochs_maker arguments: epoch_settings, filter, filter_name, decim, limited_channels,
+        hilbert, hilbert_pad, see `epochs_variants`
+
+    cache: bool
+        skip the variants produced from the same raw, ICA, script and parameters
+
+    hash_mode: str
+        input fingerprint of the cache, "mtime" or "content"
+
+    """
+
+    # variants to make, grouped by band then envelope, windowed envelopes apart
+    bands = {}
+    windowed = []
+    for variant in variants:
+        defaults = dict(filter=(None, None), filter_name=None, decim=1, limited_channels=True, hilbert=False, hilbert_pad=None)
+        variant = dict(defaults, **variant)
+        band = tuple(variant["filter"])
+        epoch_path = _epochs_path(fif_path, variant["epoch_settings"], band, variant["filter_name"])
+
+        stage_cache = None
+        if cache:
+            params = {
+                "epoch_settings": variant["epoch_settings"], "trigger_mapping": trigger_mapping, "filter": band,
+                "decim": variant["decim"], "limited_channels": variant["limited_channels"], "hilbert": variant["hilbert"]
+            }
+            if variant["hilbert_pad"] is not None:
+                params["hilbert_pad"] = variant["hilbert_pad"]
+            # the settings.json keys that change the epochs are in the parameters
+            stage_cache = StageCache(
+                "epochs", [fif_path, ica_path, Path(__file__)] + code_files(utils, load_ica_projection), params,
+                [epoch_path], hash_mode=hash_mode
+            )
+            if stage_cache.is_current():
+                print(epoch_path.name, "up to date, skipped")
+                continue
+
+        # the envelope is only computed on filtered data
+        envelope = variant["hilbert"] and band != (None, None)
+        if envelope and variant["hilbert_pad"] is not None:
+            windowed.append((variant, epoch_path, stage_cache))
+            continue
+        bands.setdefault(band, {}).setdefault(envelope, []).append((variant, epoch_path, stage_cache))
+
+    if not len(bands) and not len(windowed):
+        return
+
+    raw = read_raw_fif(fif_path, preload=True)
+    # ICA reconstruction as a projection matrix cached per ICA file and exclusions, applied in float32 blocks,
+    # checked against ICA.apply on the first seconds
+    projection = load_ica_projection(ica_path)
+    check_ica_projection(raw, read_ica(ica_path, verbose=False), projection)
+    raw = apply_ica_projection(raw, projection)
+
+    # envelopes around the events only, from the unfiltered data
+    for variant, epoch_path, stage_cache in windowed:
+        epochs = windowed_envelope_epochs(
+            raw, tuple(variant["filter"]), variant["epoch_settings"], trigger_mapping, decim=variant["decim"],
+            limited_channels=variant["limited_channels"], pad=variant["hilbert_pad"]
+        )
+        epochs.save(epoch_path, fmt="single", overwrite=True)
+        if stage_cache is not None:
+            stage_cache.record()
+
+    # unfiltered variants first, the last band is filtered in place
+    band_order = sorted(bands, key=lambda band: band != (None, None))
+    for ix, band in enumerate(band_order):
+        if band == (None, None):
+            band_raw = raw
+        elif ix == len(band_order) - 1:
+            band_raw = raw.filter(*band, picks="mag")
+        else:
+            band_raw = raw.copy().filter(*band, picks="mag")
+
+        for envelope in sorted(bands[band]):
+            if envelope:
+                # after the variants of the filtered data, the band is not used any more
+                band_raw = band_raw.apply_hilbert(picks="mag", envelope=True)
+            for variant, epoch_path, stage_cache in bands[band][envelope]:
+                _save_epochs(
+                    band_raw, epoch_path, variant["epoch_settings"], trigger_mapping, decim=variant["decim"],
+                    limited_channels=variant["limited_channels"]
+                )
+                if stage_cache is not None:
+                    stage_cache.record()
+        del band_raw
+
+
 # function that can also be accessed by importing this file
-def epochs_maker(fif_path, ica_path, epoch_settings, trigger_mapping, filter=(None, None), filter_name=None, decim=1, limited_channels=True, hilbert=False):
+def epochs_maker(fif_path, ica_path, epoch_settings, trigger_mapping, filter=(None, None), filter_name=None, decim=1, limited_channels=True, hilbert=False, hilbert_pad=None, cache=False, hash_mode="mtime"):
     """
     Parameters
     ----------
 
     epoch setting: list
         contains string to select annotated triggers, tmin, tmax
+
+    hilbert_pad: float or None
+        with a filter and hilbert, compute the envelope on windows around the events padded by this many
+        seconds (e.g. HILBERT_PAD) instead of the whole recording, see `windowed_envelope_epochs`
+
+    cache: bool
+        skip if the epochs were produced from the same raw, ICA, script and parameters
+    
+    hash_mode: str
+        input fingerprint of the cache, "mtime" or "content"
     
     """
 
-    raw = read_raw_fif(fif_path, preload=True)
-    ica = read_ica(ica_path)
-    raw = ica.apply(raw)
+    variant = dict(
+        epoch_settings=epoch_settings, filter=filter, filter_name=filter_name, decim=decim,
+        limited_channels=limited_channels, hilbert=hilbert, hilbert_pad=hilbert_pad
+    )
+    epochs_maker_variants(fif_path, ica_path, [variant], trigger_mapping, cache=cache, hash_mode=hash_mode)
 
-    fil_name = "nf"
-    if filter != (None, None):
-        fil_name = f"{filter[0]}-{filter[1]}"
-        raw = raw.filter(*filter, picks="mag")
-        if hilbert:
-            raw = raw.apply_hilbert(picks="mag", envelope=True)
-
-    if limited_channels:
-        mags = [ix for ix, ch_t in enumerate(raw.get_channel_types()) if ch_t == "mag"]
-        grippers = [ix for ix, ch_n in enumerate(raw.ch_names) if utils.check_many(["UADC009", "UADC010"], ch_n, func="any")]
-        channels = mags + grippers
-        channels.sort()
-        channels = [raw.ch_names[i] for i in channels]
-        raw = raw.pick(channels)
-    
-    trial_type, tmin, tmax, modifier = epoch_settings
 
-    events_selection = {trigger_mapping[i]: i + modifier for i in trigger_mapping.keys() if trial_type in trigger_mapping[i]}
+# function that can also be accessed by importing this file
+def run_index(index):
+    """All `epochs_variants` of the index-th raw/ICA pair of `all_files`, in one pass."""
 
-    events, event_ids = events_from_annotations(raw, event_id=events_selection)
+    fif_path, ica_path = all_files[index]
 
-    epochs = Epochs(
-        raw, events, event_ids, tmin, tmax, decim=decim, baseline=None
+    epochs_maker_variants(
+        fif_path, ica_path, epochs_variants, trigger_mapping,
+        cache=settings.get("stage_cache", False), hash_mode=settings.get("stage_cache_hash", "mtime")
     )
 
-    trial_label = trial_type.replace("_", "-")
-    if filter_name != None:
-        fil_name = filter_name
-    filename = "_".join([trial_label] + [fil_name] + (fif_path.stem.split("_")[:-1]) + ["epo.fif"])
-    epoch_path = Path(fif_path.parent).joinpath(filename)
-    epochs.save(epoch_path, fmt="single", overwrite=True)
-
 
 if __name__ == '__main__':
     try:
@@ -104,19 +335,7 @@ if __name__ == '__main__':
     to_print = f"{status} File:{str(index+1).zfill(3)}/{len(all_files)}"
     print(to_print)
 
-    fif_path, ica_path = all_files[index]
-    
-    epochs_maker(
-        fif_path, ica_path, epochs_options["extra_trial"], trigger_mapping,
-        filter=(None, None), filter_name="long-epoch", decim=1, limited_channels=True, hilbert=True
-    )
-
-    # epochs_maker(
-    #     fif_path, ica_path, epochs_options["extra_trial"], trigger_mapping,
-    #     filter=(13, 30), filter_name="13-30-hilbert-env-decim-1", decim=1, limited_channels=True, hilbert=True
-    # )
-
-
+    run_index(index)
 
     status = "END"
     time_elapsed =  np.round((time.time() - start_time)/60, 2)
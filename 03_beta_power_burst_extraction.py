@@ -1,17 +1,19 @@
 import sys
 import time
 import utils
+import burst_pipeline
+from tools.burst_store import BurstFeatureWriter, WaveformSink
+from tools.stage_cache import StageCache, code_files
+from tools.catalogue import DatasetCatalogue
+from tools.lazy_epochs import SubjectEpochs
+from tools.burst_detection import extract_bursts
+from tools.superlet import superlet_batch, clear_filter_banks
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from specparam import SpectralModel
-from tools.burst_detection import extract_bursts
 from pathlib import Path
-from mne import (
-    set_log_level,
-    read_epochs,
-    concatenate_epochs
-)
+from mne import set_log_level
+from mne.io import read_info
 
 set_log_level("ERROR")
 
@@ -25,101 +27,136 @@ raw_path = dataset_path.joinpath("MEG", "raw")
 proc_path = dataset_path.joinpath("MEG", "processed")
 beh_path = dataset_path.joinpath("BEH")
 
-# load basic data
-subjects = utils.get_directories(proc_path, strings=["sub-"], depth="one")
-subjects = [i.stem for i in subjects]
-
-
-if __name__ == '__main__':
-    try:
-        index = int(sys.argv[1])
-    except:
-        raise IndexError("no subject index")
-    
-    start_time = time.time()
-
-    status = "START"
-    to_print = f"{status} File:{str(index+1).zfill(3)}/{len(subjects)}"
-    print(to_print)
-
-    # load basic data
-    subjects = utils.get_directories(proc_path, strings=["sub-"], depth="one")
-    subjects = [i.stem for i in subjects]
-
-    subject = subjects[index]
-
-    beh_files = utils.get_files(beh_path, "*.csv", strings=["main_", subject])
-    fif_files = utils.get_files(proc_path, "*.fif", strings=["dots-onset", "realtime", "_long-epoch_", subject, "epo.fif"])
-    behaviour = pd.concat([pd.read_csv(i) for i in beh_files]).reset_index(drop=True)
-    epochs = concatenate_epochs([read_epochs(i, verbose=False).apply_baseline((-0.25, 0.0)) for i in fif_files], add_offset=True, on_mismatch="ignore", verbose=False)
-    overlap = np.mean(epochs.events[:,2] == behaviour.trial_trigger.to_numpy()) * 100
-    print(f"epoch order overlaps in {overlap}%")
+# load basic data, from the incrementally refreshed dataset catalogue
+catalogue = DatasetCatalogue(dataset_path, settings.get("catalogue_path"))
+catalogue.refresh()
+subjects = [i.stem for i in catalogue.query(strings=["sub-"], parent=proc_path, is_dir=True, order_by="path")]
+
+
+# function that can also be accessed by importing this file
+def burst_extraction(subject, n_jobs=1, chunk_size=None, cache=False, hash_mode="mtime"):
+    """
+    Beta burst extraction of one subject, from its long epochs of all blocks.
+
+    Parameters
+    ----------
+    subject : str
+        Subject directory name, e.g. "sub-001".
+    n_jobs : int
+        Number of worker processes, see `burst_pipeline.iter_channels_bursts`.
+    chunk_size : int or None
+        Trials per task, see `burst_pipeline.iter_channels_bursts`.
+    cache : bool
+        Skip if the outputs were produced from the same epochs and parameters, see `tools.stage_cache.StageCache`.
+    hash_mode : str
+        Input fingerprint of the cache, "mtime" or "content".
+    """
+
+    # epochs may have been written since the import
+    catalogue.refresh()
+    beh_files = catalogue.query(strings=["main_", subject], under=beh_path, suffix=".csv", is_dir=False)
+    fif_files = catalogue.query(
+        strings=["dots-onset", "realtime", "_long-epoch_", subject, "epo.fif"], under=proc_path, suffix=".fif",
+        is_dir=False
+    )
+    info = read_info(fif_files[0], verbose=False)
+    ch_names = info.ch_names
 
     # select sensors
     sens = ["C1", "C25", "C32", "C42", "C54", "C55", "C63"]
-    CL = [i for i in epochs.ch_names if utils.many_is_in(["MLC"], i)]
+    CL = [i for i in ch_names if utils.many_is_in(["MLC"], i)]
     CL = [i for i in CL if not utils.many_is_in(sens, i)]
-    CR = [i for i in epochs.ch_names if utils.many_is_in(["MRC"], i)]
+    CR = [i for i in ch_names if utils.many_is_in(["MRC"], i)]
     CR = [i for i in CR if not utils.many_is_in(sens, i)]
     chan_f = [31, 32, 33, 34, 41, 42, 43, 44, 51, 52, 53, 54]
     sens_F = [f"LF{i}" for i in chan_f]
-    FL = [i for i in epochs.ch_names if utils.many_is_in(sens_F, i)]
+    FL = [i for i in ch_names if utils.many_is_in(sens_F, i)]
     sens_F = [f"RF{i}" for i in chan_f]
-    FR = [i for i in epochs.ch_names if utils.many_is_in(sens_F, i)]
+    FR = [i for i in ch_names if utils.many_is_in(sens_F, i)]
 
     channels_used = CR + CL + FL + FR
     channels_used.sort()
 
-    dict_list = []
-    wfvm_list = []
-
     # output paths
     epoch_type, filter, experiment, subject, block, ftype = fif_files[0].stem.split("_")
     filename = "_".join(["burst-waveforms", epoch_type, experiment, subject + ".npy"])
     waveform_path = fif_files[0].parent.joinpath(filename)
-    filename = "_".join(["burst-features", epoch_type, experiment, subject + ".npy"])
+    filename = "_".join(["burst-features", epoch_type, experiment, subject + ".parquet"])
     features_path = fif_files[0].parent.joinpath(filename)
 
-    # channel iteration
-    for ix, channel in enumerate(channels_used):
-        data = epochs.get_data(picks=channels_used[0])[:3,0,:]
-        tf_trials = np.array([utils.superlet_tf(i, epochs.info["sfreq"]) for i in data])
-
-        freqs = np.linspace(1, 120, num=tf_trials.shape[1])
-        search_range = np.where((freqs >= 10) & (freqs <= 33))[0]
-        beta_lims = [13, 30]
-
-        pds_mean_trials = np.mean(tf_trials, axis=(2, 0))
+    freqs = utils.superlet_foi(info["sfreq"])
+    search_range = np.where((freqs >= 10) & (freqs <= 33))[0]
+    beta_lims = [13, 30]
+
+    # skip if the outputs were produced from the same epochs and parameters, before loading anything. No
+    # settings.json key changes the bursts, the dataset path is in the epochs paths
+    stage_cache = StageCache(
+        "bursts", fif_files + [Path(__file__)] + code_files(
+            utils, burst_pipeline, extract_bursts, superlet_batch, SubjectEpochs, BurstFeatureWriter
+        ),
+        {"channels": channels_used, "baseline": [-0.25, 0.0], "search_freqs": freqs[search_range], "band_lims": beta_lims},
+        [features_path, waveform_path], hash_mode=hash_mode
+    )
+    if cache and stage_cache.is_current():
+        print(f"{subject} up to date, skipped")
+        return
+
+    # selected channels of all the blocks, memory-mapped, baseline subtracted when read
+    epochs = SubjectEpochs(fif_files, channels_used, baseline=(-0.25, 0.0))
+    behaviour = pd.concat([pd.read_csv(i) for i in beh_files]).reset_index(drop=True)
+    overlap = np.mean(epochs.events[:,2] == behaviour.trial_trigger.to_numpy()) * 100
+    print(f"epoch order overlaps in {overlap}%")
 
-        sm = SpectralModel(peak_width_limits=(1.65, 12))
+    # channels x trials x times, one channel loaded at a time
+    data = epochs.channel_major()
 
-        sm.fit(freqs, pds_mean_trials, freq_range=[1,120])
+    # channel iteration, features appended per channel, waveforms streamed to disk as they are found
+    with BurstFeatureWriter(features_path) as features_writer, WaveformSink(waveform_path) as waveform_sink:
+        bursts_iter = burst_pipeline.iter_channels_bursts(
+            data, epochs.sfreq, epochs.times, freqs, search_range, freqs[search_range], beta_lims,
+            n_jobs=n_jobs, chunk_size=chunk_size, waveform_sink=waveform_sink
+        )
+        for ix, (channel, bursts) in enumerate(zip(channels_used, bursts_iter)):
+            features_writer.append(bursts, channel, subject)
+            print(f"{subject} channel: {ix+1}/{len(channels_used)}")
+    stage_cache.record()
+    # the wavelet spectra of this subject's epoch length are not needed by the next one
+    clear_filter_banks()
 
-        aperiodic_spectrum = 10**(sm._ap_fit)[search_range].reshape(-1,1)
 
-        tf_trials = tf_trials[:,search_range,:]
+# function that can also be accessed by importing this file
+def run_index(index, n_jobs=1, chunk_size=None):
+    """Burst extraction of the index-th subject of `subjects` with the settings.json options."""
 
-        bursts = extract_bursts(data, tf_trials, epochs.times, search_range, beta_lims, aperiodic_spectrum, epochs.info["sfreq"])
+    burst_extraction(
+        subjects[index], n_jobs=n_jobs, chunk_size=chunk_size,
+        cache=settings.get("stage_cache", False), hash_mode=settings.get("stage_cache_hash", "mtime")
+    )
 
-        output_dict = {}
 
-        for key in bursts.keys():
-            if key == "waveform_times":
-                continue
-            elif key != "waveform":
-                output_dict[key] = bursts[key].tolist()
+if __name__ == '__main__':
+    try:
+        index = int(sys.argv[1])
+    except:
+        raise IndexError("no subject index")
 
-        output_dict["channel"] = np.repeat(channel, bursts["trial"].shape).tolist()
-        output_dict["subject"] = np.repeat(subject, bursts["trial"].shape).tolist()
-        dict_list.append(output_dict)
-        wfvm_list.append(bursts["waveform"])
-        print(f"{subject} channel: {ix+1}/{len(channels_used)}")
+    # optional process pool: number of workers and trials per task
+    try:
+        n_jobs = int(sys.argv[2])
+    except:
+        n_jobs = 1
+    try:
+        chunk_size = int(sys.argv[3])
+    except:
+        chunk_size = None
+    
+    start_time = time.time()
 
-    output_dict = pd.concat([pd.DataFrame.from_dict(i) for i in dict_list])
-    waveforms = np.vstack(wfvm_list)
+    status = "START"
+    to_print = f"{status} File:{str(index+1).zfill(3)}/{len(subjects)}"
+    print(to_print)
 
-    output_dict.to_csv(features_path, index=False)
-    np.save(waveform_path, waveforms)
+    run_index(index, n_jobs=n_jobs, chunk_size=chunk_size)
 
     status = "END"
     time_elapsed =  np.round((time.time() - start_time)/60, 2)
@@ -0,0 +1,108 @@
+import sys
+import time
+import utils
+import importlib
+import numpy as np
+from pipeline_runner import Task, run_graph
+
+# stage scripts, imported as modules
+raw_preproc = importlib.import_module("00_raw_preproc")
+epochs_stage = importlib.import_module("02_epochs")
+
+settings = utils.load_json("settings.json")
+pipeline_settings = settings.get("pipeline", {})
+cache = settings.get("stage_cache", False)
+hash_mode = settings.get("stage_cache_hash", "mtime")
+
+
+def build_graph(datasets, proc_path):
+    """
+    Tasks of the 00 -> 02 -> 03 pipeline: raw preprocessing per CTF dataset, all the epoch variants of a block
+    once its raw and ICA files exist, bursts per subject once all its blocks are epoched. The manual ICA check
+    (01) is not part of the graph, the epochs use the ICA files as they are.
+
+    Parameters
+    ----------
+    datasets : list
+        CTF .ds paths, e.g. a selection of `00_raw_preproc.all_files`.
+    proc_path : pathlib.Path
+        Processed data directory.
+
+    Returns
+    -------
+    tasks : list
+        `pipeline_runner.Task` list.
+    """
+
+    tasks = []
+    subject_epochs = {}
+    for ds in datasets:
+        outputs = raw_preproc.output_paths(ds, proc_path)
+        subject, block = outputs["subject"], outputs["block"]
+        preproc_name = f"preproc/{subject}/block-{block}"
+        tasks.append(Task(
+            preproc_name, "00_raw_preproc", "process_ds",
+            args=(ds, raw_preproc.trigger_mapping, proc_path),
+            # same options as 00_raw_preproc.run_index, so both share the stage cache
+            kwargs=raw_preproc.process_ds_settings()
+        ))
+        subject_epochs.setdefault(subject, [])
+        if block == "calibration":
+            continue
+
+        # all the variants of a block in one pass
+        epochs_name = f"epochs/{subject}/block-{block}"
+        tasks.append(Task(
+            epochs_name, "02_epochs", "epochs_maker_variants",
+            args=(outputs["raw"], outputs["ica"], epochs_stage.epochs_variants, epochs_stage.trigger_mapping),
+            kwargs=dict(cache=cache, hash_mode=hash_mode),
+            deps=[preproc_name]
+        ))
+        subject_epochs[subject].append(epochs_name)
+
+    for subject, deps in subject_epochs.items():
+        if not len(deps):
+            continue
+        tasks.append(Task(
+            f"bursts/{subject}", "03_beta_power_burst_extraction", "burst_extraction",
+            args=(subject,),
+            kwargs=dict(
+                n_jobs=pipeline_settings.get("burst_n_jobs", 1), chunk_size=pipeline_settings.get("burst_chunk_size"),
+                cache=cache, hash_mode=hash_mode
+            ),
+            deps=deps
+        ))
+    return tasks
+
+
+if __name__ == '__main__':
+    try:
+        n_jobs = int(sys.argv[1])
+    except:
+        raise IndexError("no jobs :(")
+
+    # optional subject indices, e.g. "0,3,4", all the subjects if missing
+    datasets = raw_preproc.all_files
+    subjects = sorted(set(raw_preproc.output_paths(ds, raw_preproc.proc_path)["subject"] for ds in datasets))
+    try:
+        selected = [subjects[int(i)] for i in sys.argv[2].split(",")]
+    except IndexError:
+        if len(sys.argv) > 2:
+            raise IndexError("subject index out of range")
+        selected = subjects
+    datasets = [ds for ds in datasets if raw_preproc.output_paths(ds, raw_preproc.proc_path)["subject"] in selected]
+
+    start_time = time.time()
+    print(f"START Subjects: {len(selected)}")
+
+    tasks = build_graph(datasets, raw_preproc.proc_path)
+    status = run_graph(
+        tasks, n_jobs=n_jobs, retries=pipeline_settings.get("retries", 1),
+        state_path=raw_preproc.proc_path.joinpath("pipeline_state.json"),
+        log_path=raw_preproc.proc_path.joinpath("pipeline_log.jsonl"),
+        resume=pipeline_settings.get("resume", True)
+    )
+
+    counts = {i: list(status.values()).count(i) for i in ["done", "failed", "skipped"]}
+    time_elapsed = np.round((time.time() - start_time)/60, 2)
+    print(f"END Tasks: {counts} Time elapsed: {time_elapsed} min")
@@ -0,0 +1,44 @@
+import sys
+import time
+import numpy as np
+import warm_worker
+
+# usage:
+#   python 99_execute_worker.py serve n_workers     start the warm worker pool
+#   python 99_execute_worker.py path range_of_files  run indices 0..range_of_files-1 of a stage script on it
+#   python 99_execute_worker.py reload|shutdown
+
+try:
+    command = str(sys.argv[1])
+except:
+    raise IndexError("no command or file path")
+
+if command == "serve":
+    try:
+        n_workers = int(sys.argv[2])
+    except:
+        raise IndexError("no number of workers")
+    warm_worker.WarmWorker(n_workers=n_workers, log_path="worker_log.jsonl").serve_forever()
+
+elif command in ["reload", "shutdown"]:
+    warm_worker.send_command(warm_worker.DEFAULT_SOCKET, command)
+
+else:
+    try:
+        range_of_files = int(sys.argv[2])
+    except:
+        raise IndexError("no range of files")
+
+    start_time = time.time()
+    durations = []
+    for result in warm_worker.submit(warm_worker.DEFAULT_SOCKET, command, range(range_of_files)):
+        durations.append(result["duration"])
+        print(
+            f"{result['status'].upper()} File:{str(result['index']+1).zfill(3)}/{range_of_files} "
+            f"Time elapsed: {np.round(result['duration']/60, 2)} min"
+        )
+        if result["error"] is not None:
+            print(result["error"])
+
+    time_elapsed = np.round((time.time() - start_time)/60, 2)
+    print(f"END Files: {len(durations)} Task time: {np.round(np.sum(durations)/60, 2)} min Time elapsed: {time_elapsed} min")
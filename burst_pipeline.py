@@ -0,0 +1,237 @@
+import shutil
+import tempfile
+import numpy as np
+import utils
+from pathlib import Path
+from specparam import SpectralModel
+from specparam.sim.gen import gen_aperiodic
+from concurrent.futures import ProcessPoolExecutor
+from tools.burst_detection import extract_bursts
+
+
+def channel_aperiodic(data, sfreq, freqs, search_range):
+    """
+    Aperiodic spectrum of one channel at the burst search frequencies.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Channel data, shape (trials, times), float32 or float64.
+    sfreq : float
+        Sampling frequency in Hz.
+    freqs : numpy.ndarray
+        The `utils.superlet_foi` frequency grid.
+    search_range : numpy.ndarray
+        Indices of the burst search frequencies in `freqs`.
+
+    Returns
+    -------
+    aperiodic_spectrum : numpy.ndarray
+        Shape (len(search_range), 1).
+    """
+
+    ap_freqs, pds_mean_trials = utils.superlet_mean_spectrum(data, sfreq)
+
+    sm = SpectralModel(peak_width_limits=(1.65, 12))
+
+    sm.fit(ap_freqs, pds_mean_trials, freq_range=[1,120])
+
+    # aperiodic fit (log10 power) evaluated at the search frequencies
+    ap_fit = gen_aperiodic(freqs[search_range], sm.get_params("aperiodic_params"), sm.aperiodic_mode)
+
+    return 10**ap_fit.reshape(-1,1)
+
+
+def chunk_bursts(data, trials, sfreq, times, search_range, search_freqs, band_lims, aperiodic_spectrum, erf,
+                 waveform_sink=None):
+    """
+    Bursts of a chunk of trials of one channel.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Channel data, shape (trials, times), float32 or float64.
+    trials : slice
+        Trials of the chunk.
+    erf : numpy.ndarray
+        Event-related signal of all the trials of the channel.
+    waveform_sink : tools.burst_store.WaveformSink or None
+        Where to write the burst waveforms, returned in the dictionary if None.
+
+    Returns
+    -------
+    bursts : dict
+        Output of `tools.burst_detection.extract_bursts`, with trial numbers of the whole channel.
+    """
+
+    # float32 kept, the transform and the burst extraction convert one batch / trial at a time
+    chunk = data[trials]
+    tf_trials = utils.superlet_tf_batch(chunk, sfreq, foi_ix=search_range)
+    return extract_bursts(
+        chunk, tf_trials, times, search_freqs, band_lims, aperiodic_spectrum, sfreq,
+        erf=erf, trial_idx=np.arange(len(data))[trials], waveform_sink=waveform_sink
+    )
+
+
+def merge_bursts(bursts_list):
+    """
+    Concatenate `extract_bursts` outputs, in the order of the list.
+    """
+
+    merged = {}
+    for key in bursts_list[0].keys():
+        if key == "waveform_times":
+            merged[key] = next((i[key] for i in bursts_list[::-1] if len(i[key])), [])
+        elif key == "waveform":
+            waveforms = [i[key] for i in bursts_list if len(i[key])]
+            merged[key] = np.vstack(waveforms) if len(waveforms) else np.array([])
+        else:
+            merged[key] = np.concatenate([i[key] for i in bursts_list])
+    return merged
+
+
+def _channel_prep_task(data_path, ch_ix, sfreq, freqs, search_range):
+    data = np.load(data_path, mmap_mode="r")[ch_ix]
+    aperiodic_spectrum = channel_aperiodic(data, sfreq, freqs, search_range)
+    erf = np.mean(data, axis=0, dtype=float)
+    return aperiodic_spectrum, erf
+
+
+def _chunk_task(data_path, ch_ix, trials, sfreq, times, search_range, search_freqs, band_lims, aperiodic_spectrum,
+                erf):
+    data = np.load(data_path, mmap_mode="r")[ch_ix]
+    return chunk_bursts(data, trials, sfreq, times, search_range, search_freqs, band_lims, aperiodic_spectrum, erf)
+
+
+def extract_channels_bursts_parallel(data, sfreq, times, freqs, search_range, search_freqs, band_lims, n_jobs=2,
+                                     chunk_size=None, tmp_dir=None):
+    """
+    Burst extraction for many channels on a process pool, yields one `extract_bursts` dictionary per channel.
+
+    The data is written once to a memory-mapped .npy file that the workers open read-only, so nothing but the
+    file name and the task parameters is pickled. The aperiodic fit and the event-related signal are computed per
+    channel on all its trials, then (channel, trial chunk) tasks extract the bursts. Results are merged in
+    channel and trial order, independently of the order in which the tasks finish.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Epochs data, shape (channels, trials, times).
+    sfreq : float
+        Sampling frequency in Hz.
+    times : numpy.ndarray
+        Epoch time points.
+    freqs : numpy.ndarray
+        The `utils.superlet_foi` frequency grid.
+    search_range : numpy.ndarray
+        Indices of the burst search frequencies in `freqs`.
+    search_freqs : numpy.ndarray
+        Passed to `extract_bursts` as the search frequencies.
+    band_lims : list
+        Keep bursts whose peak frequency falls within these limits.
+    n_jobs : int
+        Number of worker processes.
+    chunk_size : int or None
+        Number of trials per task, all trials of a channel in one task if None.
+    tmp_dir : str or pathlib.Path or None
+        Where to put the memory-mapped data, system default temporary directory if None.
+
+    """
+
+    n_channels, n_trials = data.shape[:2]
+    if chunk_size is None:
+        chunk_size = n_trials
+    chunks = [slice(i, i + chunk_size) for i in range(0, n_trials, chunk_size)]
+
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        data_path = Path(tmp_dir).joinpath("epochs.npy")
+        data_mm = np.lib.format.open_memmap(data_path, mode="w+", dtype=data.dtype, shape=data.shape)
+        # one channel at a time, data can be a lazy channel major view
+        for ch_ix in range(n_channels):
+            data_mm[ch_ix] = data[ch_ix]
+        data_mm.flush()
+        del data_mm
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            prep = [
+                pool.submit(_channel_prep_task, data_path, ch_ix, sfreq, freqs, search_range)
+                for ch_ix in range(n_channels)
+            ]
+            tasks = []
+            for ch_ix in range(n_channels):
+                aperiodic_spectrum, erf = prep[ch_ix].result()
+                tasks.append([
+                    pool.submit(
+                        _chunk_task, data_path, ch_ix, trials, sfreq, times, search_range, search_freqs, band_lims,
+                        aperiodic_spectrum, erf
+                    )
+                    for trials in chunks
+                ])
+            for ch_tasks in tasks:
+                yield merge_bursts([i.result() for i in ch_tasks])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def iter_channels_bursts(data, sfreq, times, freqs, search_range, search_freqs, band_lims, n_jobs=1,
+                         chunk_size=None, tmp_dir=None, waveform_sink=None):
+    """
+    Burst extraction for many channels, yields one `extract_bursts` dictionary per channel, in channel order.
+
+    Parameters
+    ----------
+    data : numpy.ndarray or tools.lazy_epochs.ChannelMajorView
+        Epochs data of all the channels as one block, shape (channels, trials, times). Channels are processed as
+        views of it, a contiguous float32 array keeps each channel contiguous and halves the memory. A lazy
+        channel major view loads one channel at a time.
+    n_jobs : int
+        Number of worker processes, 1 processes the channels serially in this process.
+    chunk_size : int or None
+        Number of trials per TF / burst extraction step, all trials at once if None.
+    waveform_sink : tools.burst_store.WaveformSink or None
+        Where to write the burst waveforms as they are found, the dictionaries then hold their waveform_index
+        instead of the waveforms.
+
+    See `extract_channels_bursts_parallel` for the other parameters.
+    """
+
+    if n_jobs > 1:
+        for bursts in extract_channels_bursts_parallel(
+            data, sfreq, times, freqs, search_range, search_freqs, band_lims, n_jobs=n_jobs,
+            chunk_size=chunk_size, tmp_dir=tmp_dir
+        ):
+            # workers can't share the sink, waveforms are written here in channel order
+            if waveform_sink is not None:
+                bursts['waveform_index'] = waveform_sink.extend(bursts['waveform'])
+                bursts['waveform'] = np.array([])
+            yield bursts
+        return
+
+    n_trials = data.shape[1]
+    if chunk_size is None:
+        chunk_size = n_trials
+    chunks = [slice(i, i + chunk_size) for i in range(0, n_trials, chunk_size)]
+
+    for ch_data in data:
+        aperiodic_spectrum = channel_aperiodic(ch_data, sfreq, freqs, search_range)
+        erf = np.mean(ch_data, axis=0, dtype=float)
+        yield merge_bursts([
+            chunk_bursts(
+                ch_data, trials, sfreq, times, search_range, search_freqs, band_lims, aperiodic_spectrum, erf,
+                waveform_sink=waveform_sink
+            )
+            for trials in chunks
+        ])
+
+
+def extract_channels_bursts(data, sfreq, times, freqs, search_range, search_freqs, band_lims, n_jobs=1,
+                            chunk_size=None, tmp_dir=None, waveform_sink=None):
+    """
+    List version of `iter_channels_bursts`.
+    """
+
+    return list(iter_channels_bursts(
+        data, sfreq, times, freqs, search_range, search_freqs, band_lims, n_jobs=n_jobs, chunk_size=chunk_size,
+        tmp_dir=tmp_dir, waveform_sink=waveform_sink
+    ))
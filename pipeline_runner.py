@@ -0,0 +1,134 @@
+import json
+import time
+import importlib
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Task:
+    """
+    One node of the pipeline graph: a stage function called by module and function name, so that the worker
+    processes import it themselves.
+    """
+
+    def __init__(self, name, module, function, args=(), kwargs=None, deps=()):
+        """
+        :param name: unique task name, e.g. "epochs/sub-001/block-002"
+        :param module: module of the stage function, e.g. "02_epochs"
+        :param function: stage function name
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :param deps: names of the tasks that have to finish first
+        """
+        self.name = name
+        self.module = module
+        self.function = function
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.deps = tuple(deps)
+
+
+def _run_task(module, function, args, kwargs):
+    start = time.time()
+    try:
+        getattr(importlib.import_module(module), function)(*args, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return start, time.time() - start, error
+
+
+def load_state(state_path):
+    """
+    :param state_path: .json state file of a previous run
+    :return: dictionary task name: status, empty if there is no state file
+    """
+    if state_path is None or not Path(state_path).exists():
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def run_graph(tasks, n_jobs=1, retries=0, state_path=None, log_path=None, resume=True):
+    """
+    Run a dependency graph of tasks on a process pool. A task is submitted once all its dependencies are done,
+    at most n_jobs tasks run at once. Failed tasks are retried, the dependents of a task that still fails are
+    skipped. Finished tasks are recorded in the state file so that a run can be resumed after a failure, the
+    state file is removed once all the tasks are done.
+    :param tasks: list of Task
+    :param n_jobs: number of worker processes
+    :param retries: number of extra attempts of a failed task
+    :param state_path: .json file with the status of each task, None to keep no state
+    :param log_path: .jsonl file, one line of timing per task attempt is appended, None for no log
+    :param resume: skip the tasks done in the state file
+    :return: dictionary task name: "done", "failed" or "skipped"
+    """
+    tasks = {task.name: task for task in tasks}
+    state = load_state(state_path) if resume else {}
+    status = {name: "done" for name in tasks if state.get(name) == "done"}
+    attempts = {name: 0 for name in tasks}
+
+    def save_state():
+        if state_path is not None:
+            with open(state_path, "w") as f:
+                json.dump(dict(state, **status), f, indent=4)
+
+    def log(name, start, duration, outcome, error=None):
+        entry = {
+            "task": name, "attempt": attempts[name], "status": outcome,
+            "start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)), "duration": round(duration, 3)
+        }
+        print(f"{outcome.upper()} {name} attempt: {attempts[name]} time: {round(duration / 60, 2)} min")
+        if error is not None:
+            entry["error"] = error
+            print(error)
+        if log_path is not None:
+            with open(log_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    pending = [name for name in tasks if name not in status]
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        while pending or running:
+            # dependents of failed or missing tasks can never run
+            for name in list(pending):
+                if any(status.get(dep) in ("failed", "skipped") or dep not in tasks for dep in tasks[name].deps):
+                    pending.remove(name)
+                    status[name] = "skipped"
+                    log(name, time.time(), 0, "skipped")
+
+            for name in [i for i in pending if all(status.get(dep) == "done" for dep in tasks[i].deps)]:
+                if len(running) >= n_jobs:
+                    break
+                task = tasks[name]
+                attempts[name] += 1
+                pending.remove(name)
+                running[pool.submit(_run_task, task.module, task.function, task.args, task.kwargs)] = name
+
+            if not running:
+                # dependency cycle, nothing can be submitted any more
+                for name in pending:
+                    status[name] = "skipped"
+                    log(name, time.time(), 0, "skipped")
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                start, duration, error = future.result()
+                if error is None:
+                    status[name] = "done"
+                    log(name, start, duration, "done")
+                elif attempts[name] <= retries:
+                    pending.insert(0, name)
+                    log(name, start, duration, "retry", error)
+                else:
+                    status[name] = "failed"
+                    log(name, start, duration, "failed", error)
+            save_state()
+
+    save_state()
+    # nothing to resume after a complete run
+    if state_path is not None and all(i == "done" for i in status.values()):
+        Path(state_path).unlink()
+    return status
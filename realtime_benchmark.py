@@ -0,0 +1,523 @@
+import os
+import sys
+import time
+import warnings
+import contextlib
+import numpy as np
+import utils
+import burst_pipeline
+from mne import set_log_level, pick_types
+from mne.io import read_raw_fif
+from scipy.signal import welch
+from meegkit.dss import dss_line_iter
+from tools.lazy_epochs import SubjectEpochs
+from tools.burst_detection import OnlineBurstDetector, TFPeeler, FullGridPeeler, extract_bursts
+from tools.realtime_stream import ReplayProducer, StreamClient, TriggerDecoder
+from tools.streaming_zapline import StreamingZapline
+
+set_log_level("ERROR")
+
+# agreement of the online bursts with the batch detector below which the replay warns (and the bursts benchmark
+# fails): recorded epochs replay at recall 0.67 / precision 0.54 with order_max 10, synthetic at about 0.5 / 0.7
+MIN_RECALL = 0.5
+MIN_PRECISION = 0.5
+
+# usage:
+#   python realtime_benchmark.py superlet [raw.fif|synthetic] [n_channels] [block_ms]
+#       latency and throughput of the streaming beta band superlet, and its difference to the offline transform
+#   python realtime_benchmark.py peeling [epo.fif|synthetic] [channel]
+#       checks that the burst extraction with TFPeeler is bit-identical to the full-grid peeling
+#   python realtime_benchmark.py bursts [epo.fif|synthetic] [channel] [block_ms] [order_max]
+#       online burst detection replayed trial by trial on recorded epochs, compared with the batch detector,
+#       order_max of the streaming superlet (10 by default, 40 as the batch transform), exits with status 1 if
+#       the recall or the precision is below MIN_RECALL / MIN_PRECISION
+#   python realtime_benchmark.py ingest raw.fif [speed] [block_ms]
+#       replay of a processed recording over the local socket into the ring buffer, with trigger decoding
+#   python realtime_benchmark.py zapline [raw.fif|synthetic] [n_channels] [block_ms]
+#       streaming line noise removal fitted on a calibration segment, compared with dss_line_iter
+
+
+def stream_data(source, n_channels=1, duration=60.0, sfreq=1200.0, line_noise=0.0, fline=50.0):
+    """
+    Data to replay in blocks.
+
+    Parameters
+    ----------
+    source : str
+        Processed realtime_sub-*_raw.fif path, its first `n_channels` magnetometers are used, or "synthetic"
+        for white noise with 20 Hz bursts at `sfreq`.
+    duration : float
+        Seconds of data.
+    line_noise : float
+        Amplitude of the line noise added to each channel (line frequency and harmonics with random spatial
+        patterns and a slow amplitude drift), relative to the channel standard deviation. Processed recordings
+        are already cleaned.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Shape (n_channels, times).
+    sfreq : float
+        Sampling frequency in Hz.
+    """
+
+    rng = np.random.default_rng(0)
+    if source == "synthetic":
+        times = np.arange(int(duration * sfreq)) / sfreq
+        bursts = np.sin(2 * np.pi * 20 * times) * (np.sin(2 * np.pi * 0.5 * times) > 0.9)
+        data = bursts + 0.5 * rng.standard_normal((n_channels, len(times)))
+    else:
+        raw = read_raw_fif(source, preload=False)
+        picks = pick_types(raw.info, meg="mag", ref_meg=False)[:n_channels]
+        sfreq = raw.info["sfreq"]
+        data = raw.get_data(picks, 0, min(raw.n_times, int(duration * sfreq)))
+
+    if line_noise:
+        times = np.arange(data.shape[1]) / sfreq
+        scale = line_noise * np.std(data, axis=1, keepdims=True)
+        drift = 1 + 0.3 * np.sin(2 * np.pi * times / 100)
+        for harmonic in range(1, int(sfreq / 2 // fline) + 1):
+            # a few sources per harmonic, zapline needs one DSS iteration per source
+            for _ in range(3):
+                pattern = rng.standard_normal((len(data), 1)) / harmonic
+                phase = rng.uniform(0, 2 * np.pi)
+                data = data + scale * pattern * drift * np.cos(2 * np.pi * fline * harmonic * times + phase)
+    return data, sfreq
+
+
+def benchmark_superlet(data, sfreq, block_ms=50, band=(10, 33), check=True):
+    """
+    Push the data through `utils.superlet_stream` block by block.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Shape (channels, times).
+    block_ms : float
+        Block duration in ms.
+    band : tuple
+        Frequency limits in Hz.
+    check : bool
+        Compare the output with `utils.superlet_tf_batch` on the same data.
+
+    Returns
+    -------
+    report : dict
+        Latency, time per block, real-time factor (block duration / mean time per block), number of channels
+        one core keeps up with, and the maximum difference to the offline transform relative to its maximum.
+    """
+
+    block_size = int(round(sfreq * block_ms / 1000))
+    n_channels = len(data)
+    start = time.perf_counter()
+    # the batch transform order, for the comparison with it
+    stream, freqs = utils.superlet_stream(sfreq, block_size, n_channels=n_channels, band=band, order_max=40)
+    setup = time.perf_counter() - start
+
+    n_blocks = data.shape[1] // block_size
+    n_times = n_blocks * block_size
+    durations = np.zeros(n_blocks)
+    output = np.zeros((n_channels, len(freqs), n_times), dtype=np.float32)
+    for ix in range(n_blocks):
+        start = time.perf_counter()
+        ampl = stream.push(data[:, ix * block_size:(ix + 1) * block_size])
+        durations[ix] = time.perf_counter() - start
+        # aligned stream, all the frequencies have the same column times
+        times = stream.output_times()[0]
+        output[..., times[times >= 0]] = ampl[..., times >= 0]
+
+    block_s = block_size / sfreq
+    real_time_factor = block_s / np.mean(durations)
+    report = {
+        "band": band, "n_freqs": len(freqs), "n_channels": n_channels, "block_size": block_size,
+        "setup_s": setup, "latency_s": float(np.max(stream.latency_s)),
+        "block_ms_mean": 1000 * np.mean(durations), "block_ms_p95": 1000 * np.percentile(durations, 95),
+        "block_ms_max": 1000 * np.max(durations), "real_time_factor": real_time_factor,
+        "channels_per_core": n_channels * real_time_factor
+    }
+    if check:
+        offline = utils.superlet_tf_batch(data[:, :n_times], sfreq, foi_ix=stream.scale_ix)
+        valid = n_times - np.max(stream.latency)
+        report["max_rel_diff"] = float(
+            np.max(np.abs(output[..., :valid] - offline[..., :valid])) / np.max(offline[..., :valid])
+        )
+    return report
+
+
+def trial_data(source, channel=None, n_trials=40, sfreq=1200.0):
+    """
+    Trials to replay, one channel.
+
+    Parameters
+    ----------
+    source : str
+        Epochs .fif path, baseline corrected as in the burst extraction stage, or "synthetic" for noise trials
+        with a few 20 Hz bursts at `sfreq`.
+    channel : str or None
+        Channel name, the first magnetometer if None.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Shape (trials, times).
+    times : numpy.ndarray
+        Epoch time points.
+    sfreq : float
+        Sampling frequency in Hz.
+    """
+
+    if source == "synthetic":
+        rng = np.random.default_rng(0)
+        times = np.arange(-0.5, 2.0, 1 / sfreq)
+        data = np.cumsum(rng.standard_normal((n_trials, len(times))), axis=1) * 0.05
+        data += rng.standard_normal((n_trials, len(times)))
+        for trial in data:
+            for centre in rng.uniform(0, 1.5, 2):
+                freq = rng.uniform(15, 28)
+                trial += 3 * np.cos(2 * np.pi * freq * (times - centre)) * np.exp(-(times - centre) ** 2 / (2 * .05 ** 2))
+        return data, times, sfreq
+
+    if channel is None:
+        from mne import read_epochs
+        info = read_epochs(source, preload=False).info
+        channel = info.ch_names[pick_types(info, meg="mag", ref_meg=False)[0]]
+    epochs = SubjectEpochs([source], [channel], baseline=(-0.25, 0.0))
+    return epochs.channel_data(0).astype(float), epochs.times, epochs.sfreq
+
+
+def check_peeling(data, times, sfreq, search=(10, 33), band_lims=(13, 30)):
+    """
+    Burst extraction of every trial with `tools.burst_detection.TFPeeler` and with the full-grid reference
+    `FullGridPeeler` (np.std, np.argmax and the Gaussian on the whole TF map at every iteration). Raises an
+    AssertionError unless the number of peeling iterations of every trial and all the burst fields are bit-identical.
+
+    Returns
+    -------
+    report : dict
+        Number of trials, bursts and peeling iterations, time of both extractions.
+    """
+
+    counts = {}
+
+    def counting(peeler_class):
+        # records the number of iterations of every trial
+        class Counting(peeler_class):
+            def __init__(self, tf):
+                super().__init__(tf)
+                counts.setdefault(peeler_class, []).append(self)
+        return Counting
+
+    freqs = utils.superlet_foi(sfreq)
+    search_range = np.where((freqs >= search[0]) & (freqs <= search[1]))[0]
+    search_freqs = freqs[search_range]
+    aperiodic_spectrum = burst_pipeline.channel_aperiodic(data, sfreq, freqs, search_range)
+    tf_trials = utils.superlet_tf_batch(data, sfreq, foi_ix=search_range)
+
+    bursts, durations = {}, {}
+    for peeler_class in (TFPeeler, FullGridPeeler):
+        start = time.perf_counter()
+        bursts[peeler_class] = extract_bursts(
+            data, tf_trials, times, search_freqs, band_lims, aperiodic_spectrum, sfreq,
+            peeler_class=counting(peeler_class)
+        )
+        durations[peeler_class] = time.perf_counter() - start
+
+    n_peeled = {key: np.array([i.n_peeled for i in value]) for key, value in counts.items()}
+    assert np.array_equal(n_peeled[TFPeeler], n_peeled[FullGridPeeler]), "different number of peeling iterations"
+    for key, value in bursts[FullGridPeeler].items():
+        assert np.array_equal(bursts[TFPeeler][key], value), f"different {key}"
+
+    return {
+        "n_trials": len(data), "n_bursts": len(bursts[TFPeeler]["peak_time"]),
+        "n_peeled": int(np.sum(n_peeled[TFPeeler])), "tfpeeler_s": durations[TFPeeler],
+        "full_grid_s": durations[FullGridPeeler]
+    }
+
+
+def match_bursts(batch_times, batch_freqs, online_times, online_freqs, tol=0.05):
+    """
+    Greedy one to one matching of the bursts of one trial by peak time.
+
+    Returns
+    -------
+    pairs : list
+        (batch index, online index) of the bursts whose peak times differ by at most `tol` s, closest first.
+    """
+
+    dist = np.abs(np.subtract.outer(batch_times, online_times))
+    pairs = []
+    for flat in np.argsort(dist, axis=None):
+        i, j = np.unravel_index(flat, dist.shape)
+        if dist[i, j] > tol:
+            break
+        if all(i != a and j != b for a, b in pairs):
+            pairs.append((i, j))
+    return pairs
+
+
+def replay_bursts(data, times, sfreq, block_ms=50, search=(10, 33), band_lims=(13, 30), tol=0.05, order_max=10,
+                  min_recall=MIN_RECALL, min_precision=MIN_PRECISION):
+    """
+    Offline replay of the online burst detection: every trial is streamed from its first sample through
+    `utils.superlet_stream` and `tools.burst_detection.OnlineBurstDetector`, then flushed with zeros, and the
+    bursts are compared with `burst_pipeline.chunk_bursts` on the same trials, aperiodic spectrum and TF grid.
+    `order_max` is the highest order of the streaming superlet, the batch transform keeps 40. A warning is
+    issued if the recall or the precision is below `min_recall` / `min_precision`.
+
+    The polarity agreement is not part of the check: the batch waveforms are taken from the data minus the ERF
+    (computed on all the trials), the online ones from the raw data, so the polarities differ for part of the
+    matched bursts.
+
+    Returns
+    -------
+    report : dict
+        Number of bursts of each detector, recall and precision of the online bursts (peak times within `tol`
+        s), whether both reach the minimum, median differences of the matched bursts, polarity agreement,
+        latency of the online bursts (from the peak sample to the sample count when emitted) and detector time
+        per block.
+    """
+
+    block_size = int(round(sfreq * block_ms / 1000))
+    freqs = utils.superlet_foi(sfreq)
+    search_range = np.where((freqs >= search[0]) & (freqs <= search[1]))[0]
+    search_freqs = freqs[search_range]
+    aperiodic_spectrum = burst_pipeline.channel_aperiodic(data, sfreq, freqs, search_range)
+    erf = np.mean(data, axis=0)
+    batch = burst_pipeline.chunk_bursts(
+        data, slice(None), sfreq, times, search_range, search_freqs, band_lims, aperiodic_spectrum, erf
+    )
+
+    stream, _ = utils.superlet_stream(sfreq, block_size, foi_ix=search_range, order_max=order_max)
+    latency = int(np.max(stream.latency))
+    detector = OnlineBurstDetector(search_freqs, band_lims, aperiodic_spectrum, sfreq, latency)
+    n_times = len(times)
+    n_blocks = -(-(n_times + latency + detector.max_wait) // block_size) + 1
+
+    durations, latencies, pairs = [], [], []
+    online_times, online_freqs, online_polarity, online_trial = [], [], [], []
+    for trial, signal in enumerate(data):
+        stream.reset()
+        detector.reset()
+        padded = np.zeros(n_blocks * block_size)
+        padded[:n_times] = signal
+        bursts = []
+        for ix in range(n_blocks):
+            block = padded[ix * block_size:(ix + 1) * block_size]
+            tf_block = stream.push(block)
+            start = time.perf_counter()
+            bursts += detector.push(block, tf_block)
+            durations.append(time.perf_counter() - start)
+        # cut off by the end of the trial as in the batch detector
+        bursts = [i for i in bursts if i["peak_sample"] + detector.half_wlen <= n_times]
+        latencies += [(i["emitted_sample"] - i["peak_sample"]) / sfreq for i in bursts]
+
+        in_trial = np.where(batch["trial"] == trial)[0]
+        trial_times = np.array([times[i["peak_sample"]] for i in bursts])
+        trial_freqs = np.array([i["peak_freq"] for i in bursts])
+        pairs += [
+            (in_trial[i], len(online_times) + j) for i, j in
+            match_bursts(batch["peak_time"][in_trial], batch["peak_freq"][in_trial], trial_times, trial_freqs, tol)
+        ]
+        online_times += trial_times.tolist()
+        online_freqs += trial_freqs.tolist()
+        online_polarity += [i["polarity"] for i in bursts]
+        online_trial += [trial] * len(bursts)
+
+    batch_ix, online_ix = (np.array(i, dtype=int) for i in zip(*pairs)) if pairs else (np.array([], int),) * 2
+    report = {
+        "n_trials": len(data), "n_batch": len(batch["peak_time"]), "n_online": len(online_times),
+        "recall": len(pairs) / max(len(batch["peak_time"]), 1), "precision": len(pairs) / max(len(online_times), 1),
+        "median_abs_dt_ms": 1000 * np.median(np.abs(batch["peak_time"][batch_ix] - np.array(online_times)[online_ix]))
+        if len(pairs) else np.nan,
+        "median_abs_df_hz": np.median(np.abs(batch["peak_freq"][batch_ix] - np.array(online_freqs)[online_ix]))
+        if len(pairs) else np.nan,
+        "polarity_agreement": np.mean(batch["polarity"][batch_ix] == np.array(online_polarity)[online_ix])
+        if len(pairs) else np.nan,
+        "tf_latency_s": latency / sfreq,
+        "burst_latency_s_median": np.median(latencies) if len(latencies) else np.nan,
+        "burst_latency_s_max": np.max(latencies) if len(latencies) else np.nan,
+        "detector_block_ms_mean": 1000 * np.mean(durations),
+        "detector_block_ms_p95": 1000 * np.percentile(durations, 95), "detector_block_ms_max": 1000 * np.max(durations)
+    }
+    report["agreement_ok"] = report["recall"] >= min_recall and report["precision"] >= min_precision
+    if not report["agreement_ok"]:
+        warnings.warn(
+            f"online bursts agree poorly with the batch detector: recall {report['recall']:.2f} "
+            f"(min {min_recall}), precision {report['precision']:.2f} (min {min_precision})"
+        )
+    return report
+
+
+def benchmark_ingest(raw_path, trigger_mapping, speed=1.0, block_ms=50, window_s=1.0):
+    """
+    Replay a recording with `tools.realtime_stream.ReplayProducer` to a `StreamClient` in the same process, while a
+    consumer reads the last `window_s` seconds of the ring buffer after every block, as the real-time path would.
+
+    Parameters
+    ----------
+    raw_path : str
+        Processed realtime_sub-*_raw.fif path.
+    speed : float or None
+        Replay speed relative to real time, None as fast as possible.
+
+    Returns
+    -------
+    report : dict
+        Samples received and whether they are identical to the file, replay duration and achieved speed, transport
+        delay of the blocks (send to ring buffer), number of consumer windows overwritten while read, decoded
+        events and events matching the trigger channel of the file (or its annotations if it has none).
+    """
+
+    producer = ReplayProducer(raw_path, trigger_mapping, block_ms=block_ms, speed=speed)
+    block_size = producer.block_size
+    producer.serve_in_thread()
+
+    start = time.perf_counter()
+    n_reads, n_overwritten = 0, 0
+    with StreamClient(trigger_mapping) as client:
+        ring = client.ring
+        n_window = min(int(window_s * client.info["sfreq"]), ring.capacity)
+        n_read = 0
+        while not client.finished.is_set() or n_read < ring.n_written:
+            target = n_read + block_size
+            if client.finished.is_set():
+                # last block, shorter when the number of samples is not a multiple of the block size
+                target = min(target, ring.n_written)
+            if not ring.wait(target, timeout=0.01):
+                continue
+            first, window = ring.latest(n_window)
+            np.mean(window, axis=1)
+            n_overwritten += not ring.valid(first)
+            n_reads += 1
+            n_read = first + window.shape[1]
+        duration = time.perf_counter() - start
+        if client.error is not None:
+            raise client.error
+
+        n_times = producer.header["n_times"]
+        tail_start = n_times - min(ring.capacity, n_times)
+        tail = producer.raw.get_data(start=tail_start).astype(np.float32)
+        received = ring.window(tail_start, n_times)
+        events = client.events
+        delays = np.array(client.delays)
+
+    # the trigger channel of the file, or the one the producer appended from the annotations
+    if producer.trigger is None:
+        trigger = producer.raw.get_data(picks=[producer.stim_channel])[0]
+        identical = np.array_equal(received, tail)
+    else:
+        trigger = producer.trigger
+        identical = np.array_equal(received[:-1], tail) and np.array_equal(received[-1], trigger[tail_start:])
+    expected = [i[0] for i in TriggerDecoder(trigger_mapping).decode(trigger, 0)]
+    return {
+        "n_channels": len(producer.ch_names), "n_samples": int(ring.n_written),
+        "tail_identical": bool(identical), "duration_s": duration,
+        "speed": n_times / producer.header["sfreq"] / duration,
+        "delay_ms_median": 1000 * np.median(delays), "delay_ms_max": 1000 * np.max(delays),
+        "n_reads": n_reads, "n_overwritten": n_overwritten,
+        "n_events": len(events), "n_events_expected": len(expected),
+        "n_events_matched": len(np.intersect1d([i[0] for i in events], expected))
+    }
+
+
+def line_power(data, sfreq, fline=50.0, width=1.0):
+    """
+    Mean power over the channels within `width` Hz of the line frequency and its harmonics.
+    """
+
+    freqs, psd = welch(data, fs=sfreq, nperseg=int(sfreq), axis=-1)
+    harmonics = fline * np.arange(1, int(sfreq / 2 // fline) + 1)
+    band = np.any(np.abs(freqs[:, None] - harmonics) <= width, axis=1)
+    return np.mean(np.sum(psd[:, band], axis=1))
+
+
+def benchmark_zapline(data, sfreq, block_ms=50, calibration_s=60.0, refit_interval=60.0, fline=50.0, speed=10.0):
+    """
+    Fit `tools.streaming_zapline.StreamingZapline` on the first `calibration_s` seconds, then push all the data
+    through it block by block with background refits, and compare the data after the calibration with
+    dss_line_iter run offline on it with the same parameters (the 00_raw_preproc ones by default). The blocks are
+    pushed at `speed` times real time, so that the refits have time to finish.
+
+    Returns
+    -------
+    report : dict
+        Calibration fit time and number of DSS steps, time per block, number of refits, line noise attenuation
+        in dB of the stream and of the offline zapline after the calibration, and the RMS difference between both
+        relative to the offline RMS (channel means removed, the offline output starts with a moving average
+        transient).
+    """
+
+    block_size = int(round(sfreq * block_ms / 1000))
+    n_calibration = int(calibration_s * sfreq)
+    zapline = StreamingZapline(sfreq, len(data), refit_interval=refit_interval, refit_length=calibration_s, fline=fline)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        zapline.fit(data[:, :n_calibration])
+    fit_s = time.perf_counter() - start
+    n_steps = len(zapline.steps)
+
+    n_blocks = data.shape[1] // block_size
+    n_times = n_blocks * block_size
+    durations = np.zeros(n_blocks)
+    cleaned = np.zeros((len(data), n_times))
+    stream_start = time.perf_counter()
+    for ix in range(n_blocks):
+        block = data[:, ix * block_size:(ix + 1) * block_size]
+        time.sleep(max(stream_start + ix * block_size / (sfreq * speed) - time.perf_counter(), 0))
+        start = time.perf_counter()
+        cleaned[:, ix * block_size:(ix + 1) * block_size] = zapline.process(block)
+        durations[ix] = time.perf_counter() - start
+    zapline.close()
+
+    test = data[:, n_calibration:n_times]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        offline = dss_line_iter(test.T, sfreq=sfreq, **zapline.fit_params)[0].T
+    online = cleaned[:, n_calibration:]
+    power = line_power(test, sfreq, fline)
+    diff = (online - online.mean(axis=1, keepdims=True)) - (offline - offline.mean(axis=1, keepdims=True))
+    return {
+        "n_channels": len(data), "block_size": block_size, "calibration_s": calibration_s, "fit_s": fit_s,
+        "n_steps": n_steps, "block_ms_mean": 1000 * np.mean(durations),
+        "block_ms_p95": 1000 * np.percentile(durations, 95), "block_ms_max": 1000 * np.max(durations),
+        "real_time_factor": block_size / sfreq / np.mean(durations), "n_refits": zapline.n_refits,
+        "refit_error": repr(zapline.refit_error) if zapline.refit_error is not None else None,
+        "attenuation_db_online": 10 * np.log10(power / line_power(online, sfreq, fline)),
+        "attenuation_db_offline": 10 * np.log10(power / line_power(offline, sfreq, fline)),
+        "rel_rms_diff": float(np.sqrt(np.mean(diff ** 2) / np.mean(offline ** 2)))
+    }
+
+
+if __name__ == '__main__':
+    try:
+        command = str(sys.argv[1])
+    except:
+        raise IndexError("no benchmark")
+    source = sys.argv[2] if len(sys.argv) > 2 else "synthetic"
+    block_ms = float(sys.argv[4]) if len(sys.argv) > 4 else 50
+
+    if command == "superlet":
+        n_channels = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        data, sfreq = stream_data(source, n_channels)
+        report = benchmark_superlet(data, sfreq, block_ms)
+    elif command == "zapline":
+        n_channels = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+        data, sfreq = stream_data(source, n_channels, duration=240.0, line_noise=2.0)
+        report = benchmark_zapline(data, sfreq, block_ms)
+    elif command == "ingest":
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+        report = benchmark_ingest(source, utils.load_json("trigger_mapping.json"), speed or None, block_ms)
+    elif command == "peeling":
+        channel = (sys.argv[3] or None) if len(sys.argv) > 3 else None
+        data, times, sfreq = trial_data(source, channel)
+        report = check_peeling(data, times, sfreq)
+    elif command == "bursts":
+        channel = (sys.argv[3] or None) if len(sys.argv) > 3 else None
+        data, times, sfreq = trial_data(source, channel)
+        order_max = int(sys.argv[5]) if len(sys.argv) > 5 else 10
+        report = replay_bursts(data, times, sfreq, block_ms, order_max=order_max)
+    else:
+        raise ValueError(f"unknown benchmark {command}")
+    for key, value in report.items():
+        print(key, f"{value:.4g}" if isinstance(value, float) else value)
+    if not report.get("agreement_ok", True):
+        sys.exit(1)
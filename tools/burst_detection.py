@@ -1,10 +1,20 @@
-import copy
 import math
 import numpy as np
-from mne.filter import filter_data
-from scipy.signal import hilbert, argrelextrema
+from functools import lru_cache
+from mne.filter import create_filter
+from scipy.signal import hilbert, argrelextrema, fftconvolve
 from scipy.stats import linregress
 
+# Gaussians are evaluated within this many SDs of the peak, beyond it they are below float64 precision
+GAUSS_TRUNC = np.sqrt(-2 * np.log(np.finfo(float).eps))
+
+# beyond this many SDs exp(-x ** 2 / 2) underflows to exactly 0 (float64)
+GAUSS_ZERO = np.sqrt(2 * 746.)
+
+# relative margin of the noise floor within which the exact np.std decides whether to stop peeling, far above the
+# error of the running TFPeeler moments
+STD_RTOL = 1e-9
+
 
 def gaus2d(x=0, y=0, mx=0, my=0, sx=1, sy=1):
     """
@@ -30,6 +40,159 @@ def overlap(a, b):
     return a[0] <= b[0] <= a[1] or b[0] <= a[0] <= b[1]
 
 
+class TFPeeler:
+    """
+    Time-frequency map for iterative Gaussian peeling, with the same values as subtracting each Gaussian on the full
+    grid. The Gaussian is evaluated with gaus2d only within GAUSS_ZERO SDs of the peak, beyond it the full-grid
+    values are exactly 0. The mean and the sum of squared deviations are updated from the deviations of the changed
+    box (stable, no cancellation of large sums) and recomputed exactly every `resync` subtractions, the per-frequency
+    maxima only for the rows of the box
+    """
+
+    def __init__(self, tf, resync=16):
+        """
+        :param tf: TF spectrum (freq x time), copied
+        :param resync: number of subtractions between two exact recomputations of the mean and squared deviations
+        """
+        self.tf = np.array(tf, dtype=float)
+        self.size = self.tf.size
+        self.x_idx = np.arange(self.tf.shape[1])
+        self.y_idx = np.arange(self.tf.shape[0])
+        self.resync = resync
+        self.n_peeled = 0
+        self._resync()
+
+    def _resync(self):
+        self.mean = np.mean(self.tf)
+        self.m2 = np.sum((self.tf - self.mean) ** 2)
+        self.row_arg = np.argmax(self.tf, axis=1)
+        self.row_max = self.tf[self.y_idx, self.row_arg]
+
+    def std(self):
+        """
+        Standard deviation from the running moments, relative error far below STD_RTOL
+        :return: standard deviation of the TF map
+        """
+        return np.sqrt(max(self.m2, 0.) / self.size)
+
+    def exact_std(self):
+        """
+        Standard deviation recomputed over the whole map, as np.std
+        :return: standard deviation of the TF map
+        """
+        return np.std(self.tf)
+
+    def argmax(self):
+        """
+        Location of the maximum, ties resolved as np.argmax on the flattened map
+        :return: peak index [freq, time]
+        """
+        f_idx = np.argmax(self.row_max)
+        return f_idx, self.row_arg[f_idx]
+
+    def subtract_gaussian(self, amp, mx, my, sx, sy):
+        """
+        Subtract amp * gaus2d(x, y, mx, my, sx, sy) from the TF map
+        :param amp: amplitude of the Gaussian
+        :param mx: mean in time dimension (index)
+        :param my: mean in frequency dimension (index)
+        :param sx: standard deviation in time dimension (index)
+        :param sy: standard deviation in frequency dimension (index)
+        """
+        self.n_peeled += 1
+        if not (np.isfinite(sx) and np.isfinite(sy) and sx > 0 and sy > 0):
+            # Degenerate Gaussian, subtracted on the full grid
+            x_idx, y_idx = np.meshgrid(self.x_idx, self.y_idx)
+            self.tf -= amp * gaus2d(x_idx, y_idx, mx=mx, my=my, sx=sx, sy=sy)
+            self._resync()
+            return
+
+        # Bounding box of the non-zero part
+        x_sl = slice(max(0, int(np.floor(mx - GAUSS_ZERO * sx))), int(np.ceil(mx + GAUSS_ZERO * sx)) + 1)
+        y_sl = slice(max(0, int(np.floor(my - GAUSS_ZERO * sy))), int(np.ceil(my + GAUSS_ZERO * sy)) + 1)
+
+        # Same elementwise operations as on the full grid
+        z = amp * gaus2d(self.x_idx[x_sl][None, :], self.y_idx[y_sl][:, None], mx=mx, my=my, sx=sx, sy=sy)
+
+        box = self.tf[y_sl, x_sl]
+        old_dev = np.sum((box - self.mean) ** 2)
+        old_sum = np.sum(box)
+        box -= z
+        # Moments updated from the deviations of the box: M2' = M2 + sum((new - mean)^2 - (old - mean)^2)
+        # - size * (mean' - mean)^2
+        delta = (np.sum(box) - old_sum) / self.size
+        self.m2 += np.sum((box - self.mean) ** 2) - old_dev - self.size * delta ** 2
+        self.mean += delta
+
+        # Only the rows of the box can change their maximum
+        rows = self.tf[y_sl]
+        self.row_arg[y_sl] = np.argmax(rows, axis=1)
+        self.row_max[y_sl] = rows[np.arange(rows.shape[0]), self.row_arg[y_sl]]
+
+        if self.n_peeled % self.resync == 0:
+            self._resync()
+
+
+class FullGridPeeler(TFPeeler):
+    """
+    Reference peeling on the full map, as extract_bursts_single_trial before TFPeeler: exact np.std, np.argmax and
+    gaus2d on the full grid at every iteration. Same interface as TFPeeler, to check it
+    """
+
+    def std(self):
+        return np.std(self.tf)
+
+    def argmax(self):
+        return np.unravel_index(np.argmax(self.tf), self.tf.shape)
+
+    def subtract_gaussian(self, amp, mx, my, sx, sy):
+        self.n_peeled += 1
+        x_idx, y_idx = np.meshgrid(self.x_idx, self.y_idx)
+        self.tf -= amp * gaus2d(x_idx, y_idx, mx=mx, my=my, sx=sx, sy=sy)
+
+
+@lru_cache(maxsize=512)
+def band_filter(sfreq, n_times, l_freq, h_freq):
+    """
+    FIR filter as designed by mne.filter.filter_data with default settings, cached per band
+    :param sfreq: sampling rate
+    :param n_times: number of samples of the filtered signals
+    :param l_freq: lower pass-band edge
+    :param h_freq: upper pass-band edge
+    :return: filter coefficients
+    """
+    h = create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    h.flags.writeable = False
+    return h
+
+
+def filter_band(signal, sfreq, l_freq, h_freq):
+    """
+    Zero-phase FIR filtering equivalent to mne.filter.filter_data with default settings, using the cached filter
+    :param signal: signal (time)
+    :param sfreq: sampling rate
+    :param l_freq: lower pass-band edge
+    :param h_freq: upper pass-band edge
+    :return: filtered signal (time)
+    """
+    h = band_filter(sfreq, len(signal), l_freq, h_freq)
+    n_times = len(signal)
+    # Mirror the edges ("reflect_limited") to reduce the transient response
+    n_edge = max(min(len(h), n_times) - 1, 0)
+    l_z_pad = np.zeros(max(n_edge - n_times + 1, 0))
+    r_z_pad = np.zeros(max(n_edge - n_times + 1, 0))
+    signal_ext = np.concatenate([
+        l_z_pad,
+        2 * signal[:1] - signal[n_edge:0:-1],
+        signal,
+        2 * signal[-1:] - signal[-2:-n_edge - 2:-1],
+        r_z_pad
+    ])
+    # Compensate the delay of the linear-phase filter
+    shift = (len(h) - 1) // 2 + n_edge
+    return fftconvolve(signal_ext, h)[shift:shift + n_times]
+
+
 def fwhm_burst_norm(tf, peak):
     """
     Find two-dimensional FWHM
@@ -85,7 +248,8 @@ def fwhm_burst_norm(tf, peak):
     return right_loc, left_loc, up_loc, down_loc
 
 
-def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, aperiodic_spectrum, sfreq, w_size=.26):
+def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, aperiodic_spectrum, sfreq, w_size=.26,
+                                waveform_sink=None, peeler_class=TFPeeler):
     """
     Extract bursts from epoched data
     :param raw_trial: raw data for trial (time)
@@ -96,6 +260,9 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
     :param aperiodic_spectrum: aperiodic spectrum
     :param sfreq: sampling rate
     :param w_size: window size to extract burst waveforms
+    :param waveform_sink: if given, waveforms are appended to it (see tools.burst_store.WaveformSink) instead of
+                          being returned, and their row numbers are returned as waveform_index
+    :param peeler_class: peeling of the TF map, see TFPeeler (FullGridPeeler for the reference computation)
     :return: disctionary with waveform, peak frequency, relative peak amplitude, absolute peak amplitude, peak
             time, peak adjustment, FWHM in frequency, FWHM in time, and polarity for each detected burst
     """
@@ -111,9 +278,8 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
         'polarity': [],
         'waveform_times': []
     }
-
-    # Grid for computing 2D Gaussians
-    x_idx, y_idx = np.meshgrid(range(len(times)), range(len(search_freqs)))
+    if waveform_sink is not None:
+        bursts['waveform_index'] = []
 
     # Window size in points
     wlen = int(w_size * sfreq)
@@ -128,18 +294,25 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
         print("All values equal 0 after aperiodic subtraction")
         return bursts
 
+    # Filtered signal and its phase for each band, shared by the bursts of this trial
+    band_cache = {}
+
     # TF for iterating
-    trial_tf_iter = copy.copy(trial_tf)
+    peeler = peeler_class(trial_tf)
+    trial_tf_iter = peeler.tf
 
     while True:
         # Compute noise floor
-        thresh = 2 * np.std(trial_tf_iter)
+        thresh = 2 * peeler.std()
 
         # Find peak
-        [peak_freq_idx, peak_time_idx] = np.unravel_index(np.argmax(trial_tf_iter), trial_tf.shape)
+        [peak_freq_idx, peak_time_idx] = peeler.argmax()
         peak_freq = search_freqs[peak_freq_idx]
         peak_amp_iter = trial_tf_iter[peak_freq_idx, peak_time_idx]
         peak_amp_base = trial_tf[peak_freq_idx, peak_time_idx]
+        # Running moments are approximate, use the exact noise floor for close calls
+        if np.abs(peak_amp_iter - thresh) <= STD_RTOL * np.abs(thresh):
+            thresh = 2 * peeler.exact_std()
         # Stop if no peak above threshold
         if peak_amp_iter < thresh:
             break
@@ -171,10 +344,6 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
         fwhm_t = (times[1] - times[0]) * fwhm_t_idx
         sigma_t = fwhm_t_idx / 2.355
         sigma_f = fwhm_f_idx / 2.355
-        # Fitted Gaussian
-        z = peak_amp_iter * gaus2d(x_idx, y_idx, mx=peak_time_idx, my=peak_freq_idx, sx=sigma_t, sy=sigma_f)
-        # Subtract fitted Gaussian for next iteration
-        new_trial_tf_iter = trial_tf_iter - z
 
         # If detected peak is within band limits and not degenerate
         if all([peak_freq >= band_lims[0], peak_freq <= band_lims[1], not hv_isnan]):
@@ -183,17 +352,22 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
                 np.max([0, peak_freq_idx - dloc]),
                 np.min([len(search_freqs) - 1, peak_freq_idx + uloc])
             ]
-            filtered = filter_data(raw_trial.reshape(1, -1), sfreq, search_freqs[freq_range[0]], search_freqs[freq_range[1]],
-                                   verbose=False)
+            band = (search_freqs[freq_range[0]], search_freqs[freq_range[1]])
+            if band not in band_cache:
+                filtered = filter_band(raw_trial, sfreq, *band).reshape(1, -1)
+
+                # Hilbert transform
+                analytic_signal = hilbert(filtered)
+                # Get phase
+                instantaneous_phase = np.unwrap(np.angle(analytic_signal)) % math.pi
 
-            # Hilbert transform
-            analytic_signal = hilbert(filtered)
-            # Get phase
-            instantaneous_phase = np.unwrap(np.angle(analytic_signal)) % math.pi
+                # Local phase minima
+                min_phase_pts = argrelextrema(instantaneous_phase.T, np.less)[0]
+                band_cache[band] = (filtered, min_phase_pts)
+            filtered, min_phase_pts = band_cache[band]
 
             # Find local phase minima with negative deflection closest to TF peak
             # If no minimum is found, the error is caught and no burst is added
-            min_phase_pts = argrelextrema(instantaneous_phase.T, np.less)[0]
             new_peak_time_idx = peak_time_idx
             try:
                 new_peak_time_idx = min_phase_pts[np.argmin(np.abs(peak_time_idx - min_phase_pts))]
@@ -236,7 +410,10 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
                             burst *= -1.0
                             polarity = 1
 
-                        bursts['waveform'].append(burst)
+                        if waveform_sink is not None:
+                            bursts['waveform_index'].append(waveform_sink.append(burst))
+                        else:
+                            bursts['waveform'].append(burst)
                         bursts['peak_freq'].append(peak_freq)
                         bursts['peak_amp_iter'].append(peak_amp_iter)
                         bursts['peak_amp_base'].append(peak_amp_base)
@@ -246,7 +423,8 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
                         bursts['fwhm_time'].append(fwhm_t)
                         bursts['polarity'].append(polarity)
 
-        trial_tf_iter = new_trial_tf_iter
+        # Subtract fitted Gaussian for next iteration
+        peeler.subtract_gaussian(peak_amp_iter, mx=peak_time_idx, my=peak_freq_idx, sx=sigma_t, sy=sigma_f)
 
     bursts['waveform'] = np.array(bursts['waveform'])
     bursts['peak_freq'] = np.array(bursts['peak_freq'])
@@ -257,11 +435,14 @@ def extract_bursts_single_trial(raw_trial, tf, times, search_freqs, band_lims, a
     bursts['fwhm_freq'] = np.array(bursts['fwhm_freq'])
     bursts['fwhm_time'] = np.array(bursts['fwhm_time'])
     bursts['polarity'] = np.array(bursts['polarity'])
+    if waveform_sink is not None:
+        bursts['waveform_index'] = np.array(bursts['waveform_index'], dtype=np.int64)
 
     return bursts
 
 
-def extract_bursts(raw_trials, tf, times, search_freqs, band_lims, aperiodic_spectrum, sfreq, w_size=.26):
+def extract_bursts(raw_trials, tf, times, search_freqs, band_lims, aperiodic_spectrum, sfreq, w_size=.26, erf=None,
+                   trial_idx=None, waveform_sink=None, peeler_class=TFPeeler):
     """
     Extract bursts from epoched data
     :param raw_trials: raw data for each trial (trial x time)
@@ -272,6 +453,12 @@ def extract_bursts(raw_trials, tf, times, search_freqs, band_lims, aperiodic_spe
     :param aperiodic_spectrum: aperiodic spectrum
     :param sfreq: sampling rate
     :param w_size: window size to extract burst waveforms
+    :param erf: event-related signal to regress out, mean of raw_trials if None (pass it when raw_trials is only a
+                chunk of the trials)
+    :param trial_idx: trial numbers of raw_trials, 0 to n_trials - 1 if None
+    :param waveform_sink: if given, waveforms are appended to it instead of being returned, see
+                          extract_bursts_single_trial
+    :param peeler_class: see extract_bursts_single_trial
     :return: disctionary with trial, waveform, peak frequency, relative peak amplitude, absolute peak amplitude, peak
             time, peak adjustment, FWHM in frequency, FWHM in time, and polarity for each detected burst
     """
@@ -288,23 +475,32 @@ def extract_bursts(raw_trials, tf, times, search_freqs, band_lims, aperiodic_spe
         'polarity': [],
         'waveform_times': []
     }
+    if waveform_sink is not None:
+        bursts['waveform_index'] = []
 
     # Compute event-related signal
-    erf = np.mean(raw_trials, axis=0)
+    if erf is None:
+        erf = np.mean(raw_trials, axis=0, dtype=float)
+    if trial_idx is None:
+        trial_idx = range(len(raw_trials))
 
     # Iterate through trials
     for t_idx, tr_tf in enumerate(tf):
 
         # Regress out ERF
-        slope, intercept, r, p, se = linregress(erf, raw_trials[t_idx, :])
-        raw_trial = raw_trials[t_idx, :] - (intercept + slope * erf)
+        raw_trial = np.asarray(raw_trials[t_idx, :], dtype=float)
+        slope, intercept, r, p, se = linregress(erf, raw_trial)
+        raw_trial = raw_trial - (intercept + slope * erf)
 
         trial_bursts=extract_bursts_single_trial(raw_trial, tr_tf, times, search_freqs, band_lims, aperiodic_spectrum,
-                                                 sfreq, w_size=w_size)
+                                                 sfreq, w_size=w_size, waveform_sink=waveform_sink,
+                                                 peeler_class=peeler_class)
 
         n_trial_bursts=len(trial_bursts['peak_time'])
-        bursts['trial'].extend([int(t_idx) for i in range(n_trial_bursts)])
+        bursts['trial'].extend([int(trial_idx[t_idx]) for i in range(n_trial_bursts)])
         bursts['waveform'].extend(trial_bursts['waveform'])
+        if waveform_sink is not None:
+            bursts['waveform_index'].extend(trial_bursts['waveform_index'])
         bursts['peak_freq'].extend(trial_bursts['peak_freq'])
         bursts['peak_amp_iter'].extend(trial_bursts['peak_amp_iter'])
         bursts['peak_amp_base'].extend(trial_bursts['peak_amp_base'])
@@ -326,5 +522,257 @@ def extract_bursts(raw_trials, tf, times, search_freqs, band_lims, aperiodic_spe
     bursts['fwhm_freq'] = np.array(bursts['fwhm_freq'])
     bursts['fwhm_time'] = np.array(bursts['fwhm_time'])
     bursts['polarity'] = np.array(bursts['polarity'])
+    if waveform_sink is not None:
+        bursts['waveform_index'] = np.array(bursts['waveform_index'], dtype=np.int64)
+
+    return bursts
+
+class OnlineBurstDetector:
+    """
+    Causal version of extract_bursts_single_trial for one channel of a stream: consumes the raw samples and the TF
+    columns block by block (e.g. from tools.superlet.StreamingSuperlet) and emits each burst `max_wait` after its
+    peak column arrived.
+
+    Same iterative peeling as the batch detector, on the last `threshold_window` seconds of the residual TF: the
+    aperiodic spectrum is subtracted from the TF and clipped at 0, the threshold is twice the standard deviation of
+    the residual in the window, and while the largest peak at least `max_wait` old (so its right FWHM arm has
+    arrived, a maximum in time of the residual) is above the threshold, its FWHM are found with fwhm_burst_norm and
+    the fitted Gaussian is subtracted from the residual, including the columns still to come. Younger, larger peaks
+    do not hold it back, unlike the batch order, and at most `max_peels` peaks are peeled per block. Bursts within
+    the band limits get the same phase adjustment, waveform and polarity as the batch detector, from the raw data
+    around the peak. The raw data is not ERF-regressed, the event-related signal needs all the trials: the
+    waveforms include the evoked response and the polarity can differ from the batch one, whose waveforms are taken
+    from the data minus the ERF.
+
+    A burst is emitted at most latency + max_wait + one block after its peak column, so at most 30 ms more after
+    its phase adjusted peak sample, as long as fewer than `max_peels` peaks mature within a block. The TF latency
+    dominates: 0.66 s in the beta band with superlet order_max 10, the default of utils.superlet_stream for the
+    online path, about 1.5 s with order_max 40 as the batch transform, for a similar agreement with the batch
+    detector.
+    """
+
+    def __init__(self, search_freqs, band_lims, aperiodic_spectrum, sfreq, latency, w_size=.26, threshold=None,
+                 threshold_window=2., max_wait=.3, phase_window=1., max_peels=10):
+        """
+        :param search_freqs: frequencies of the TF rows
+        :param band_lims: keep bursts whose peak frequency falls within these limits
+        :param aperiodic_spectrum: aperiodic spectrum (freq x 1)
+        :param sfreq: sampling rate
+        :param latency: delay of the TF columns after the raw samples, in samples (StreamingSuperlet latency)
+        :param w_size: window size to extract burst waveforms
+        :param threshold: fixed threshold, e.g. from a calibration, None for the running threshold
+        :param threshold_window: duration of the residual TF the running threshold is computed on, in s
+        :param max_wait: age of a peak column before it is peeled, in s
+        :param phase_window: raw data used on each side of the peak for the phase adjustment, in s
+        :param max_peels: maximum number of peaks peeled per block, bounds the time of a block, the others are
+                          peeled with the next blocks
+        """
+        self.search_freqs = np.asarray(search_freqs)
+        self.band_lims = band_lims
+        self.aperiodic_spectrum = np.asarray(aperiodic_spectrum, dtype=float).reshape(-1, 1)
+        self.sfreq = sfreq
+        self.latency = int(latency)
+        self.threshold = threshold
+        self.half_wlen = int(int(w_size * sfreq) * .5)
+        self.max_wait = max(int(max_wait * sfreq), 1)
+        self.phase_window = int(phase_window * sfreq)
+        self.max_peels = max_peels
+        self.n_cols = max(int(threshold_window * sfreq), 1)
+        # raw samples around the oldest column of the TF window
+        self.n_raw = self.latency + self.n_cols + self.phase_window + self.half_wlen
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the state, the next block is the start of a new stream (e.g. a new trial)
+        """
+        self.n_samples = 0
+        self.raw = np.zeros(self.n_raw)
+        self.base = np.zeros((len(self.search_freqs), self.n_cols))
+        self.resid = np.zeros((len(self.search_freqs), self.n_cols))
+        self.thresh = np.nan
+        # stream index of the first column not final yet
+        self._decided = 0
+        # Gaussians subtracted from the residual, still to be subtracted from the next columns
+        self._gaussians = []
+        self._emitted = []
+
+    def _col_start(self):
+        # stream index of the first column of the TF buffers
+        return self.n_samples - self.latency - self.n_cols
+
+    def push(self, raw_block, tf_block):
+        """
+        :param raw_block: newest raw samples (time)
+        :param tf_block: TF columns (freq x time) of the samples `latency` samples before raw_block
+        :return: list of burst dictionaries with the batch detector fields (peak_time in s from the start of the
+                 stream), the peak sample and the sample count when emitted
+        """
+        raw_block = np.asarray(raw_block, dtype=float)
+        n_block = len(raw_block)
+        if tf_block.shape != (len(self.search_freqs), n_block):
+            raise ValueError("TF block must have one column per raw sample")
+
+        self.raw = np.concatenate([self.raw[n_block:], raw_block])
+        self.n_samples += n_block
+        col_tf = np.array(tf_block, dtype=float) - self.aperiodic_spectrum
+        col_tf[col_tf < 0] = 0
+        self.base = np.concatenate([self.base[:, n_block:], col_tf], axis=1)
+        self.resid = np.concatenate([self.resid[:, n_block:], col_tf], axis=1)
+        col_start = self._col_start()
+        new_cols = np.arange(self.n_cols - n_block, self.n_cols)
+
+        # continuation of the Gaussians subtracted so far
+        self._subtract_gaussians(new_cols)
+
+        # columns of the stream received so far
+        n_valid = min(self.n_cols, self.n_samples - self.latency)
+        if n_valid <= 0:
+            return []
+        if self.threshold is not None:
+            self.thresh = self.threshold
+
+        # peel the peaks that became at least max_wait old down to the noise floor, whatever the younger columns
+        # hold, the older columns are final
+        bursts = []
+        first = self.n_cols - n_valid
+        mature = self.n_cols - self.max_wait
+        start = max(first, self._decided - col_start)
+        if mature <= start:
+            return bursts
+        for _ in range(self.max_peels):
+            if self.threshold is None:
+                self.thresh = 2 * np.std(self.resid[:, first:])
+            # maxima in time only, not the rising flank of a younger peak
+            candidates = self.resid[:, start:mature]
+            candidates = np.where(candidates >= self.resid[:, start + 1:mature + 1], candidates, -np.inf)
+            peak_f, peak_col = np.unravel_index(np.argmax(candidates), candidates.shape)
+            if candidates[peak_f, peak_col] < self.thresh:
+                self._decided = col_start + mature
+                break
+            burst = self._confirm(peak_f, start + peak_col)
+            if burst is not None:
+                bursts.append(burst)
+        return bursts
+
+    def _subtract_gaussians(self, cols):
+        col_start = self._col_start()
+        keep = []
+        for amp, mx, my, sx, sy in self._gaussians:
+            gx = np.exp(-(col_start + cols - mx) ** 2. / (2. * sx ** 2.))
+            gy = np.exp(-(np.arange(len(self.search_freqs)) - my) ** 2. / (2. * sy ** 2.))
+            self.resid[:, cols] -= amp * np.outer(gy, gx)
+            if col_start + cols[-1] < mx + GAUSS_TRUNC * sx:
+                keep.append((amp, mx, my, sx, sy))
+        self._gaussians = keep
+
+    def _confirm(self, peak_freq_idx, peak_col):
+        # as one iteration of extract_bursts_single_trial, on the residual window
+        col_start = self._col_start()
+        trial_tf_iter = self.resid
+        peak_freq = self.search_freqs[peak_freq_idx]
+        peak_amp_iter = self.resid[peak_freq_idx, peak_col]
+        peak_amp_base = self.base[peak_freq_idx, peak_col]
+
+        rloc, lloc, uloc, dloc = fwhm_burst_norm(trial_tf_iter, (peak_freq_idx, peak_col))
+        vert_isnan = any(np.isnan([uloc, dloc]))
+        horiz_isnan = any(np.isnan([rloc, lloc]))
+        if vert_isnan:
+            v_sh = max(int((self.search_freqs.shape[0] - peak_freq_idx) / 2), 1)
+            uloc = v_sh
+            dloc = v_sh
+        elif horiz_isnan:
+            h_sh = max(int((trial_tf_iter.shape[1] - peak_col) / 2), 1)
+            rloc = h_sh
+            lloc = h_sh
+        hv_isnan = any([vert_isnan, horiz_isnan])
+
+        fwhm_f_idx = uloc + dloc
+        fwhm_f = (self.search_freqs[1] - self.search_freqs[0]) * fwhm_f_idx
+        fwhm_t_idx = lloc + rloc
+        fwhm_t = fwhm_t_idx / self.sfreq
+        sigma_t = fwhm_t_idx / 2.355
+        sigma_f = fwhm_f_idx / 2.355
 
-    return bursts
\ No newline at end of file
+        burst = None
+        if self.band_lims[0] <= peak_freq <= self.band_lims[1] and not hv_isnan:
+            burst = self._burst(
+                peak_freq_idx, col_start + peak_col, peak_amp_iter, peak_amp_base, uloc, dloc, fwhm_f, fwhm_t
+            )
+
+        # subtract the fitted Gaussian from the residual, the next columns as they arrive
+        self._subtract_box(peak_amp_iter, col_start + peak_col, peak_freq_idx, sigma_t, sigma_f)
+        return burst
+
+    def _subtract_box(self, amp, mx, my, sx, sy):
+        col_start = self._col_start()
+        if not (np.isfinite(sx) and np.isfinite(sy) and sx > 0 and sy > 0):
+            # degenerate Gaussian, only remove the peak so that the peeling moves on
+            self.resid[int(my), int(mx - col_start)] = 0
+            return
+        x_sl = slice(max(0, int(np.floor(mx - col_start - GAUSS_TRUNC * sx))), self.n_cols)
+        y_sl = slice(max(0, int(np.floor(my - GAUSS_TRUNC * sy))), int(np.ceil(my + GAUSS_TRUNC * sy)) + 1)
+        gx = np.exp(-(col_start + np.arange(self.n_cols)[x_sl] - mx) ** 2. / (2. * sx ** 2.))
+        gy = np.exp(-(np.arange(len(self.search_freqs))[y_sl] - my) ** 2. / (2. * sy ** 2.))
+        self.resid[y_sl, x_sl] -= amp * np.outer(gy, gx)
+        self._gaussians.append((amp, mx, my, sx, sy))
+
+    def _burst(self, peak_freq_idx, peak_sample, peak_amp_iter, peak_amp_base, uloc, dloc, fwhm_f, fwhm_t):
+        # raw data around the peak, in stream samples [raw_start, n_samples)
+        raw_start = self.n_samples - self.n_raw
+        win_start = max(0, peak_sample - self.phase_window, raw_start)
+        win_stop = min(self.n_samples, peak_sample + self.phase_window)
+        raw_trial = self.raw[win_start - raw_start:win_stop - raw_start]
+
+        freq_range = [
+            np.max([0, peak_freq_idx - dloc]),
+            np.min([len(self.search_freqs) - 1, peak_freq_idx + uloc])
+        ]
+        band = (self.search_freqs[int(freq_range[0])], self.search_freqs[int(freq_range[1])])
+        filtered = filter_band(raw_trial, self.sfreq, *band).reshape(1, -1)
+        instantaneous_phase = np.unwrap(np.angle(hilbert(filtered))) % math.pi
+        min_phase_pts = argrelextrema(instantaneous_phase.T, np.less)[0]
+
+        peak_time_idx = peak_sample - win_start
+        if not len(min_phase_pts):
+            return None
+        new_peak_time_idx = min_phase_pts[np.argmin(np.abs(peak_time_idx - min_phase_pts))]
+        adjustment = (new_peak_time_idx - peak_time_idx) / self.sfreq
+        if np.abs(adjustment) >= .03:
+            return None
+
+        # burst cut off by the start of the stream or the last sample
+        new_peak_sample = win_start + new_peak_time_idx
+        if new_peak_sample < self.half_wlen or new_peak_sample + self.half_wlen > self.n_samples:
+            return None
+        peak_time = new_peak_sample / self.sfreq
+
+        for o_t, o_fwhm_t in self._emitted:
+            if overlap([peak_time - .5 * fwhm_t, peak_time + .5 * fwhm_t],
+                       [o_t - .5 * o_fwhm_t, o_t + .5 * o_fwhm_t]):
+                return None
+        oldest = (self.n_samples - self.n_raw) / self.sfreq
+        self._emitted = [i for i in self._emitted if i[0] + i[1] >= oldest] + [(peak_time, fwhm_t)]
+
+        waveform = self.raw[new_peak_sample - self.half_wlen - raw_start:new_peak_sample + self.half_wlen - raw_start]
+        waveform = waveform - np.mean(waveform)
+        peak_dists = np.abs(argrelextrema(filtered.T, np.greater)[0] - new_peak_time_idx)
+        trough_dists = np.abs(argrelextrema(filtered.T, np.less)[0] - new_peak_time_idx)
+        polarity = 0
+        if len(trough_dists) == 0 or (len(peak_dists) > 0 and np.min(peak_dists) < np.min(trough_dists)):
+            waveform *= -1.0
+            polarity = 1
+
+        return {
+            'waveform': waveform,
+            'peak_freq': self.search_freqs[peak_freq_idx],
+            'peak_amp_iter': peak_amp_iter,
+            'peak_amp_base': peak_amp_base,
+            'peak_time': peak_time,
+            'peak_sample': new_peak_sample,
+            'peak_adjustment': adjustment,
+            'fwhm_freq': fwhm_f,
+            'fwhm_time': fwhm_t,
+            'polarity': polarity,
+            'emitted_sample': self.n_samples
+        }
@@ -0,0 +1,201 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Feature columns of extract_bursts and their stored types
+FEATURE_TYPES = {
+    'trial': pa.int32(),
+    'peak_freq': pa.float32(),
+    'peak_amp_iter': pa.float32(),
+    'peak_amp_base': pa.float32(),
+    'peak_time': pa.float32(),
+    'peak_adjustment': pa.float32(),
+    'fwhm_freq': pa.float32(),
+    'fwhm_time': pa.float32(),
+    'polarity': pa.int8(),
+    'waveform_index': pa.int64(),
+}
+
+# Categorical columns, stored once per row group as a dictionary
+CATEGORY_COLUMNS = ['channel', 'subject']
+
+SCHEMA = pa.schema(
+    [(key, value) for key, value in FEATURE_TYPES.items()] +
+    [(key, pa.dictionary(pa.int32(), pa.string())) for key in CATEGORY_COLUMNS]
+)
+
+
+def bursts_to_table(bursts, first_row=0, **categories):
+    """
+    Convert an extract_bursts dictionary to a typed table
+    :param bursts: dictionary with the burst features
+    :param first_row: waveform row of the first burst, used when bursts has no waveform_index (waveforms stacked in
+                      the order of the features)
+    :param categories: value of each categorical column (channel, subject) for all the bursts
+    :return: pyarrow Table with the SCHEMA columns
+    """
+    n_bursts = len(bursts['trial'])
+    if 'waveform_index' not in bursts:
+        bursts = dict(bursts, waveform_index=np.arange(first_row, first_row + n_bursts))
+    columns = [pa.array(np.asarray(bursts[key]).astype(value.to_pandas_dtype()), type=value)
+               for key, value in FEATURE_TYPES.items()]
+    for key in CATEGORY_COLUMNS:
+        columns.append(pa.DictionaryArray.from_arrays(
+            pa.array(np.zeros(n_bursts, dtype=np.int32)), pa.array([str(categories[key])])
+        ))
+    return pa.Table.from_arrays(columns, schema=SCHEMA)
+
+
+class BurstFeatureWriter:
+    """
+    Parquet burst feature file written one channel at a time, each append is a row group
+    """
+
+    def __init__(self, path):
+        """
+        :param path: output .parquet path, overwritten
+        """
+        self.path = path
+        self.n_rows = 0
+        self._writer = pq.ParquetWriter(path, SCHEMA)
+
+    def append(self, bursts, channel, subject):
+        """
+        Append the bursts of one channel
+        :param bursts: extract_bursts dictionary
+        :param channel: channel name
+        :param subject: subject label
+        """
+        table = bursts_to_table(bursts, first_row=self.n_rows, channel=channel, subject=subject)
+        self._writer.write_table(table)
+        self.n_rows += table.num_rows
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WaveformSink:
+    """
+    Growable on-disk waveform matrix (burst x time). Rows are written into a memory-mapped .npy file that is
+    preallocated in chunks and grown in place, the .npy header is rewritten to the final number of rows on close
+    """
+
+    def __init__(self, path, n_samples=None, dtype=np.float32, chunk_rows=4096):
+        """
+        :param path: output .npy path, overwritten
+        :param n_samples: waveform length, taken from the first appended waveform if None
+        :param dtype: stored data type
+        :param chunk_rows: number of rows allocated at once
+        """
+        self.path = path
+        self.n_samples = n_samples
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.n_rows = 0
+        self.closed = False
+        self._mm = None
+        if n_samples is not None:
+            self._create()
+
+    def _create(self):
+        self._mm = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype,
+                                             shape=(self.chunk_rows, self.n_samples))
+        self._offset = self._mm.offset
+
+    def _resize(self, n_rows):
+        # the .npy header has spare room for the first dimension to grow in place
+        self._mm.flush()
+        self._mm = None
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (n_rows, self.n_samples)}
+        with open(self.path, 'r+b') as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            if f.tell() != self._offset:
+                raise RuntimeError("Waveform file header can not be resized in place")
+            f.truncate(self._offset + n_rows * self.n_samples * self.dtype.itemsize)
+
+    def append(self, waveform):
+        """
+        Append one waveform
+        :param waveform: waveform (time)
+        :return: row number of the waveform
+        """
+        return self.extend(np.asarray(waveform).reshape(1, -1))[0]
+
+    def extend(self, waveforms):
+        """
+        Append many waveforms
+        :param waveforms: waveforms (burst x time)
+        :return: row numbers of the waveforms
+        """
+        waveforms = np.asarray(waveforms)
+        if waveforms.size == 0:
+            return np.arange(self.n_rows, self.n_rows, dtype=np.int64)
+        if self._mm is None:
+            self.n_samples = waveforms.shape[1]
+            self._create()
+
+        capacity = self._mm.shape[0]
+        if self.n_rows + len(waveforms) > capacity:
+            while self.n_rows + len(waveforms) > capacity:
+                capacity += max(self.chunk_rows, capacity)
+            self._resize(capacity)
+            self._mm = np.load(self.path, mmap_mode='r+')
+
+        rows = np.arange(self.n_rows, self.n_rows + len(waveforms), dtype=np.int64)
+        self._mm[rows[0]:rows[-1] + 1] = waveforms
+        self.n_rows += len(waveforms)
+        return rows
+
+    def close(self):
+        """
+        Trim the file to the written rows
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._mm is None:
+            np.save(self.path, np.zeros((0, self.n_samples or 0), dtype=self.dtype))
+            return
+        self._resize(self.n_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_burst_features(paths, columns=None, filters=None):
+    """
+    Read burst features of one or many files
+    :param paths: .parquet path or list of paths
+    :param columns: columns to read, all if None
+    :param filters: pyarrow row filters, e.g. [('channel', 'in', ['MLC11'])]
+    :return: DataFrame, channel and subject as categoricals
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    tables = [pq.read_table(path, columns=columns, filters=filters) for path in paths]
+    # unify the per row group dictionaries before concatenating
+    table = pa.concat_tables(tables).unify_dictionaries()
+    return table.to_pandas()
+
+
+def load_bursts(features_path, waveform_path, columns=None):
+    """
+    Burst features with the waveform matrix memory-mapped, the waveform of each burst is the waveform_index row
+    :param features_path: .parquet features path
+    :param waveform_path: .npy waveforms path
+    :param columns: feature columns to read, all if None
+    :return: DataFrame of features, read-only memory-mapped waveforms (burst x time)
+    """
+    features = read_burst_features(features_path, columns=columns)
+    waveforms = np.load(waveform_path, mmap_mode='r')
+    return features, waveforms
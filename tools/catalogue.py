@@ -0,0 +1,272 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+# default directory of the catalogue files, on the local disk
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache"))).joinpath("real_time_confidence")
+
+# stage of an artifact from its name, the first match wins
+STAGE_RULES = [
+    ("manifest", lambda name, is_dir: name.endswith(".manifest.json")),
+    ("raw", lambda name, is_dir: is_dir and name.endswith(".ds")),
+    ("preproc", lambda name, is_dir: name.endswith("_raw.fif")),
+    ("ica", lambda name, is_dir: name.endswith("_ica.fif")),
+    ("calibration", lambda name, is_dir: name.endswith("_meg-calibration.json")),
+    ("epochs", lambda name, is_dir: name.endswith("_epo.fif")),
+    ("burst_features", lambda name, is_dir: name.startswith("burst-features")),
+    ("burst_waveforms", lambda name, is_dir: name.startswith("burst-waveforms")),
+    ("behaviour", lambda name, is_dir: name.endswith(".csv")),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY, parent TEXT, name TEXT, is_dir INTEGER, subject TEXT, block TEXT, stage TEXT
+);
+CREATE INDEX IF NOT EXISTS artifacts_parent ON artifacts (parent);
+CREATE INDEX IF NOT EXISTS artifacts_query ON artifacts (stage, subject, block);
+"""
+
+
+def derived_cache_path(source, suffix):
+    """
+    Local cache file derived from a dataset file, one per source file (overwritten when the source changes, so
+    re-runs leave nothing behind), in CACHE_DIR rather than next to the processed data
+    :param source: path of the file the cache is derived from
+    :param suffix: end of the file name, e.g. "_proj.npz"
+    :return: path in CACHE_DIR/derived, its directory exists
+    """
+    source = Path(source)
+    digest = hashlib.sha256(str(source.resolve()).encode()).hexdigest()[:12]
+    path = CACHE_DIR.joinpath("derived", f"{source.stem}-{digest}{suffix}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def ds_subject_block(name):
+    """
+    Subject and block of a CTF dataset name, e.g. "XXX_realtime_20240101_05.ds" -> ("sub-XXX", "003")
+    :param name: .ds directory name
+    :return: subject directory name, "calibration" or the zero-padded block number
+    """
+    subject = name.split("_")[0]
+    if "01.ds" in name:
+        block_type = "calibration"
+    else:
+        block = int(name.split("_")[-1].split(".")[0]) - 2
+        block_type = str(block).zfill(3)
+    return f"sub-{subject}", block_type
+
+
+def parse_artifact(name, is_dir):
+    """
+    :param name: file or directory name
+    :param is_dir: whether it is a directory
+    :return: subject, block and stage of an artifact name, None if not found in the name
+    """
+    stage = next((stage for stage, rule in STAGE_RULES if rule(name, is_dir)), None)
+    if stage == "raw":
+        try:
+            subject, block = ds_subject_block(name)
+            return subject, block, stage
+        except ValueError:
+            pass
+    subject = re.search(r"sub-[^_./]+", name)
+    block = re.search(r"block-([^_.]+)", name)
+    return subject and subject.group(0), block and block.group(1), stage
+
+
+class DatasetCatalogue:
+    """
+    Persistent SQLite index of the files and directories of the dataset, with the subject, block and stage
+    parsed from their names. Refreshing only lists the directories whose modification time changed since the
+    last refresh (the others are only stat-ed), CTF .ds directories are indexed but not entered, and the write
+    lock is only taken when one of them changed. The SQLite file is on the local disk by default, SQLite locking
+    is unreliable on network filesystems.
+    """
+
+    def __init__(self, root, db_path=None, timeout=60):
+        """
+        :param root: dataset directory
+        :param db_path: SQLite file, one per dataset directory in CACHE_DIR if None
+        :param timeout: seconds to wait for another process writing the catalogue
+        """
+        self.root = Path(root)
+        if db_path is None:
+            digest = hashlib.sha256(str(self.root.resolve()).encode()).hexdigest()[:12]
+            db_path = CACHE_DIR.joinpath(f"catalogue-{digest}.sqlite")
+        self.db_path = Path(db_path)
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+
+    @property
+    def _db(self):
+        # one connection per process, a connection must not be used across a fork
+        if self._connection is None or self._pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.db_path), timeout=self.timeout, isolation_level=None)
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def refresh(self):
+        """
+        Bring the index up to date with the directory tree
+        :return: number of directories listed
+        """
+        start = time.time()
+        listed = 0
+        if not self._changed():
+            print(f"catalogue: up to date in {round(time.time() - start, 2)} s")
+            return listed
+
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            known = dict(self._db.execute("SELECT path, mtime_ns FROM directories"))
+            seen = set()
+            stack = [str(self.root)]
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen.add(directory)
+                if known.get(directory) == mtime:
+                    subdirs = [i for (i,) in self._db.execute(
+                        "SELECT path FROM artifacts WHERE parent = ? AND is_dir = 1 AND stage IS NOT 'raw'",
+                        (directory,)
+                    )]
+                else:
+                    subdirs = self._list(directory, mtime)
+                    listed += 1
+                stack.extend(subdirs)
+
+            # directories removed from the tree
+            for directory in set(known) - seen:
+                self._db.execute("DELETE FROM directories WHERE path = ?", (directory,))
+                self._db.execute("DELETE FROM artifacts WHERE parent = ?", (directory,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        print(f"catalogue: {listed} directories listed in {round(time.time() - start, 2)} s")
+        return listed
+
+    def _changed(self):
+        # new and removed directories change the modification time of their parent, stat-ing the indexed ones
+        # is enough, without locking the database
+        known = dict(self._db.execute("SELECT path, mtime_ns FROM directories"))
+        if str(self.root) not in known:
+            return True
+        for directory, mtime in known.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _list(self, directory, mtime):
+        rows = []
+        subdirs = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name == self.db_path.name or entry.name.startswith(self.db_path.name + "-"):
+                    continue
+                is_dir = entry.is_dir()
+                subject, block, stage = parse_artifact(entry.name, is_dir)
+                rows.append((entry.path, directory, entry.name, int(is_dir), subject, block, stage))
+                if is_dir and stage != "raw":
+                    subdirs.append(entry.path)
+        self._db.execute("DELETE FROM artifacts WHERE parent = ?", (directory,))
+        self._db.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self._db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime))
+        return subdirs
+
+    def _select(self, columns, stage=None, subject=None, block=None, strings=(), under=None, parent=None,
+                suffix=None, is_dir=None, order_by="name"):
+        conditions, values = [], []
+        if stage is not None:
+            stages = [stage] if isinstance(stage, str) else list(stage)
+            conditions.append(f"stage IN ({', '.join('?' * len(stages))})")
+            values.extend(stages)
+        parent = None if parent is None else str(parent)
+        for column, value in [("subject", subject), ("block", block), ("parent", parent)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        for string in strings:
+            conditions.append("instr(name, ?) > 0")
+            values.append(string)
+        if under is not None:
+            prefix = os.path.join(str(under), "")
+            conditions.append("substr(path, 1, ?) = ?")
+            values.extend([len(prefix), prefix])
+        if suffix is not None:
+            conditions.append("substr(name, -?) = ?")
+            values.extend([len(suffix), suffix])
+        if is_dir is not None:
+            conditions.append("is_dir = ?")
+            values.append(int(is_dir))
+        if order_by not in ("name", "path"):
+            raise ValueError("order_by 'name' or 'path'")
+
+        sql = f"SELECT {columns} FROM artifacts"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order_by}, path"
+        return self._db.execute(sql, values).fetchall()
+
+    def query(self, stage=None, subject=None, block=None, strings=(), under=None, parent=None, suffix=None,
+              is_dir=None, order_by="name"):
+        """
+        Artifacts matching all the given conditions
+        :param stage: stage name or list of names, see STAGE_RULES
+        :param subject: subject directory name, e.g. "sub-001"
+        :param block: block, e.g. "002" or "calibration"
+        :param strings: strings that all have to be in the name (case sensitive, as utils.check_many)
+        :param under: directory the artifacts are in, at any depth
+        :param parent: directory the artifacts are directly in
+        :param suffix: name ending, e.g. ".csv"
+        :param is_dir: True for directories only, False for files only
+        :param order_by: "name" (as utils.get_files) or "path" (as utils.get_directories)
+        :return: list of pathlib.Path
+        """
+        rows = self._select(
+            "path", stage=stage, subject=subject, block=block, strings=strings, under=under, parent=parent,
+            suffix=suffix, is_dir=is_dir, order_by=order_by
+        )
+        return [Path(i) for (i,) in rows]
+
+    def subjects(self, **conditions):
+        """
+        :param conditions: query conditions, e.g. stage="epochs"
+        :return: sorted subjects of the matching artifacts
+        """
+        return sorted(set(i for (i,) in self._select("subject", **conditions)) - {None})
+
+    def pairs(self, stage_a, stage_b, **conditions):
+        """
+        Artifacts of two stages in the same directory matched by subject and block, e.g. the raw and ICA fif
+        files of each block
+        :param stage_a: stage of the first element, sets the order
+        :param stage_b: stage of the second element
+        :param conditions: query conditions applied to both stages
+        :return: list of (path_a, path_b)
+        """
+        columns = "path, parent, subject, block"
+        match = {tuple(i[1:]): Path(i[0]) for i in self._select(columns, stage=stage_b, **conditions)}
+        return [
+            (Path(i[0]), match[tuple(i[1:])]) for i in self._select(columns, stage=stage_a, **conditions)
+            if tuple(i[1:]) in match
+        ]
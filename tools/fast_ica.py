@@ -0,0 +1,99 @@
+import json
+import time
+import hashlib
+import numpy as np
+import mne
+from pathlib import Path
+from scipy.optimize import linear_sum_assignment
+from mne.io import RawArray
+from mne.preprocessing import ICA, read_ica
+
+
+def subsample_raw(raw, decim=1, segment_length=10.0, segment_step=1, reject_by_annotation=True):
+    """
+    Subsample of continuous data for an ICA fit. The data is read `segment_length` seconds at a time and decimated
+    as it is read (ICA.fit copies the whole recording first), every `segment_step`-th segment is kept. Segments
+    start on multiples of decim, so with all segments kept the samples are those ICA.fit(raw, decim=decim) uses
+    :param raw: filtered mne Raw, the data must be low-passed below sfreq / (2 * decim)
+    :param decim: decimation
+    :param segment_length: length of the segments in seconds
+    :param segment_step: one segment in segment_step is kept
+    :param reject_by_annotation: leave out the segments annotated as bad, as ICA.fit
+    :return: RawArray of the kept samples with the info of raw, whose sampling rate is left unchanged as in an ICA
+             fitted with decim
+    """
+    decim = max(1, int(decim))
+    length = max(decim, int(round(segment_length * raw.info["sfreq"])) // decim * decim)
+    omit = "omit" if reject_by_annotation else None
+    data = np.concatenate([
+        raw.get_data(None, i, min(i + length, raw.n_times), reject_by_annotation=omit)[:, ::decim]
+        for i in range(0, raw.n_times, length)[::segment_step]
+    ], axis=1)
+    return RawArray(data, raw.info.copy(), verbose=False)
+
+
+def match_components(ica, reference):
+    """
+    Match the components of two ICA fitted on the same channels, by the absolute correlation of their channel
+    patterns (Hungarian assignment)
+    :param ica: fitted mne ICA
+    :param reference: fitted mne ICA
+    :return: reference component of each matched ica component, absolute correlation of each match
+    """
+    patterns, reference_patterns = ica.get_components(), reference.get_components()
+    n = patterns.shape[1]
+    corr = np.abs(np.corrcoef(patterns.T, reference_patterns.T)[:n, n:])
+    rows, cols = linear_sum_assignment(corr, maximize=True)
+    return cols, corr[rows, cols]
+
+
+def fit_ica(raw, n_components=20, method="fastica", fit_params=None, decim=1, segment_length=10.0,
+            segment_step=1, random_state=None, fit_cache=None, compare=False):
+    """
+    Fit an ICA on decimated and segment subsampled continuous data, see subsample_raw, with mne ICA.fit
+    :param raw: filtered mne Raw
+    :param n_components: number of ICA components
+    :param method: ICA solver, "picard" (python-picard) is the fastest, "fastica", "infomax"
+    :param fit_params: solver parameters, see mne ICA
+    :param decim: decimation of the fit data, the data must be low-passed below sfreq / (2 * decim)
+    :param segment_length: segment length in seconds
+    :param segment_step: one segment in segment_step is used for the fit
+    :param random_state: seed of the solver
+    :param fit_cache: _ica.fif path of the fitted ICA, reused (with a .json key next to it) when fitted again on
+        the same data with the same parameters and mne version, None for no cache. Unseeded fits are not cached
+    :param compare: also fit the ICA on all the data and match the components, slow
+    :return: fitted ICA, report dictionary (fit time, number of samples, whether the fit was cached, and with
+        compare the full fit time and the absolute correlations of the matched components)
+    """
+    start = time.time()
+    fit_raw = subsample_raw(raw, decim=decim, segment_length=segment_length, segment_step=segment_step)
+
+    key = None
+    if fit_cache is not None and random_state is not None:
+        fit_cache = Path(fit_cache)
+        digest = hashlib.blake2b(np.ascontiguousarray(fit_raw.get_data()))
+        digest.update(json.dumps([
+            fit_raw.ch_names, raw.info["bads"], n_components, method, fit_params, random_state, mne.__version__
+        ], default=str).encode())
+        key = digest.hexdigest()
+    cached = key is not None and fit_cache.exists() and fit_cache.with_suffix(".json").exists() and \
+        json.loads(fit_cache.with_suffix(".json").read_text()).get("key") == key
+    if cached:
+        ica = read_ica(fit_cache, verbose=False)
+    else:
+        ica = ICA(n_components=n_components, method=method, fit_params=fit_params, random_state=random_state)
+        ica.fit(fit_raw)
+        if key is not None:
+            ica.save(fit_cache, overwrite=True, verbose=False)
+            fit_cache.with_suffix(".json").write_text(json.dumps({"key": key}))
+    report = {"fit_time": time.time() - start, "n_samples": ica.n_samples_, "fit_cached": cached}
+    del fit_raw
+
+    if compare:
+        reference = ICA(n_components=n_components, method=method, fit_params=fit_params, random_state=random_state)
+        start = time.time()
+        reference.fit(raw)
+        report["full_fit_time"] = time.time() - start
+        report["full_n_samples"] = reference.n_samples_
+        report["match"] = match_components(ica, reference)[1].tolist()
+    return ica, report
@@ -0,0 +1,139 @@
+import os
+import hashlib
+import numpy as np
+from pathlib import Path
+from mne import pick_types, pick_info, pick_channels
+from mne.io import RawArray
+from mne.preprocessing import read_ica
+from tools.catalogue import derived_cache_path
+
+
+def ica_projection(ica):
+    """
+    ICA.apply as one affine map of the ICA channels, cleaned = matrix @ data + offset, with the excluded components
+    of the ICA. Built from the fitted attributes with the steps of ICA.apply: pre-whitening, PCA mean, unmixing of
+    the first n_pca_components PCA components, excluded components zeroed and residual PCA components kept
+    :param ica: fitted mne ICA
+    :return: matrix (channels x channels), offset (channels), ICA channel names, compensation grade of the ICA
+    """
+    if ica.noise_cov is None and any(i["active"] for i in ica.info["projs"]):
+        raise ValueError("ICA with active projectors, use ICA.apply")
+
+    n_components = ica.n_components_
+    n_max = ica.pca_components_.shape[0]
+    n_pca = ica.n_pca_components
+    if isinstance(n_pca, float):
+        # number of components explaining this fraction of the variance, as ICA.apply
+        explained = np.cumsum(np.asarray(ica.pca_explained_variance_, dtype=np.float64))
+        n_pca = min(np.sum(explained / explained[-1] <= n_pca) + 1, n_max)
+    elif n_pca is None:
+        n_pca = n_max
+    n_pca = max(int(n_pca), n_components)
+    if n_pca > n_max:
+        raise ValueError(f"n_pca_components ({n_pca}) must be <= the total number of PCA components ({n_max})")
+
+    pca_components = ica.pca_components_[:n_pca]
+    unmixing = np.eye(n_pca)
+    unmixing[:n_components, :n_components] = ica.unmixing_matrix_
+    unmixing = unmixing @ pca_components
+    mixing = np.eye(n_pca)
+    mixing[:n_components, :n_components] = ica.mixing_matrix_
+    mixing = pca_components.T @ mixing
+    keep = np.concatenate([np.setdiff1d(np.arange(n_components), ica.exclude), np.arange(n_components, n_pca)])
+    proj = mixing[:, keep] @ unmixing[keep]
+
+    # pre-whitening and PCA mean around the projection
+    mean = np.zeros(len(ica.ch_names)) if ica.pca_mean_ is None else ica.pca_mean_
+    if ica.noise_cov is None:
+        whitener = np.diag(1 / ica.pre_whitener_[:, 0])
+        unwhitener = np.diag(ica.pre_whitener_[:, 0])
+    else:
+        whitener = ica.pre_whitener_
+        unwhitener = np.linalg.pinv(ica.pre_whitener_, rcond=1e-14)
+    matrix = unwhitener @ proj @ whitener
+    offset = unwhitener @ (mean - proj @ mean)
+    grade = pick_info(ica.info, pick_channels(ica.info["ch_names"], ica.ch_names)).compensation_grade or 0
+    return matrix, offset, list(ica.ch_names), grade
+
+
+def _ica_picks(info, ch_names):
+    # the ICA channels in raw order, as ICA.apply
+    return pick_types(info, meg=False, include=ch_names, exclude=[], ref_meg=False)
+
+
+def load_ica_projection(ica_path, cache_dir=None):
+    """
+    ICA projection of an ICA file, cached in one .npz file per ICA file, keyed by the excluded components and the
+    ICA file hash and overwritten when they change
+    :param ica_path: ICA .fif path
+    :param cache_dir: cache directory, the local cache directory of the catalogue if None (see
+        tools.catalogue.derived_cache_path), not the processed data directory
+    :return: matrix, offset, ICA channel names, compensation grade, see ica_projection
+    """
+    ica_path = Path(ica_path)
+    ica = read_ica(ica_path, verbose=False)
+    digest = hashlib.sha256(ica_path.read_bytes())
+    digest.update(str(sorted(int(i) for i in ica.exclude)).encode())
+    key = digest.hexdigest()
+    if cache_dir is None:
+        path = derived_cache_path(ica_path, "_proj.npz")
+    else:
+        path = Path(cache_dir).joinpath(f"{ica_path.stem}_proj.npz")
+    if path.exists():
+        try:
+            with np.load(path) as cached:
+                if "key" in cached and str(cached["key"]) == key:
+                    return (
+                        cached["matrix"], cached["offset"], [str(i) for i in cached["ch_names"]], int(cached["grade"])
+                    )
+        except (OSError, ValueError, EOFError):
+            pass
+    matrix, offset, ch_names, grade = ica_projection(ica)
+    # written under a temporary name and renamed, other processes never read a partly written file
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, matrix=matrix, offset=offset, ch_names=np.array(ch_names), grade=grade, key=key)
+    os.replace(tmp_path, path)
+    return matrix, offset, ch_names, grade
+
+
+def apply_ica_projection(raw, projection, n_block=10000, dtype=np.float32):
+    """
+    Apply an ICA projection to preloaded continuous data, in place, n_block samples at a time
+    :param raw: preloaded mne Raw, with the compensation grade of the ICA
+    :param projection: matrix, offset, ICA channel names, compensation grade, see ica_projection
+    :param n_block: number of samples per block
+    :param dtype: data type of the block products, float32 halves the memory traffic of the matrix products
+    :return: raw
+    """
+    matrix, offset, ch_names, grade = projection
+    picks = _ica_picks(raw.info, ch_names)
+    # as ICA.apply, on the ICA channels
+    raw_grade = pick_info(raw.info, picks).compensation_grade or 0
+    if raw_grade != grade:
+        raise RuntimeError(f"Compensation grade of ICA ({grade}) and Raw ({raw_grade}) do not match")
+    matrix = matrix.astype(dtype)
+    offset = offset.astype(dtype)[:, None]
+    for start in range(0, raw.n_times, n_block):
+        stop = min(start + n_block, raw.n_times)
+        block = raw[picks, start:stop][0].astype(dtype)
+        raw[picks, start:stop] = matrix @ block + offset
+    return raw
+
+
+def check_ica_projection(raw, ica, projection, duration=10.0, rtol=1e-4):
+    """
+    Compare apply_ica_projection with ICA.apply on the first seconds of the data, raises an AssertionError if they
+    differ by more than the float32 block products
+    :param raw: preloaded mne Raw, not cleaned yet, unchanged
+    :param ica: fitted mne ICA the projection was built from
+    :param projection: see ica_projection
+    :param duration: seconds of data compared
+    :param rtol: tolerance relative to the largest cleaned value
+    """
+    stop = min(raw.n_times, int(duration * raw.info["sfreq"]))
+    picks = _ica_picks(raw.info, projection[2])
+    expected = ica.apply(RawArray(raw.get_data(stop=stop), raw.info, verbose=False), verbose=False)
+    expected = expected.get_data(picks)
+    cleaned = apply_ica_projection(RawArray(raw.get_data(stop=stop), raw.info, verbose=False), projection)
+    cleaned = cleaned.get_data(picks)
+    np.testing.assert_allclose(cleaned, expected, rtol=0, atol=rtol * np.max(np.abs(expected)))
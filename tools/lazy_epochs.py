@@ -0,0 +1,195 @@
+import os
+import hashlib
+import numpy as np
+from pathlib import Path
+from mne import read_epochs
+from tools.catalogue import derived_cache_path
+
+
+def _normalize(key, n):
+    # int, slice, boolean mask or index array -> index array, and whether the axis is kept
+    if isinstance(key, (int, np.integer)):
+        return np.arange(n)[[key]], False
+    return np.arange(n)[key], True
+
+
+def block_cache_path(fif_path, channels, cache_dir=None):
+    """
+    :param fif_path: epochs .fif path
+    :param channels: channel names
+    :param cache_dir: cache directory, the local cache directory of the catalogue if None (see
+        tools.catalogue.derived_cache_path), not the processed data directory
+    :return: .npy path of the channel subset of the epochs
+    """
+    fif_path = Path(fif_path)
+    digest = hashlib.sha256("\n".join(channels).encode()).hexdigest()[:12]
+    if cache_dir is None:
+        return derived_cache_path(fif_path, f"_ch-{digest}.npy")
+    return Path(cache_dir).joinpath(f"{fif_path.stem}_ch-{digest}.npy")
+
+
+def load_block(fif_path, channels, cache_dir=None, n_batch=32):
+    """
+    Memory-mapped data of a subset of channels of an epochs file, channel major (channels x trials x times,
+    float32). Written once, n_batch epochs at a time, rewritten when the .fif file is newer. Writing it removes
+    the files of other channel subsets of the same block, so at most one file per block is left
+    :param fif_path: epochs .fif path
+    :param channels: channel names
+    :param cache_dir: cache directory, see block_cache_path
+    :param n_batch: number of epochs read at once
+    :return: read-only memmap, the Epochs read without data
+    """
+    epochs = read_epochs(fif_path, preload=False, verbose=False)
+    path = block_cache_path(fif_path, channels, cache_dir)
+    if not path.exists() or path.stat().st_mtime < Path(fif_path).stat().st_mtime:
+        n_trials, n_times = len(epochs.events), len(epochs.times)
+        tmp_path = path.with_name(path.stem + f".{os.getpid()}.tmp.npy")
+        data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(channels), n_trials, n_times))
+        for start in range(0, n_trials, n_batch):
+            stop = min(start + n_batch, n_trials)
+            batch = epochs.get_data(picks=channels, item=slice(start, stop), verbose=False)
+            data[:, start:stop] = batch.transpose(1, 0, 2)
+        data.flush()
+        del data
+        os.replace(tmp_path, path)
+        prefix = path.name[:path.name.rindex("_ch-") + 4]
+        for old in path.parent.glob("*_ch-*.npy"):
+            # files being written by other processes end with .tmp.npy
+            if old.name.startswith(prefix) and old != path and not old.name.endswith(".tmp.npy"):
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+    return np.load(path, mmap_mode="r"), epochs
+
+
+class SubjectEpochs:
+    """
+    Virtual (trials, channels, times) array of the epochs of several blocks, for a subset of channels. Each block
+    is a memory-mapped channel major .npy file (see `load_block`) and the baseline is subtracted when data is
+    read, so only the indexed data is loaded. Same values as
+    concatenate_epochs([read_epochs(i).apply_baseline(baseline) for i in fif_paths]).get_data(picks=channels)
+    cast to float32, the events sample column is offset per block as by concatenate_epochs(add_offset=True).
+    """
+
+    def __init__(self, fif_paths, channels, baseline=None, cache_dir=None):
+        """
+        :param fif_paths: epochs .fif paths, in concatenation order
+        :param channels: channel names
+        :param baseline: (bmin, bmax) in seconds, None for no baseline correction
+        :param cache_dir: directory of the .npy block files, see block_cache_path
+        """
+        self.channels = list(channels)
+        self.baseline = baseline
+        self.blocks = []
+        events = []
+        for fif_path in fif_paths:
+            data, epochs = load_block(fif_path, self.channels, cache_dir)
+            self.blocks.append(data)
+            events.append(epochs.events.copy())
+        self.ch_names = self.channels
+        self.times = epochs.times
+        self.sfreq = epochs.info["sfreq"]
+        self.dtype = np.dtype(np.float32)
+
+        # events offset as by concatenate_epochs
+        shift = np.int64((10 + epochs.tmax) * self.sfreq)
+        events_offset = np.int64(0)
+        for evs in events:
+            if len(evs):
+                max_timestamp = int(np.max(evs[:, 0]))
+                evs[:, 0] += events_offset
+                events_offset += max_timestamp + shift
+        self.events = np.concatenate(events) if len(events) else np.zeros((0, 3), dtype=int)
+
+        self.block_starts = np.cumsum([0] + [i.shape[1] for i in self.blocks])
+        self.shape = (int(self.block_starts[-1]), len(self.channels), len(self.times))
+
+        # baseline means of each block, channels x trials
+        self._means = None
+        if baseline is not None:
+            bmin, bmax = baseline
+            imin = 0 if bmin is None else int(np.where(self.times >= bmin)[0][0])
+            imax = len(self.times) if bmax is None else int(np.where(self.times <= bmax)[0][-1]) + 1
+            self._means = [np.mean(i[..., imin:imax], axis=-1, dtype=np.float64) for i in self.blocks]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read(self, trials, channels, times):
+        # channels x trials x times, baseline corrected
+        out = np.empty((len(channels), len(trials), len(np.arange(self.shape[2])[times])), dtype=self.dtype)
+        block_ix = np.searchsorted(self.block_starts, trials, side="right") - 1
+        for block in np.unique(block_ix):
+            rows = np.where(block_ix == block)[0]
+            local = trials[rows] - self.block_starts[block]
+            data = self.blocks[block][np.ix_(channels, local)][..., times].astype(np.float64)
+            if self._means is not None:
+                data -= self._means[block][np.ix_(channels, local)][..., None]
+            out[:, rows] = data
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        trials, keep_trials = _normalize(key[0], self.shape[0])
+        channels, keep_channels = _normalize(key[1], self.shape[1])
+        times = key[2] if isinstance(key[2], slice) else _normalize(key[2], self.shape[2])[0]
+        data = self._read(trials, channels, times).transpose(1, 0, 2)
+        if isinstance(key[2], (int, np.integer)):
+            data = data[..., 0]
+        if not keep_channels:
+            data = data[:, 0]
+        if not keep_trials:
+            data = data[0]
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def get_data(self):
+        """
+        :return: all the data (trials x channels x times)
+        """
+        return self[:]
+
+    def channel_data(self, channel):
+        """
+        :param channel: channel index
+        :return: baseline corrected data of one channel (trials x times)
+        """
+        return self._read(np.arange(self.shape[0]), np.array([channel]), slice(None))[0]
+
+    def channel_major(self):
+        """
+        :return: channels x trials x times view, reading one channel at a time
+        """
+        return ChannelMajorView(self)
+
+
+class ChannelMajorView:
+    """
+    Channel major (channels, trials, times) view of a SubjectEpochs, indexing or iterating over the channels
+    loads one channel at a time
+    """
+
+    def __init__(self, epochs):
+        self.epochs = epochs
+        self.shape = (epochs.shape[1], epochs.shape[0], epochs.shape[2])
+        self.dtype = epochs.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, channel):
+        return self.epochs.channel_data(channel)
+
+    def __iter__(self):
+        for channel in range(self.shape[0]):
+            yield self.epochs.channel_data(channel)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.stack(list(self))
+        return data if dtype is None else data.astype(dtype)
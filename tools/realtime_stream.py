@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import socket
+import struct
+import tempfile
+import threading
+import numpy as np
+from mne import pick_types, events_from_annotations
+from mne.io import read_raw_fif
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "real_time_confidence_stream.sock")
+
+# block header: first sample, number of samples (0 ends the stream), send time
+BLOCK_HEADER = struct.Struct("<qid")
+
+# trigger channel of the CTF recordings, rebuilt from the annotations when the processed file has none
+STIM_CHANNEL = "UDIO001"
+
+
+class RingBuffer:
+    """
+    Preallocated multichannel ring buffer for one writer thread and any number of reader threads, without locks.
+    Every sample is stored twice, at its position and `capacity` samples later, so that any window of up to
+    `capacity` samples is one contiguous block and is returned as a view. The writer copies a block in and only
+    then advances `n_written`, readers only read samples below `n_written`. A view stays valid until the writer
+    wraps around it, `valid(start)` tells whether a window starting at `start` was overwritten while it was used.
+    """
+
+    def __init__(self, n_channels, capacity, dtype=np.float32):
+        """
+        :param n_channels: number of channels
+        :param capacity: number of samples kept
+        :param dtype: sample data type
+        """
+        self.capacity = int(capacity)
+        self.data = np.zeros((n_channels, 2 * self.capacity), dtype=dtype)
+        self.n_written = 0
+
+    def write(self, block):
+        """
+        :param block: new samples (channels x time), at most capacity samples
+        """
+        n = block.shape[1]
+        if n > self.capacity:
+            raise ValueError(f"block of {n} samples larger than the buffer ({self.capacity})")
+        pos = self.n_written % self.capacity
+        split = min(n, self.capacity - pos)
+        self.data[:, pos:pos + n] = block
+        self.data[:, self.capacity + pos:self.capacity + pos + split] = block[:, :split]
+        self.data[:, :n - split] = block[:, split:]
+        self.n_written += n
+
+    def valid(self, start):
+        """
+        :param start: first sample (stream index) of a window
+        :return: whether the window is still in the buffer
+        """
+        return start >= self.n_written - self.capacity
+
+    def window(self, start, stop):
+        """
+        :param start: first sample (stream index)
+        :param stop: sample after the last one, at most n_written
+        :return: view of the samples (channels x time), without copy
+        """
+        if stop > self.n_written:
+            raise ValueError(f"sample {stop} not written yet ({self.n_written})")
+        if stop < start or not self.valid(start):
+            raise ValueError(f"samples {start}-{stop} not in the buffer ({self.n_written - self.capacity}-{self.n_written})")
+        pos = start % self.capacity
+        return self.data[:, pos:pos + stop - start]
+
+    def latest(self, n):
+        """
+        :param n: number of samples
+        :return: first sample (stream index) and view of the last n samples written
+        """
+        stop = self.n_written
+        start = max(stop - n, 0)
+        return start, self.window(start, stop)
+
+    def wait(self, n_samples, timeout=None, poll=5e-4):
+        """
+        Sleep until n_samples were written
+        :param n_samples: number of samples
+        :param timeout: in s, None to wait forever
+        :param poll: time between the checks, in s
+        :return: whether the samples were written
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.n_written < n_samples:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+
+class TriggerDecoder:
+    """
+    Incremental trigger decoding, same events as find_events (onsets of increases of the trigger value, none at the
+    first sample) named as annotations_from_events with the trigger mapping (unmapped codes are dropped)
+    """
+
+    def __init__(self, trigger_mapping):
+        """
+        :param trigger_mapping: trigger code -> event name, e.g. trigger_mapping.json with integer keys
+        """
+        self.trigger_mapping = {int(i): trigger_mapping[i] for i in trigger_mapping.keys()}
+        self.last = None
+
+    def decode(self, values, first_sample):
+        """
+        :param values: trigger channel samples of a block
+        :param first_sample: stream index of the first sample
+        :return: list of (sample, code, name) of the events starting in the block
+        """
+        values = np.rint(values).astype(np.int64)
+        previous = np.concatenate([[values[0] if self.last is None else self.last], values[:-1]])
+        self.last = values[-1]
+        onsets = np.where((values > previous) & (values != 0))[0]
+        return [
+            (first_sample + int(i), int(values[i]), self.trigger_mapping[int(values[i])])
+            for i in onsets if int(values[i]) in self.trigger_mapping
+        ]
+
+
+def replay_trigger(raw, trigger_mapping, pulse=0.01):
+    """
+    Trigger channel rebuilt from the annotations of a processed recording
+    :param raw: mne Raw with the annotations of annotations_from_events
+    :param trigger_mapping: trigger code -> event name
+    :param pulse: duration of each trigger pulse, in s
+    :return: trigger values (time)
+    """
+    event_id = {name: int(code) for code, name in trigger_mapping.items()}
+    trigger = np.zeros(raw.n_times, dtype=np.float32)
+    if not any(i in event_id for i in raw.annotations.description):
+        return trigger
+    events, _ = events_from_annotations(raw, event_id=event_id, verbose=False)
+    n_pulse = max(int(round(pulse * raw.info["sfreq"])), 1)
+    for sample, _, code in events:
+        sample -= raw.first_samp
+        trigger[sample:sample + n_pulse] = code
+    return trigger
+
+
+class ReplayProducer:
+    """
+    Stand-in for the CTF real-time server: replays a recording over a local Unix socket, block by block at
+    real-time or accelerated speed. The stream starts with one JSON header line (sampling rate, channel names and
+    types, trigger channel index, block size, number of samples), then each block is a BLOCK_HEADER followed by the
+    float32 samples (channels x time, C order), and a header with 0 samples ends the stream. Processed recordings
+    have no trigger channel, one is appended from the annotations and the trigger mapping.
+    """
+
+    def __init__(self, raw_path, trigger_mapping, socket_path=DEFAULT_SOCKET, block_ms=50, speed=1.0,
+                 read_chunk=10.0):
+        """
+        :param raw_path: processed realtime_sub-*_raw.fif path
+        :param trigger_mapping: trigger code -> event name
+        :param socket_path: Unix socket the producer listens on
+        :param block_ms: block duration in ms
+        :param speed: replay speed relative to real time, None as fast as possible
+        :param read_chunk: seconds of data read from the file at once
+        """
+        self.raw = read_raw_fif(raw_path, preload=False, verbose=False)
+        self.socket_path = socket_path
+        self.speed = speed
+        sfreq = float(self.raw.info["sfreq"])
+        self.block_size = max(int(round(sfreq * block_ms / 1000)), 1)
+        self.read_chunk = max(int(read_chunk * sfreq) // self.block_size, 1) * self.block_size
+
+        self.ch_names = list(self.raw.ch_names)
+        ch_types = self.raw.get_channel_types()
+        stim = pick_types(self.raw.info, meg=False, stim=True, exclude=[])
+        self.trigger = None
+        if len(stim):
+            self.stim_channel = int(stim[0])
+        else:
+            self.trigger = replay_trigger(self.raw, trigger_mapping)
+            self.stim_channel = len(self.ch_names)
+            self.ch_names.append(STIM_CHANNEL)
+            ch_types.append("stim")
+        self.header = {
+            "sfreq": sfreq, "ch_names": self.ch_names, "ch_types": ch_types, "stim_channel": self.stim_channel,
+            "block_size": self.block_size, "n_times": int(self.raw.n_times)
+        }
+        self._listening = threading.Event()
+
+    def _chunks(self):
+        # float32 channels x time, read_chunk samples at a time
+        for start in range(0, self.raw.n_times, self.read_chunk):
+            stop = min(start + self.read_chunk, self.raw.n_times)
+            chunk = np.empty((len(self.ch_names), stop - start), dtype=np.float32)
+            chunk[:self.raw.info["nchan"]] = self.raw.get_data(start=start, stop=stop)
+            if self.trigger is not None:
+                chunk[-1] = self.trigger[start:stop]
+            yield start, chunk
+
+    def stream(self, connection):
+        """
+        Send the recording on a connected socket
+        :param connection: connected socket
+        """
+        connection.sendall((json.dumps(self.header) + "\n").encode())
+        start_time = time.monotonic()
+        for chunk_start, chunk in self._chunks():
+            for offset in range(0, chunk.shape[1], self.block_size):
+                block = np.ascontiguousarray(chunk[:, offset:offset + self.block_size])
+                first = chunk_start + offset
+                if self.speed is not None:
+                    # the block is sent once its last sample has been acquired
+                    delay = start_time + (first + block.shape[1]) / (self.header["sfreq"] * self.speed) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                connection.sendall(BLOCK_HEADER.pack(first, block.shape[1], time.time()))
+                connection.sendall(block.data)
+        connection.sendall(BLOCK_HEADER.pack(self.raw.n_times, 0, time.time()))
+
+    def serve(self, n_clients=1):
+        """
+        Replay the recording to n_clients clients, one after the other
+        :param n_clients: number of connections served before returning
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.socket_path)
+            server.listen(1)
+            self._listening.set()
+            try:
+                for _ in range(n_clients):
+                    connection, _ = server.accept()
+                    with connection:
+                        try:
+                            self.stream(connection)
+                        except (BrokenPipeError, ConnectionResetError):
+                            pass
+            finally:
+                os.unlink(self.socket_path)
+
+    def serve_in_thread(self, n_clients=1):
+        """
+        :param n_clients: number of connections served
+        :return: started daemon thread of serve, listening when returned
+        """
+        thread = threading.Thread(target=self.serve, args=(n_clients,), daemon=True)
+        thread.start()
+        self._listening.wait()
+        return thread
+
+
+def _recv_into(connection, view):
+    while len(view):
+        n = connection.recv_into(view)
+        if n == 0:
+            raise ConnectionError("stream closed")
+        view = view[n:]
+
+
+class StreamClient:
+    """
+    Receives a ReplayProducer (or real-time server) stream into a RingBuffer from a background thread and decodes
+    the triggers as they arrive. Blocks are received into one preallocated buffer and copied once, into the ring
+    buffer, readers use the zero-copy windows of `ring`.
+    """
+
+    def __init__(self, trigger_mapping, socket_path=DEFAULT_SOCKET, capacity=60.0, connect_timeout=10.0):
+        """
+        :param trigger_mapping: trigger code -> event name
+        :param socket_path: Unix socket of the producer
+        :param capacity: seconds of data kept in the ring buffer
+        :param connect_timeout: seconds to wait for the producer
+        """
+        self.trigger_mapping = trigger_mapping
+        self.socket_path = socket_path
+        self.capacity = capacity
+        self.connect_timeout = connect_timeout
+        self.info = None
+        self.ring = None
+        # (sample, code, name), appended by the receiver thread
+        self.events = []
+        # transport delay of each block (receive time - send time), in s
+        self.delays = []
+        self.finished = threading.Event()
+        # exception that ended the stream early, None when the stream ended or was stopped
+        self.error = None
+        self._stopping = False
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        """
+        Connect, read the stream header, allocate the ring buffer and start receiving
+        :return: self
+        """
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self._socket.connect(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        header = b""
+        while not header.endswith(b"\n"):
+            byte = self._socket.recv(1)
+            if not byte:
+                raise ConnectionError("stream closed before its header")
+            header += byte
+        self.info = json.loads(header)
+        n_channels = len(self.info["ch_names"])
+        capacity = max(int(self.capacity * self.info["sfreq"]), self.info["block_size"])
+        self.ring = RingBuffer(n_channels, capacity)
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+        return self
+
+    def _receive(self):
+        decoder = TriggerDecoder(self.trigger_mapping)
+        n_channels = len(self.info["ch_names"])
+        block = np.empty(n_channels * self.info["block_size"], dtype=np.float32)
+        header = bytearray(BLOCK_HEADER.size)
+        stim = self.info["stim_channel"]
+        try:
+            while True:
+                _recv_into(self._socket, memoryview(header))
+                first, n, sent = BLOCK_HEADER.unpack(header)
+                if n == 0:
+                    break
+                samples = block[:n_channels * n].reshape(n_channels, n)
+                _recv_into(self._socket, memoryview(samples).cast("B"))
+                if first != self.ring.n_written:
+                    raise ConnectionError(f"block starts at {first}, expected {self.ring.n_written}")
+                self.ring.write(samples)
+                self.delays.append(time.time() - sent)
+                if stim is not None:
+                    self.events += decoder.decode(samples[stim], first)
+        except (ConnectionError, OSError) as error:
+            if not self._stopping:
+                self.error = error
+        finally:
+            self.finished.set()
+
+    def stop(self):
+        """
+        Close the connection and wait for the receiver thread
+        """
+        self._stopping = True
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
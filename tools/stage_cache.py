@@ -0,0 +1,128 @@
+import json
+import time
+import inspect
+import hashlib
+import numpy as np
+from pathlib import Path
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Path):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f"Parameter of type {type(obj).__name__} can not be hashed")
+
+
+def file_fingerprint(path, hash_mode="mtime"):
+    """
+    Fingerprint of a file or of a directory (e.g. a CTF .ds), all its files in name order
+    :param path: file or directory path
+    :param hash_mode: "mtime" (size and modification time) or "content" (sha256 of the bytes)
+    :return: fingerprint string
+    """
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(i for i in path.rglob("*") if i.is_file())
+    else:
+        files = [path]
+
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(str(file.relative_to(path) if path.is_dir() else file.name).encode())
+        if hash_mode == "content":
+            with open(file, "rb") as f:
+                for block in iter(lambda: f.read(2**24), b""):
+                    digest.update(block)
+        elif hash_mode == "mtime":
+            stat = file.stat()
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        else:
+            raise ValueError(f"Unknown hash_mode {hash_mode}")
+    return digest.hexdigest()
+
+
+def code_files(*objects):
+    """
+    Source files of the project code a stage runs, as cache inputs, so that editing an imported module (not only
+    the stage script) invalidates the outputs
+    :param objects: modules, or functions and classes whose defining module is added
+    :return: list of source file paths, in the given order without duplicates
+    """
+    files = []
+    for obj in objects:
+        file = Path(inspect.getsourcefile(obj)).resolve()
+        if file not in files:
+            files.append(file)
+    return files
+
+
+class StageCache:
+    """
+    Content-addressed cache of one pipeline stage run. The key hashes the stage name, the fingerprints of the
+    inputs and the parameters; a sidecar manifest next to the first output records it with the provenance.
+    A run is skipped when the manifest key matches and all the outputs exist. Outputs edited after the run
+    (e.g. ICA exclusions) are kept, downstream stages see them as changed inputs.
+    """
+
+    def __init__(self, stage, inputs, params, outputs, hash_mode="mtime"):
+        """
+        :param stage: stage name
+        :param inputs: input files or directories, include the stage script and the project modules it
+            uses (see code_files) to invalidate on code changes
+        :param params: JSON serialisable parameters that change the outputs
+        :param outputs: output paths, the manifest is written next to the first one
+        :param hash_mode: input fingerprint, "mtime" or "content", see file_fingerprint
+        """
+        self.stage = stage
+        self.inputs = [Path(i) for i in inputs]
+        self.params = params
+        self.outputs = [Path(i) for i in outputs]
+        self.hash_mode = hash_mode
+        self.manifest_path = self.outputs[0].with_name(self.outputs[0].name + MANIFEST_SUFFIX)
+
+        self.input_fingerprints = {str(i): file_fingerprint(i, hash_mode) for i in self.inputs}
+        self.params_json = json.dumps(params, sort_keys=True, default=_to_json)
+        content = json.dumps([stage, hash_mode, sorted(self.input_fingerprints.items()), self.params_json])
+        self.key = hashlib.sha256(content.encode()).hexdigest()
+
+    def manifest(self):
+        """
+        :return: recorded manifest dictionary, None if missing or unreadable
+        """
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self):
+        """
+        :return: True if the outputs exist and were produced from the same inputs and parameters
+        """
+        manifest = self.manifest()
+        if manifest is None or manifest.get("key") != self.key:
+            return False
+        return all(i.exists() for i in self.outputs)
+
+    def record(self):
+        """
+        Write the manifest of a finished run
+        """
+        manifest = {
+            "stage": self.stage,
+            "key": self.key,
+            "hash_mode": self.hash_mode,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "inputs": self.input_fingerprints,
+            "params": json.loads(self.params_json),
+            "outputs": {str(i): file_fingerprint(i) for i in self.outputs},
+        }
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
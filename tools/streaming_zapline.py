@@ -0,0 +1,184 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import welch, lfilter, lfilter_zi
+from meegkit.dss import dss0
+from meegkit.utils import tscov, gaussfilt
+from tools.realtime_stream import RingBuffer
+
+
+def smooth_kernel(sfreq, fline):
+    """
+    Causal moving average over one line period, as meegkit.utils.smooth(x, sfreq / fline)
+    :param sfreq: sampling rate
+    :param fline: line frequency
+    :return: FIR coefficients
+    """
+    frac, n = np.modf(sfreq / fline)
+    kernel = np.r_[np.ones(int(n)), frac]
+    return kernel / kernel.sum()
+
+
+def fit_zapline_steps(data, sfreq, fline=50.0, win_sz=10, spot_sz=2.5, nfft=512, n_iter_max=100):
+    """
+    The iterations of meegkit.dss.dss_line_iter (with dss_line, nremove=1) as rank one steps. Iteration k removes
+    the component w_k of the line residual N(x) = x - smooth(x) regressed on the channels,
+    x <- x - outer(N(x) @ w_k, beta_k), so the whole cleaning only needs the w_k and beta_k and the state of the
+    moving average. Same stopping rule as dss_line_iter (mean PSD around the line frequency down to the
+    polynomial fit of the spectrum without the line peak), same output up to the channel means.
+    :param data: calibration data (channels x times)
+    :param sfreq: sampling rate
+    :param fline: line frequency
+    :param win_sz: half width of the frequency window of the polynomial fit, see dss_line_iter
+    :param spot_sz: half width of the line peak, see dss_line_iter
+    :param nfft: FFT size of the PSD
+    :param n_iter_max: maximum number of iterations
+    :return: list of (w, beta) steps (empty when the first iteration already brings no improvement), scores
+    """
+    x = np.array(data, dtype=float).T
+    x -= np.mean(x, axis=0)
+    kernel = smooth_kernel(sfreq, fline)
+    n_harm = np.floor((sfreq / 2) / fline).astype(int)
+
+    # clean spectrum estimate, as dss_line_iter
+    freq, psd = welch(x, fs=sfreq, nfft=nfft, axis=0)
+    freq_rn_ix = (freq >= fline - win_sz) & (freq <= fline + win_sz)
+    freq_used = freq[freq_rn_ix]
+    freq_sp_ix = (freq_used >= fline - spot_sz) & (freq_used <= fline + spot_sz)
+    mean_psd = np.mean(psd, axis=1)[freq_rn_ix]
+    mean_psd[freq_sp_ix] = np.interp(freq_used[freq_sp_ix], freq_used[~freq_sp_ix], mean_psd[~freq_sp_ix])
+    clean_fit_line = np.poly1d(np.polyfit(freq_used, mean_psd, 3))(freq_used)
+
+    steps, scores = [], []
+    for iteration in range(n_iter_max):
+        noise = x - lfilter(kernel, 1, x, axis=0)
+        c0 = tscov(noise)[0]
+        c1 = tscov(gaussfilt(noise, sfreq, fline, fwhm=1, n_harm=n_harm))[0]
+        w = dss0(c0, c1)[0][:, 0]
+        # regression of the residual on the component, as tsr
+        artifact = noise @ w
+        artifact_c = artifact - np.mean(artifact)
+        beta = artifact_c @ (noise - np.mean(noise, axis=0)) / (artifact_c @ artifact_c)
+        x -= np.outer(artifact, beta)
+        x -= np.mean(x, axis=0)
+        steps.append((w, beta))
+
+        freq, psd = welch(x, fs=sfreq, nfft=nfft, axis=0)
+        scores.append(np.mean((np.mean(psd, axis=1)[freq_rn_ix] - clean_fit_line)[freq_sp_ix]))
+        if scores[-1] <= 0:
+            # dss_line_iter returns the original data if the first iteration does not improve it
+            return (steps if iteration else []), scores
+    raise RuntimeError("Could not converge. Consider increasing the maximum number of iterations")
+
+
+class StreamingZapline:
+    """
+    Zapline for blocks of a stream: the spatial filters of dss_line_iter are learned on a calibration segment (see
+    fit_zapline_steps) and each block is cleaned with the fixed rank one steps and a causal moving average, a few
+    matrix-vector products per step. With `refit_interval`, the filters are refitted in a background thread on the
+    last `refit_length` seconds of raw data and swapped in at the next block, with the moving averages of the new
+    filters run over the raw data before that block, so the swap adds no transient.
+    """
+
+    def __init__(self, sfreq, n_channels, fline=50.0, win_sz=10, spot_sz=5.5, nfft=1024, n_iter_max=30,
+                 refit_interval=None, refit_length=60.0):
+        """
+        :param sfreq: sampling rate
+        :param n_channels: number of channels of the blocks
+        :param fline: line frequency
+        :param win_sz: see dss_line_iter
+        :param spot_sz: see dss_line_iter
+        :param nfft: see dss_line_iter
+        :param n_iter_max: see dss_line_iter
+        :param refit_interval: seconds of stream between two refits, None for no refit
+        :param refit_length: seconds of raw data the refits are done on
+        """
+        self.sfreq = sfreq
+        self.n_channels = n_channels
+        self.fit_params = dict(fline=fline, win_sz=win_sz, spot_sz=spot_sz, nfft=nfft, n_iter_max=n_iter_max)
+        self.kernel = smooth_kernel(sfreq, fline)
+        self.refit_interval = None if refit_interval is None else int(refit_interval * sfreq)
+        self.history = None
+        if self.refit_interval is not None:
+            self.history = RingBuffer(n_channels, int(refit_length * sfreq), dtype=np.float64)
+        self.steps = []
+        self.scores = []
+        self.n_refits = 0
+        self.refit_error = None
+        self._zi = []
+        self._pool = None
+        self._refit = None
+        self._last_refit = 0
+
+    def _set_steps(self, steps, scores, warm=None):
+        self.steps, self.scores = steps, scores
+        # moving average states, initialised on the next block
+        self._zi = [None] * len(steps)
+        if warm is not None and warm.shape[1]:
+            self._clean(np.array(warm, dtype=float))
+
+    def _n_warm(self, n_steps):
+        # the moving average is a FIR filter, its state only depends on its last len(kernel) - 1 inputs and those
+        # of each step on the outputs of the steps before
+        return n_steps * (len(self.kernel) - 1) + len(self.kernel)
+
+    def _clean(self, y):
+        # cleans y in place, continuing the moving averages
+        for ix, (w, beta) in enumerate(self.steps):
+            artifact = w @ y
+            if self._zi[ix] is None:
+                self._zi[ix] = lfilter_zi(self.kernel, 1) * artifact[0]
+            smoothed, self._zi[ix] = lfilter(self.kernel, 1, artifact, zi=self._zi[ix])
+            y -= np.outer(beta, artifact - smoothed)
+        return y
+
+    def fit(self, data):
+        """
+        Learn the filters on calibration data
+        :param data: calibration data (channels x times)
+        :return: self
+        """
+        self._set_steps(*fit_zapline_steps(data, self.sfreq, **self.fit_params))
+        if self.history is not None:
+            tail = data[:, -self.history.capacity:]
+            self.history.write(tail)
+            self._last_refit = self.history.n_written
+        return self
+
+    def _check_refit(self, n_block):
+        if self._refit is not None and self._refit.done():
+            try:
+                steps, scores = self._refit.result()
+                # raw samples before the current block, to warm the moving averages of the new filters
+                stop = self.history.n_written - n_block
+                start = max(0, stop - self._n_warm(len(steps)), self.history.n_written - self.history.capacity)
+                self._set_steps(steps, scores, warm=self.history.window(start, stop))
+                self.n_refits += 1
+            except Exception as error:
+                # keep the current filters
+                self.refit_error = error
+            self._refit = None
+        if self._refit is None and self.history.n_written - self._last_refit >= self.refit_interval:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=1)
+            n_times = min(self.history.n_written, self.history.capacity)
+            data = np.array(self.history.latest(n_times)[1])
+            self._refit = self._pool.submit(fit_zapline_steps, data, self.sfreq, **self.fit_params)
+            self._last_refit = self.history.n_written
+
+    def process(self, block):
+        """
+        :param block: raw samples (channels x time)
+        :return: cleaned samples (channels x time), float64
+        """
+        if self.history is not None:
+            self.history.write(block)
+            self._check_refit(block.shape[1])
+        return self._clean(np.array(block, dtype=float))
+
+    def close(self):
+        """
+        Wait for a running refit and stop the background thread
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
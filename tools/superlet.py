@@ -8,9 +8,18 @@
 #
 
 
+import os
+import hashlib
+import tempfile
 import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from scipy.fft import fft, ifft, next_fast_len
 from scipy.signal import fftconvolve
 
+# default memory budget of a filter bank, its kernels and spectra
+BANK_MAX_BYTES = 256 * 2**20
+
 
 def superlet(
     data_arr,
@@ -20,6 +29,8 @@ def superlet(
     order_min=1,
     c_1=3,
     adaptive=False,
+    filter_bank=None,
+    magnitude=False,
 ):
 
     """
@@ -67,12 +78,21 @@ def superlet(
         linearly with the frequencies of interest from `order_min` 
         to `order_max`. If set to False the same SL will be used for
         all frequencies.
+    filter_bank : :class:`SuperletFilterBank` or None
+        Optional cache of the sampled wavelets, built for the same
+        parameters, so repeated transforms don't rebuild the kernels.
+        A ValueError is raised if its parameters differ
+    magnitude : bool
+        If set to True only the amplitude is computed, the geometric
+        mean is accumulated from weighted log-magnitudes in a single
+        float32 buffer and exponentiated once at the end
     
     Returns
     -------
     gmean_spec : :class:`numpy.ndarray`
         Complex time-frequency representation of the input data. 
         Shape is (len(scales), data_arr.shape[0], data_arr.shape[1]).
+        float32 amplitude if `magnitude` is True.
 
     Notes
     -----
@@ -82,24 +102,42 @@ def superlet(
  
     """
 
+    if filter_bank is not None:
+        # the kernels depend on the samplerate, scales and cycles only
+        filter_bank.check_key(
+            samplerate, scales, c_1, order_min, order_max, adaptive=adaptive
+        )
+
     # adaptive SLT
     if adaptive:
 
-        gmean_spec = FASLT(data_arr, samplerate, scales, order_max, order_min, c_1)
+        gmean_spec = FASLT(
+            data_arr, samplerate, scales, order_max, order_min, c_1,
+            filter_bank, magnitude
+        )
 
     # multiplicative SLT
     else:
 
         gmean_spec = multiplicativeSLT(
-            data_arr, samplerate, scales, order_max, order_min, c_1
+            data_arr, samplerate, scales, order_max, order_min, c_1,
+            filter_bank, magnitude
         )
 
     return gmean_spec
 
 
-def multiplicativeSLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
+def multiplicativeSLT(
+    data_arr, samplerate, scales, order_max, order_min=1, c_1=3,
+    filter_bank=None, magnitude=False
+):
 
     dt = 1 / samplerate
+
+    if magnitude:
+        cycles, weights = _superlet_weights(scales, order_max, order_min, c_1)
+        return _log_gmean_ampl(data_arr, dt, scales, cycles, weights, filter_bank)
+
     # create the complete multiplicative set spanning
     # order_min - order_max
     cycles = c_1 * np.arange(order_min, order_max + 1)
@@ -107,18 +145,21 @@ def multiplicativeSLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=
     SL = [MorletSL(c) for c in cycles]
 
     # lowest order
-    gmean_spec = cwtSL(data_arr, SL[0], scales, dt)
+    gmean_spec = cwtSL(data_arr, SL[0], scales, dt, filter_bank)
     gmean_spec = np.power(gmean_spec, 1 / order_num)
 
     for wavelet in SL[1:]:
 
-        spec = cwtSL(data_arr, wavelet, scales, dt)
+        spec = cwtSL(data_arr, wavelet, scales, dt, filter_bank)
         gmean_spec *= np.power(spec, 1 / order_num)
 
     return gmean_spec
 
 
-def FASLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
+def FASLT(
+    data_arr, samplerate, scales, order_max, order_min=1, c_1=3,
+    filter_bank=None, magnitude=False
+):
 
     """ Fractional adaptive SL transform
 
@@ -127,9 +168,18 @@ def FASLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
     
     R(o_f) = R_1 * R_2 * ... * R_i * R_i+1 ** alpha 
     with o_f = o_i + alpha
+
+    With `magnitude` only |R(o_f)| is computed in the log domain.
     """
 
     dt = 1 / samplerate
+
+    if magnitude:
+        cycles, weights = _superlet_weights(
+            scales, order_max, order_min, c_1, adaptive=True
+        )
+        return _log_gmean_ampl(data_arr, dt, scales, cycles, weights, filter_bank)
+
     # frequencies of interest
     # from the scales for the SL Morlet
     fois = 1 / (2 * np.pi * scales)
@@ -155,7 +205,7 @@ def FASLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
 
     # 1st order
     # lowest order is needed for all scales/frequencies
-    gmean_spec = cwtSL(data_arr, SL[0], scales, dt)  # 1st order <-> order_min
+    gmean_spec = cwtSL(data_arr, SL[0], scales, dt, filter_bank)  # 1st order <-> order_min
     # Geometric normalization according to scale dependent order
     gmean_spec = np.power(gmean_spec.T, exponents).T
 
@@ -168,7 +218,7 @@ def FASLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
         # relevant scales for the next order
         scales_o = scales[last_jump:]
         # order + 1 spec
-        next_spec = cwtSL(data_arr, SL[i + 1], scales_o, dt)
+        next_spec = cwtSL(data_arr, SL[i + 1], scales_o, dt, filter_bank)
 
         # which fractions for the current next_spec
         # in the interval [order, order+1)
@@ -190,6 +240,32 @@ def FASLT(data_arr, samplerate, scales, order_max, order_min=1, c_1=3):
     return gmean_spec
 
 
+def _log_gmean_ampl(data_arr, dt, scales, cycles, weights, filter_bank=None):
+
+    """
+    Amplitude of the geometric mean of the superlet set, accumulated
+    as weighted log-magnitudes of every wavelet transform.
+    """
+
+    scales = np.asarray(scales)
+    log_ampl = np.zeros((len(scales),) + data_arr.shape, dtype=np.float32)
+    # weights broadcast along the data dimensions
+    w_shape = (-1,) + (1,) * data_arr.ndim
+
+    for c, w in zip(cycles, weights):
+
+        used = np.nonzero(w)[0]
+        spec = cwtSL(data_arr, MorletSL(c), scales[used], dt, filter_bank)
+        ampl = np.abs(spec)
+        del spec
+        with np.errstate(divide="ignore"):
+            np.log(ampl, out=ampl)
+        ampl *= w[used].reshape(w_shape).astype(np.float32)
+        log_ampl[used] += ampl
+
+    return np.exp(log_ampl, out=log_ampl)
+
+
 class MorletSL:
     def __init__(self, c_i=3, k_sd=5):
 
@@ -256,7 +332,7 @@ def scale_from_period(period):
     return period / (2 * np.pi)
 
 
-def cwtSL(data, wavelet, scales, dt):
+def cwtSL(data, wavelet, scales, dt, filter_bank=None):
 
     """
     The continuous Wavelet transform specifically
@@ -268,6 +344,8 @@ def cwtSL(data, wavelet, scales, dt):
     - this way the norm of the spectrum (modulus) 
       at the corresponding harmonic frequency is the 
       harmonic signal's amplitude
+    - the sampled wavelets are taken from `filter_bank`
+      when one is given
 
     Notes
     -----
@@ -289,10 +367,13 @@ def cwtSL(data, wavelet, scales, dt):
     # compute in time
     for ind, scale in enumerate(scales):
 
-        t = _get_superlet_support(scale, dt, wavelet.c_i)
-        # sample wavelet and normalise
-        norm = dt ** 0.5 / (4 * np.pi)
-        wavelet_data = norm * wavelet(t, scale)  # this is an 1d array for sure!
+        if filter_bank is not None:
+            wavelet_data = filter_bank.kernel(scale, wavelet.c_i)
+        else:
+            t = _get_superlet_support(scale, dt, wavelet.c_i)
+            # sample wavelet and normalise
+            norm = dt ** 0.5 / (4 * np.pi)
+            wavelet_data = norm * wavelet(t, scale)  # this is an 1d array for sure!
         output[ind, :] = fftconvolve(data, wavelet_data[tuple(slices)], mode="same")
 
     return output
@@ -337,6 +418,653 @@ def compute_adaptive_order(freq, order_min, order_max):
     return order_min + order
 
 
+def superlet_batch(
+    data_arr,
+    samplerate,
+    scales,
+    order_max,
+    order_min=1,
+    c_1=3,
+    adaptive=False,
+    n_batch=64,
+    filter_bank=None,
+    scale_ix=None,
+    decim=1,
+):
+
+    """
+    Batched amplitude-only Superlet Transform for many signals at once.
+
+    Gives the same amplitudes as ``np.abs(superlet(...))`` applied to every
+    signal separately, but each batch of signals is Fourier transformed
+    only once per FFT length and the spectrum of every wavelet is reused
+    across all the signals of the batch. Only the amplitude is accumulated,
+    so no complex (scales, signals, time) array is ever allocated.
+
+    Parameters
+    ----------
+    data_arr : nD :class:`numpy.ndarray`
+        Uniformly sampled time-series data, e.g. (trials, channels, times).
+        The last dimension is interpreted as the time axis
+    samplerate : float
+        Samplerate of the time-series in Hz
+    scales : 1D :class:`numpy.ndarray`
+        Set of scales to use in wavelet transform, see :func:`superlet`
+    order_max : int
+        Maximal order of the superlet set
+    order_min : int
+        Minimal order of the superlet set
+    c_1 : int
+        Number of cycles of the base Morlet wavelet
+    adaptive : bool
+        Wether to perform multiplicative SLT or fractional adaptive SLT
+    n_batch : int
+        Number of signals transformed together, bounds the memory
+        of the frequency domain buffers
+    filter_bank : :class:`SuperletFilterBank` or None
+        Cache of the wavelet spectra built for the same parameters,
+        number of samples, `scale_ix` and `decim`, a temporary one is
+        created if not given. A ValueError is raised if its parameters
+        differ
+    scale_ix : 1D array of int or None
+        Indices of the scales to compute. The adaptive orders are
+        still derived from all the `scales`, so the rows are identical
+        to the corresponding rows of the full transform
+    decim : int or 1D array of int
+        Output decimation in time, one value for all the computed
+        scales or one per scale. The decimated samples are obtained
+        directly from a shorter inverse FFT
+
+    Returns
+    -------
+    ampl : :class:`numpy.ndarray` or list
+        float32 amplitude of the time-frequency representation.
+        Shape is data_arr.shape[:-1] + (n_scales, n_times / decim).
+        With different decimations per scale a list with one
+        data_arr.shape[:-1] + (n_times / decim,) array per scale.
+    """
+
+    lead_shape = data_arr.shape[:-1]
+    n_times = data_arr.shape[-1]
+    signals = data_arr.reshape(-1, n_times)
+
+    if filter_bank is None:
+        filter_bank = SuperletFilterBank(
+            samplerate, scales, order_max, order_min, c_1, adaptive, n_times,
+            scale_ix=scale_ix, decim=decim
+        )
+    else:
+        filter_bank.check_key(
+            samplerate, scales, c_1, order_min, order_max, n_times, adaptive,
+            scale_ix, decim
+        )
+
+    decims = filter_bank.decim
+    n_rows = len(decims)
+    n_out = [len(range(0, n_times, d)) for d in decims]
+
+    # geometric mean accumulated as weighted log-magnitudes
+    if len(set(decims)) == 1:
+        ampl = np.zeros((signals.shape[0], n_rows, n_out[0]), dtype=np.float32)
+        rows = [ampl[:, r] for r in range(n_rows)]
+    else:
+        rows = [np.zeros((signals.shape[0], n), dtype=np.float32) for n in n_out]
+
+    # FFT length groups outermost, each group of spectra is fetched once
+    # per call, so a bank larger than the cache is not evicted mid-call
+    for n_fft, pairs in filter_bank.groups.items():
+        spectra = filter_bank.spectra(n_fft)
+
+        for start in range(0, signals.shape[0], n_batch):
+            batch = slice(start, start + n_batch)
+            # data transformed once per batch and FFT length, in double
+            # precision also for float32 input
+            data_f = fft(signals[batch].astype(float), n_fft, axis=-1)
+
+            for (r_ix, o_ix), wavelet_f in zip(pairs, spectra):
+                spec_f = data_f * wavelet_f
+                d = decims[r_ix]
+                if d > 1:
+                    # every d-th sample of the convolution is the inverse
+                    # transform of the spectrum folded to n_fft / d bins
+                    spec_f = spec_f.reshape(spec_f.shape[0], d, -1).sum(axis=1) / d
+                # "same" part, the wavelet spectra are shifted to start at 0
+                spec = ifft(spec_f, axis=-1)[:, :n_out[r_ix]]
+                with np.errstate(divide="ignore"):
+                    rows[r_ix][batch] += filter_bank.weights[o_ix, r_ix] * np.log(np.abs(spec))
+
+    for row in rows:
+        np.exp(row, out=row)
+
+    if len(set(decims)) == 1:
+        return ampl.reshape(lead_shape + (n_rows, n_out[0]))
+    return [row.reshape(lead_shape + (n,)) for row, n in zip(rows, n_out)]
+
+
+class SuperletFilterBank:
+
+    """
+    Cache of the sampled and normalised superlet wavelets and their
+    spectra for one set of transform parameters.
+
+    Kernels and spectra are built on first use and kept up to
+    `max_bytes` (`BANK_MAX_BYTES` by default, None for the size of the
+    whole bank). Once the budget is used up, nothing is evicted and the
+    further entries are recomputed at every use: the transform visits
+    the FFT groups in the same order for every batch, a least recently
+    used cache would evict each one just before it is needed again
+    (the full grid at 1200 Hz is over 1 GB). The spectra are stored as complex64,
+    grouped by the FFT length needed for a signal of `n_times` samples
+    and, if `cache_dir` is given, saved there as .npy files so that later
+    processes can memory-map them instead of recomputing.
+
+    `scale_ix` and `decim` restrict the spectra to a subset of the
+    scales and their output decimation, see :func:`superlet_batch`.
+    """
+
+    def __init__(
+        self,
+        samplerate,
+        scales,
+        order_max,
+        order_min=1,
+        c_1=3,
+        adaptive=False,
+        n_times=None,
+        max_bytes=BANK_MAX_BYTES,
+        cache_dir=None,
+        scale_ix=None,
+        decim=1,
+    ):
+
+        self.samplerate = samplerate
+        self.dt = 1 / samplerate
+        self.scales = np.asarray(scales)
+        self.order_max = order_max
+        self.order_min = order_min
+        self.c_1 = c_1
+        self.adaptive = adaptive
+        self.n_times = n_times
+        self.cache_dir = cache_dir
+
+        if scale_ix is None:
+            scale_ix = np.arange(len(self.scales))
+        self.scale_ix = np.asarray(scale_ix)
+        self.decim = np.broadcast_to(decim, self.scale_ix.shape).astype(int).tolist()
+
+        self.key = self.make_key(
+            samplerate, scales, c_1, order_min, order_max, n_times, adaptive,
+            scale_ix, decim
+        )
+        self.digest = hashlib.sha1(repr(self.key).encode()).hexdigest()[:16]
+
+        # orders follow the full set of scales, weights only the computed rows
+        self.cycles, weights = _superlet_weights(
+            self.scales, order_max, order_min, c_1, adaptive
+        )
+        self.weights = weights[:, self.scale_ix]
+        self.SL = {c: MorletSL(c) for c in self.cycles}
+
+        # every (row, wavelet) pair of the geometric mean grouped by the
+        # FFT length it needs, so short wavelets don't pay for the longest one
+        self.groups = {}
+        if n_times is not None:
+            for r_ix, o_ix in zip(*np.nonzero(self.weights.T)):
+                d = self.decim[r_ix]
+                M = len(self._support(r_ix, o_ix))
+                # divisible by the decimation to fold the spectrum
+                n_fft = d * next_fast_len(-(-(n_times + M - 1) // d))
+                self.groups.setdefault(n_fft, []).append((r_ix, o_ix))
+
+        if max_bytes is None:
+            # all the spectra and kernels of the bank
+            n_kernels = sum(
+                len(self._support(r_ix, o_ix)) for r_ix, o_ix in zip(*np.nonzero(self.weights.T))
+            )
+            max_bytes = 16 * n_kernels + sum(
+                len(pairs) * n_fft * np.dtype(np.complex64).itemsize
+                for n_fft, pairs in self.groups.items()
+            )
+        self.max_bytes = max_bytes
+
+        self._cache = {}
+        self._nbytes = 0
+
+    @staticmethod
+    def make_key(
+        samplerate, scales, c_1, order_min, order_max, n_times, adaptive,
+        scale_ix=None, decim=1
+    ):
+        # None is all the scales
+        if scale_ix is None:
+            scale_ix = np.arange(len(scales))
+        scale_ix = tuple(np.asarray(scale_ix).tolist())
+        return (
+            float(samplerate), tuple(np.asarray(scales).tolist()), c_1,
+            order_min, order_max, n_times, bool(adaptive),
+            scale_ix, tuple(np.atleast_1d(decim).tolist())
+        )
+
+    # names of the make_key fields
+    KEY_FIELDS = (
+        "samplerate", "scales", "c_1", "order_min", "order_max", "n_times",
+        "adaptive", "scale_ix", "decim"
+    )
+
+    def check_key(
+        self, samplerate, scales, c_1, order_min, order_max, n_times=None,
+        adaptive=False, scale_ix=None, decim=1
+    ):
+
+        """
+        Raises a ValueError if the bank was built for other transform
+        parameters. `n_times` None skips the number of samples, the
+        subset of scales and the decimation (kernels only).
+        """
+
+        key = self.make_key(
+            samplerate, scales, c_1, order_min, order_max, n_times, adaptive,
+            scale_ix, decim
+        )
+        fields = range(len(key)) if n_times is not None else (0, 1, 2, 3, 4, 6)
+        for ix in fields:
+            if key[ix] != self.key[ix]:
+                raise ValueError(
+                    f"Filter bank was built for a different {self.KEY_FIELDS[ix]}!"
+                )
+
+    def kernel(self, scale, cycles):
+
+        """
+        Sampled and normalised wavelet as used by :func:`cwtSL`.
+        """
+
+        key = ("kernel", float(scale), cycles)
+        wavelet_data = self._get(key)
+        if wavelet_data is None:
+            if cycles not in self.SL:
+                self.SL[cycles] = MorletSL(cycles)
+            t = _get_superlet_support(scale, self.dt, cycles)
+            norm = self.dt ** 0.5 / (4 * np.pi)
+            wavelet_data = norm * self.SL[cycles](t, scale)
+            self._put(key, wavelet_data)
+        return wavelet_data
+
+    def spectra(self, n_fft):
+
+        """
+        Spectra of all the wavelets in the `n_fft` group, in the order
+        of `groups[n_fft]`. The wavelets are circularly shifted so that
+        the "same" part of the convolution starts at sample 0.
+        """
+
+        key = ("spectra", n_fft)
+        spectra = self._get(key)
+        if spectra is not None:
+            return spectra
+
+        pairs = self.groups[n_fft]
+        path = None
+        if self.cache_dir is not None:
+            path = Path(self.cache_dir).joinpath(f"superlet-bank_{self.digest}_{n_fft}_c64.npy")
+            if path.exists():
+                try:
+                    spectra = np.load(path, mmap_mode="r")
+                except (OSError, ValueError, EOFError):
+                    spectra = None
+                # unreadable or truncated, rebuilt and replaced below
+                if spectra is not None and (
+                    spectra.shape != (len(pairs), n_fft) or spectra.dtype != np.complex64
+                ):
+                    spectra = None
+
+        if spectra is None:
+            spectra = np.empty((len(pairs), n_fft), dtype=np.complex64)
+            wavelet_data = np.zeros(n_fft, dtype=np.complex128)
+            for ix, (r_ix, o_ix) in enumerate(pairs):
+                kernel = self.kernel(self.scales[self.scale_ix[r_ix]], self.cycles[o_ix])
+                wavelet_data[:] = 0
+                wavelet_data[:len(kernel)] = kernel
+                offset = (len(kernel) - 1) // 2
+                spectra[ix] = fft(np.roll(wavelet_data, -offset))
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # written under a temporary name and renamed, so that other
+                # processes never map a partly written file
+                with tempfile.NamedTemporaryFile(
+                    dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False
+                ) as f:
+                    np.save(f, spectra)
+                os.replace(f.name, path)
+
+        self._put(key, spectra)
+        return spectra
+
+    def clear(self):
+        self._cache.clear()
+        self._nbytes = 0
+
+    def _support(self, r_ix, o_ix):
+        return _get_superlet_support(
+            self.scales[self.scale_ix[r_ix]], self.dt, self.cycles[o_ix]
+        )
+
+    def _get(self, key):
+        if key not in self._cache:
+            return None
+        return self._cache[key][0]
+
+    def _put(self, key, value):
+        nbytes = value.nbytes
+        # kept only within the budget, see the class docstring
+        if self._nbytes + nbytes > self.max_bytes:
+            return
+        self._cache[key] = (value, nbytes)
+        self._nbytes += nbytes
+
+
+_FILTER_BANKS = OrderedDict()
+
+
+def get_filter_bank(
+    samplerate,
+    scales,
+    order_max,
+    order_min=1,
+    c_1=3,
+    adaptive=False,
+    n_times=None,
+    max_bytes=BANK_MAX_BYTES,
+    cache_dir=None,
+    scale_ix=None,
+    decim=1,
+    max_banks=1,
+):
+
+    """
+    Returns the process wide :class:`SuperletFilterBank` for
+    the given parameters, creating it on first use. Only the
+    `max_banks` most recently used banks are kept alive, see
+    also :func:`clear_filter_banks`.
+    """
+
+    key = SuperletFilterBank.make_key(
+        samplerate, scales, c_1, order_min, order_max, n_times, adaptive,
+        scale_ix, decim
+    )
+    if key in _FILTER_BANKS:
+        _FILTER_BANKS.move_to_end(key)
+        return _FILTER_BANKS[key]
+
+    bank = SuperletFilterBank(
+        samplerate, scales, order_max, order_min, c_1, adaptive,
+        n_times, max_bytes, cache_dir, scale_ix, decim
+    )
+    _FILTER_BANKS[key] = bank
+    while len(_FILTER_BANKS) > max_banks:
+        _FILTER_BANKS.popitem(last=False)
+    return bank
+
+
+def clear_filter_banks():
+
+    """
+    Releases the process wide filter banks, e.g. between subjects.
+    """
+
+    _FILTER_BANKS.clear()
+
+
+class StreamingSuperlet:
+
+    """
+    Stateful amplitude-only Superlet Transform of a stream of
+    fixed-size blocks, e.g. the blocks of a real-time acquisition.
+
+    Every wavelet is applied by uniformly partitioned overlap-save
+    convolution: the wavelet is cut in partitions of `block_size`
+    samples whose spectra (FFT length 2 * block_size) are computed
+    once, and the spectra of the last input blocks are kept in a
+    frequency domain delay line. A block costs one FFT per channel,
+    one matrix product per frequency bin between the delay line and
+    the partition spectra of all the wavelets, and one short inverse
+    FFT per wavelet and channel, whatever the wavelet length.
+
+    The output of a block has `block_size` columns per frequency,
+    the amplitudes of :func:`superlet_batch` (same parameters and
+    `scale_ix`) delayed by `latency` samples: the convolutions are
+    "same" convolutions, a column needs the samples up to half the
+    longest wavelet of its frequency after it. The log-magnitudes of
+    the shorter wavelets are delayed to match before the geometric
+    mean. With `align` all the frequencies have the latency of the
+    slowest, so every column is one time point.
+    """
+
+    # the wavelets are split in groups of similar length, so the
+    # shorter ones don't multiply the zero partitions of the longest
+    n_groups = 4
+
+    def __init__(
+        self,
+        samplerate,
+        scales,
+        order_max,
+        order_min=1,
+        c_1=3,
+        adaptive=False,
+        block_size=60,
+        n_channels=1,
+        scale_ix=None,
+        align=True,
+    ):
+
+        """
+        Parameters
+        ----------
+        samplerate, scales, order_max, order_min, c_1, adaptive :
+            Superlet parameters, see :func:`superlet`
+        block_size : int
+            Number of samples of every block, e.g. 60 for 50 ms at 1200 Hz
+        n_channels : int
+            Number of channels of every block
+        scale_ix : 1D array of int or None
+            Indices of the scales to compute, the adaptive orders are
+            still derived from all the `scales`, see :func:`superlet_batch`
+        align : bool
+            Delay all the frequencies to the latency of the slowest
+        """
+
+        bank = SuperletFilterBank(
+            samplerate, scales, order_max, order_min, c_1, adaptive,
+            scale_ix=scale_ix
+        )
+        self.samplerate = samplerate
+        self.block_size = block_size
+        self.n_channels = n_channels
+        self.scale_ix = bank.scale_ix
+        self.n_fft = 2 * block_size
+
+        # (row, wavelet) pairs of the geometric mean, the longest first
+        pairs = list(zip(*np.nonzero(bank.weights.T)))
+        kernels = [
+            bank.kernel(bank.scales[bank.scale_ix[r_ix]], bank.cycles[o_ix])
+            for r_ix, o_ix in pairs
+        ]
+        order = np.argsort([-len(k) for k in kernels], kind="stable")
+        pairs = [pairs[i] for i in order]
+        kernels = [kernels[i] for i in order]
+        rows = np.array([r_ix for r_ix, o_ix in pairs])
+        n_parts = np.array([-(-len(k) // block_size) for k in kernels])
+        self.n_parts = int(n_parts[0])
+
+        # partition spectra of each group, (n_fft, partitions, wavelets)
+        self._spectra = []
+        bounds = np.linspace(0, len(pairs), self.n_groups + 1).astype(int)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if stop == start:
+                continue
+            spectra = np.zeros((self.n_fft, n_parts[start], stop - start), dtype=np.complex64)
+            for ix in range(start, stop):
+                padded = np.zeros(n_parts[ix] * block_size, dtype=np.complex128)
+                padded[:len(kernels[ix])] = kernels[ix]
+                parts = fft(padded.reshape(n_parts[ix], block_size), self.n_fft, axis=-1)
+                spectra[:, :n_parts[ix], ix - start] = parts.T
+            self._spectra.append(spectra)
+
+        # geometric mean exponents, pairs grouped by frequency
+        self._weights = np.array([bank.weights[o_ix, r_ix] for r_ix, o_ix in pairs], dtype=np.float32)
+        self._row_order = np.argsort(rows, kind="stable")
+        self._row_starts = np.searchsorted(rows[self._row_order], np.arange(len(self.scale_ix)))
+
+        # latency of every frequency and delay of every pair to reach it,
+        # sample of the "same" convolution at the centre of each wavelet
+        offsets = np.array([(len(k) - 1) // 2 for k in kernels])
+        latency = np.zeros(len(self.scale_ix), dtype=int)
+        np.maximum.at(latency, rows, offsets)
+        if align:
+            latency[:] = latency.max()
+        self.latency = latency
+        self._delays = latency[rows] - offsets
+
+        self.reset()
+
+    def reset(self):
+
+        """
+        Clear the state, the next block is the start of a new stream.
+        """
+
+        self.n_samples = 0
+        self._input = np.zeros((self.n_channels, self.n_fft))
+        # input spectra, the newest block first
+        self._fdl = np.zeros((self.n_fft, self.n_channels, self.n_parts), dtype=np.complex64)
+        # circular buffer of the log-magnitudes, long enough for the largest delay
+        self._history_len = int(self._delays.max()) + self.block_size
+        self._log_ampl = np.zeros((self.n_channels, len(self._delays), self._history_len), dtype=np.float32)
+        self._history_pos = 0
+
+    @property
+    def latency_s(self):
+
+        """
+        Latency of every frequency in seconds, the acquisition of the
+        block itself comes on top.
+        """
+
+        return self.latency / self.samplerate
+
+    def push(self, block):
+
+        """
+        Transform the next block.
+
+        Parameters
+        ----------
+        block : :class:`numpy.ndarray`
+            Shape (n_channels, block_size), or (block_size,) for one channel
+
+        Returns
+        -------
+        ampl : :class:`numpy.ndarray`
+            float32 amplitude, shape (n_channels, n_freqs, block_size)
+            or (n_freqs, block_size) for a 1D block. Column j of
+            frequency f is the sample `output_times()[f, j]` of the
+            stream, columns of negative samples are undefined.
+        """
+
+        block = np.asarray(block)
+        one_channel = block.ndim == 1
+        block = block.reshape(-1, block.shape[-1])
+        if block.shape != (self.n_channels, self.block_size):
+            raise ValueError(
+                f"Expected blocks of shape {(self.n_channels, self.block_size)}, got {block.shape}!"
+            )
+        B = self.block_size
+
+        # the last two blocks, transformed once per channel
+        self._input[:, :B] = self._input[:, B:]
+        self._input[:, B:] = block
+        self._fdl[..., 1:] = self._fdl[..., :-1]
+        self._fdl[..., 0] = fft(self._input, axis=-1).T
+
+        # per frequency bin, sum over the partitions of the partition
+        # spectra times the spectra of the input blocks they apply to
+        spec_f = np.empty((self.n_fft, self.n_channels, len(self._delays)), dtype=np.complex64)
+        start = 0
+        for spectra in self._spectra:
+            stop = start + spectra.shape[2]
+            np.matmul(self._fdl[..., :spectra.shape[1]], spectra, out=spec_f[..., start:stop])
+            start = stop
+        spec = ifft(spec_f, axis=0, overwrite_x=True)[B:]
+        self.n_samples += B
+
+        # log-magnitudes into the circular history
+        cols = (self._history_pos + np.arange(B)) % self._history_len
+        with np.errstate(divide="ignore"):
+            self._log_ampl[..., cols] = np.log(np.abs(spec)).transpose(1, 2, 0)
+        self._history_pos = (self._history_pos + B) % self._history_len
+
+        # delayed log-magnitudes, weighted sum per frequency
+        delayed = (cols[None, :] - self._delays[:, None]) % self._history_len
+        log_ampl = np.take_along_axis(self._log_ampl, delayed[None], axis=-1)
+        log_ampl *= self._weights[:, None]
+        ampl = np.exp(np.add.reduceat(log_ampl[:, self._row_order], self._row_starts, axis=1))
+        return ampl[0] if one_channel else ampl
+
+    def output_times(self):
+
+        """
+        Sample index in the stream of every column of the last output,
+        shape (n_freqs, block_size).
+        """
+
+        last = self.n_samples - self.block_size + np.arange(self.block_size)
+        return last[None, :] - self.latency[:, None]
+
+
+def _superlet_weights(scales, order_max, order_min=1, c_1=3, adaptive=False):
+
+    """
+    Cycles of the superlet set and the exponent of every
+    (wavelet, scale) pair in the geometric mean.
+
+    Mirrors the order bookkeeping of :func:`multiplicativeSLT` and
+    :func:`FASLT`, a zero weight means the wavelet is not used for
+    that scale.
+
+    Returns
+    -------
+    cycles : 1D :class:`numpy.ndarray`
+        Number of cycles of every Morlet in the superlet set
+    weights : 2D :class:`numpy.ndarray`
+        Exponents, shape is (len(cycles), len(scales))
+    """
+
+    if not adaptive:
+        cycles = c_1 * np.arange(order_min, order_max + 1)
+        weights = np.full((len(cycles), len(scales)), 1 / len(cycles))
+        return cycles, weights
+
+    fois = 1 / (2 * np.pi * scales)
+    orders = compute_adaptive_order(fois, order_min, order_max)
+    orders_int = np.int32(np.floor(orders))
+    cycles = c_1 * np.unique(orders_int)
+    exponents = 1 / (orders - order_min + 1)
+    order_jumps = np.where(np.diff(orders_int))[0]
+    alphas = orders % orders_int
+
+    weights = np.zeros((len(cycles), len(scales)))
+    weights[0] = exponents
+    last_jump = 1
+    for i, jump in enumerate(order_jumps):
+        scale_span = slice(last_jump, jump + 1)
+        weights[i + 1, scale_span] = alphas[scale_span] * exponents[scale_span]
+        weights[i + 1, jump + 1:] = exponents[jump + 1:]
+        last_jump = jump + 1
+
+    return cycles, weights
+
+
 # ---------------------------------------------------------
 # Some test data akin to figure 3 of the source publication
 # ---------------------------------------------------------
@@ -5,7 +5,7 @@ from pathlib import Path
 from mne.io import read_raw_ctf
 from mne.channels import read_layout
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from tools.superlet import superlet, scale_from_period
+from tools.superlet import superlet, superlet_batch, scale_from_period, get_filter_bank, StreamingSuperlet
 
 
 def colorbar(mappable, label):
@@ -183,6 +183,19 @@ def load_json(json_path):
     return data
 
 
+def peak_rss():
+    """Peak resident set size in bytes of this process and of its largest finished child process, nan where the
+    resource module is not available (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return np.nan, np.nan
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return own, children
+
+
 def find_missing_channels(raw, layout="CTF275", ch_name_string="M"):
     """Returns missing channels and the indices"""
     lay_full = read_layout(fname=layout)
@@ -194,11 +207,15 @@ def find_missing_channels(raw, layout="CTF275", ch_name_string="M"):
     return missing_chan, missing_chan_ix
 
 
-def superlet_tf(signal, sfreq, num="nyquist", max_freq=120):
+def superlet_tf(signal, sfreq, num="nyquist", max_freq=120, cache_dir=None):
     if num == "nyquist":
         num = int(sfreq/2)
     foi = np.linspace(1, max_freq, num=num)
     scales = scale_from_period(1/foi)
+    filter_bank = get_filter_bank(
+        sfreq, scales, order_max=40, order_min=1, c_1=4, adaptive=True,
+        n_times=signal.shape[0], cache_dir=cache_dir
+    )
     spec = superlet(
         signal,
         samplerate=sfreq,
@@ -206,9 +223,146 @@ def superlet_tf(signal, sfreq, num="nyquist", max_freq=120):
         order_max=40,
         order_min=1,
         c_1=4,
-        adaptive=True
+        adaptive=True,
+        filter_bank=filter_bank,
+        magnitude=True
+    )
+    return spec
+
+
+def superlet_tf_batch(data, sfreq, num="nyquist", max_freq=120, n_batch=64, cache_dir=None, foi_ix=None, decim=1):
+    """
+    Batched version of `superlet_tf` for a whole epochs array.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Signals with time on the last axis, e.g. (trials, channels, times).
+    sfreq : float
+        Sampling frequency in Hz.
+    num : int or str
+        Number of frequencies between 1 Hz and `max_freq`, "nyquist" uses int(sfreq/2).
+    max_freq : float
+        Highest frequency of interest.
+    n_batch : int
+        Number of signals transformed together.
+    cache_dir : str or pathlib.Path or None
+        Directory to persist the wavelet spectra in, reused by later runs.
+    foi_ix : array of int or None
+        Indices of the frequencies (see `superlet_foi`) to compute, the superlet orders are
+        still those of the full frequency grid.
+    decim : int or array of int
+        Output decimation in time, for all the computed frequencies or one per frequency.
+
+    Returns
+    -------
+    tf : numpy.ndarray or list
+        float32 amplitude, shape (trials, channels, freqs, times / decim). A list of
+        (trials, channels, times / decim) arrays if the decimation differs between frequencies.
+    """
+
+    foi = superlet_foi(sfreq, num=num, max_freq=max_freq)
+    scales = scale_from_period(1/foi)
+    filter_bank = get_filter_bank(
+        sfreq, scales, order_max=40, order_min=1, c_1=4, adaptive=True,
+        n_times=data.shape[-1], cache_dir=cache_dir, scale_ix=foi_ix, decim=decim
+    )
+    return superlet_batch(
+        data,
+        samplerate=sfreq,
+        scales=scales,
+        order_max=40,
+        order_min=1,
+        c_1=4,
+        adaptive=True,
+        n_batch=n_batch,
+        filter_bank=filter_bank,
+        scale_ix=foi_ix,
+        decim=decim
+    )
+
+
+def superlet_stream(sfreq, block_size, n_channels=1, num="nyquist", max_freq=120, band=None, foi_ix=None,
+                    align=True, order_max=10):
+    """
+    Streaming version of `superlet_tf_batch`, see `tools.superlet.StreamingSuperlet`.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency in Hz.
+    block_size : int
+        Number of samples of every pushed block.
+    n_channels : int
+        Number of channels of every pushed block.
+    band : tuple or None
+        (low, high) frequency limits in Hz, e.g. (10, 33) for the burst search range. Only the frequencies
+        of the `superlet_foi` grid within the band are computed, which is what keeps the transform real time.
+    foi_ix : array of int or None
+        Indices of the frequencies to compute, instead of `band`.
+    align : bool
+        Same latency for all the frequencies.
+    order_max : int
+        Highest superlet order. 10 by default for the online path, 40 as `superlet_tf_batch` for the same
+        output as the batch transform. The latency is set by the longest wavelet: about 0.66 s in the beta band
+        with 10 instead of 1.5 s with 40, at the cost of frequency resolution but with a similar agreement of
+        the online bursts with the batch ones (see `realtime_benchmark.replay_bursts`).
+
+    Returns
+    -------
+    stream : tools.superlet.StreamingSuperlet
+        Its `push` returns the float32 amplitude (channels, freqs, block_size) of the `superlet_tf_batch`
+        frequencies, `stream.latency` samples late.
+    freqs : numpy.ndarray
+        Frequencies of the rows.
+    """
+
+    foi = superlet_foi(sfreq, num=num, max_freq=max_freq)
+    if band is not None:
+        foi_ix = np.where((foi >= band[0]) & (foi <= band[1]))[0]
+    stream = StreamingSuperlet(
+        sfreq, scale_from_period(1/foi), order_max=order_max, order_min=1, c_1=4, adaptive=True,
+        block_size=block_size, n_channels=n_channels, scale_ix=foi_ix, align=align
     )
-    return np.single(np.abs(spec))
+    return stream, foi[stream.scale_ix]
+
+
+def superlet_foi(sfreq, num="nyquist", max_freq=120):
+    """Frequency grid of `superlet_tf` and `superlet_tf_batch`."""
+    if num == "nyquist":
+        num = int(sfreq/2)
+    return np.linspace(1, max_freq, num=num)
+
+
+def superlet_mean_spectrum(data, sfreq, num="nyquist", max_freq=120, step=4, samples_per_cycle=8,
+                           n_batch=64, cache_dir=None):
+    """
+    Time and trial averaged superlet amplitude on a coarse frequency grid.
+
+    Meant for the aperiodic fit, which only needs the average spectrum: every `step`-th frequency
+    of the `superlet_tf` grid is computed and each frequency is decimated in time to about
+    `samples_per_cycle` samples per cycle before averaging.
+
+    Returns
+    -------
+    freqs : numpy.ndarray
+        The coarse frequency grid.
+    spectrum : numpy.ndarray
+        Average amplitude, shape data.shape[1:-1] + (freqs,).
+    """
+
+    foi = superlet_foi(sfreq, num=num, max_freq=max_freq)
+    foi_ix = np.arange(0, len(foi), step)
+    decim = np.maximum(1, np.floor(sfreq / (samples_per_cycle * foi[foi_ix]))).astype(int)
+    tf = superlet_tf_batch(
+        data, sfreq, num=num, max_freq=max_freq, n_batch=n_batch, cache_dir=cache_dir,
+        foi_ix=foi_ix, decim=decim
+    )
+    if isinstance(tf, list):
+        spectrum = np.stack([np.mean(i, axis=(0, -1)) for i in tf], axis=-1)
+    else:
+        spectrum = np.moveaxis(np.mean(tf, axis=(0, -1)), 0, -1)
+    return foi[foi_ix], spectrum
 
 
 def many_is_in(multiple, target):
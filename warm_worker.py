@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import socket
+import importlib
+import tempfile
+import threading
+import traceback
+import socketserver
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# stage scripts that expose run_index(index)
+STAGE_MODULES = ["00_raw_preproc", "02_epochs", "03_beta_power_burst_extraction"]
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "real_time_confidence_worker.sock")
+
+
+def module_name(script):
+    """Module name of a stage script path, e.g. "./02_epochs.py" -> "02_epochs"."""
+    return Path(script).stem
+
+
+def _import_stages(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+def _run_index(module, index, kwargs, submitted):
+    start = time.time()
+    try:
+        importlib.import_module(module).run_index(index, **kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return {
+        "module": module, "index": index, "status": "done" if error is None else "failed",
+        "queue_wait": round(start - submitted, 3), "duration": round(time.time() - start, 3),
+        "pid": os.getpid(), "error": error
+    }
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def reply(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            command = request.get("command", "run")
+            if command == "run":
+                for result in self.server.worker.run(request["module"], request["indices"], request.get("kwargs")):
+                    self.reply(result)
+                self.reply({"command": "run", "status": "finished"})
+            elif command == "reload":
+                self.server.worker.reload()
+                self.reply({"command": "reload", "status": "finished"})
+            elif command == "shutdown":
+                self.reply({"command": "shutdown", "status": "finished"})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            else:
+                self.reply({"command": command, "status": "unknown command"})
+
+
+class WarmWorker:
+    """
+    Long-lived pool of worker processes with the stage modules imported once: mne, meegkit, specparam, the
+    settings and the file lists of each stage are loaded at start, every task then only calls run_index(index).
+    Tasks are received as JSON lines on a Unix socket, see `submit`, and the timing of each task is returned and
+    appended to a log.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, n_workers=1, modules=STAGE_MODULES, log_path=None):
+        """
+        :param socket_path: Unix socket the server listens on
+        :param n_workers: number of worker processes
+        :param modules: stage modules imported by the workers
+        :param log_path: .jsonl file the task timings are appended to, None for no log
+        """
+        self.socket_path = socket_path
+        self.n_workers = n_workers
+        self.modules = list(modules)
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        # imported here first, forked workers start with the modules loaded
+        _import_stages(self.modules)
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.n_workers, initializer=_import_stages, initargs=(self.modules,))
+
+    def reload(self):
+        """
+        Re-import the stage modules (settings.json and file lists) and start new workers, the running tasks
+        finish on the old ones
+        """
+        with self._lock:
+            for module in self.modules:
+                importlib.reload(importlib.import_module(module))
+            old_pool, self.pool = self.pool, self._new_pool()
+        old_pool.shutdown(wait=False)
+        print("RELOAD", ", ".join(self.modules))
+
+    def run(self, module, indices, kwargs=None):
+        """
+        Run module.run_index for each index on the pool
+        :param module: stage module or script path
+        :param indices: list of indices
+        :param kwargs: extra run_index keyword arguments
+        :return: generator of timing dictionaries, in the order the tasks finish
+        """
+        module = module_name(module)
+        if module not in self.modules:
+            raise ValueError(f"{module} is not a stage module")
+        with self._lock:
+            futures = [
+                self.pool.submit(_run_index, module, index, kwargs or {}, time.time()) for index in indices
+            ]
+        for future in as_completed(futures):
+            result = future.result()
+            print(
+                f"{result['status'].upper()} {module} index: {result['index']} wait: {result['queue_wait']} s "
+                f"time: {round(result['duration'] / 60, 2)} min"
+            )
+            if result["error"] is not None:
+                print(result["error"])
+            if self.log_path is not None:
+                with self._lock, open(self.log_path, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+            yield result
+
+    def serve_forever(self):
+        """
+        Serve requests on the Unix socket until a shutdown command
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, _Handler) as server:
+            server.worker = self
+            print(f"LISTENING {self.socket_path} workers: {self.n_workers}")
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(self.socket_path)
+                self.pool.shutdown()
+
+
+def _request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode())
+        for line in client.makefile("r"):
+            message = json.loads(line)
+            if message.get("status") == "finished":
+                return
+            yield message
+
+
+def submit(socket_path, module, indices, kwargs=None):
+    """
+    Send tasks to a running WarmWorker and wait for them
+    :param socket_path: Unix socket of the server
+    :param module: stage module or script path, e.g. "02_epochs.py"
+    :param indices: list of indices
+    :param kwargs: extra run_index keyword arguments
+    :return: generator of timing dictionaries, in the order the tasks finish
+    """
+    request = {"command": "run", "module": module_name(module), "indices": list(indices), "kwargs": kwargs or {}}
+    return _request(socket_path, request)
+
+
+def send_command(socket_path, command):
+    """
+    :param socket_path: Unix socket of the server
+    :param command: "reload" or "shutdown"
+    """
+    for message in _request(socket_path, {"command": command}):
+        print(message)